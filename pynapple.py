@@ -3,43 +3,150 @@
 #
 # Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
 #
-# Notes/caveats:
-#
-# > doesn't handle large nick-lists (i.e. lists spanning multiple 353 messages)
-#
 # By the way, this line is 80 characters long....................................
 
-import queue
+import argparse
+import collections
+import importlib
+import re
 from datetime import datetime
 import hashlib
-import socket
+import os
 import string
 import threading
 import time
 
-from pynapple_tkui import *
-#from pynapple_ncui import *
+from pynapple_capture import RECEIVED, SENT, TrafficCapture
+from pynapple_history import History
+from pynapple_log import Logger
+from pynapple_match import Matcher
+from pynapple_net import (AddressCache, FastPath, LineFramer, LoadShedder,
+                          ReceiveQueue, SenderThread, SendQueue, WakeupPipe,
+                          format_address, get_default_engine, open_connection)
+from pynapple_proto import Dispatcher, NickList, irc_lower, parse_message
+from pynapple_ring import RingBuffer
+from pynapple_stats import Metrics, StatsWriter
+
+# The user interface backends, by the name used to pick one on the command
+# line, and the module implementing each. Only the chosen one is imported, so
+# e.g. running headless never loads Tk.
+backends = {
+    "tk": "pynapple_tkui",
+    "curses": "pynapple_ncui",
+    "headless": "pynapple_nullui",
+}
+defaultBackend = "tk"
+
+def load_backend(name):
+    # Import the given backend and return its UserInterfacePlugin class.
+    return importlib.import_module(backends[name]).UserInterfacePlugin
+
+class Buffer:
+    # The state of one channel we're in (or of the status buffer, which isn't
+    # tied to any connection): its nick-list, topic, and the lines displayed
+    # in it. Only the current buffer is shown; lines added to any other buffer
+    # are kept until the user switches to it. At most scrollback lines are kept
+    # (as (message, color, hilite) tuples); older ones are dropped.
+    scrollback = 5000
+
+    def __init__(self, conn, name):
+        self.conn = conn # the IRC connection this channel belongs to, or None
+        self.name = name
+        self.topic = ""
+        self.nicklist = NickList()
+        self.pendingNames = None # NickList being filled in by a names reply
+        self.lines = RingBuffer(self.scrollback)
+        self.unread = 0
+
+    def is_channel(self):
+        return self.conn is not None
 
 class IRC:
     # Encapsulates a connection to an IRC server. Handles sending / receiving of
-    # messages, message parsing, connection and disconnection, etc.
+    # messages, message parsing, connection and disconnection, etc. Each
+    # connection keeps track of the channels joined through it, indexed by
+    # their case-folded name, so incoming messages are routed to the right
+    # buffer with a single lookup.
     nick = "pynapple"
     host = "localhost"
-    server = ""
-    topic = ""
     user = "pynapple"
     name = "Pynapple"
     partMessage = "Parting!"
     quitMessage = "Quitting!"
-    logfile = "log.txt"
+    encoding = "utf-8"           # preferred encoding for incoming lines
+    fallbackEncoding = "latin-1" # for lines that aren't valid in the above
+    rxBufferSize = 65536         # size of the socket thread's receive buffer
+    maxLineLength = 8704         # 512 byte message plus 8191 bytes of tags
     version = "0.0000001"
-    channel = ""
-    nicklist = []
-    connected = False
-    joined = False
-    logEnabled = False
-    stopThreadRequest = threading.Event()
-    rxQueue = queue.Queue()
+    autoJoin = []         # channels joined once we've logged in
+    pollTimeout = 0.01    # seconds poll() may block waiting for a first message
+    pollBatchSize = 500   # max messages handled per poll() call
+    pollBatchTime = 0.02  # max seconds spent handling messages per poll() call
+    fastReplies = True    # answer PINGs and CTCPs as soon as they're received
+    connectAttemptDelay = 0.25 # seconds before racing the next address
+    connectTimeout = 10.0 # seconds to give up connecting after
+    churnWindow = 0.5     # seconds over which joins, parts and quits are collected
+    churnSummary = 4      # more of them than this in a channel are summarized
+    splitMemory = 900.0   # seconds to remember users lost in a netsplit
+    capabilities = ("batch",) # IRCv3 capabilities we ask for
+    rxQueueSize = 10000   # received lines waiting to be handled, at most
+    rxOverload = "shed"   # what to do beyond that: "shed" or "pause"
+    rxShedCommands = ("JOIN", "PART", "QUIT") # dropped first when shedding
+    shedReportInterval = 5.0 # seconds between reports of dropped lines
+    messageHandlers = (   # commands handled by us, and the methods doing so
+        ("PING", "handle_ping"),
+        ("PRIVMSG", "handle_privmsg"),
+        ("JOIN", "handle_join"),
+        ("PART", "handle_part"),
+        ("QUIT", "handle_quit"),
+        ("NICK", "handle_nick"),
+        ("MODE", "handle_mode"),
+        ("CAP", "handle_cap"),
+        ("BATCH", "handle_batch"),
+        ("005", "handle_isupport"),
+        ("353", "handle_namreply"),
+        ("366", "handle_endofnames"),
+        ("376", "handle_endofmotd"),
+    )
+
+    def __init__(self, session):
+        self.session = session
+        self.server = ""
+        self.port = 0
+        self.sock = None
+        self.conn = None         # AsyncConnection, when using asyncio
+        self.connected = False
+        self.channels = {}       # Buffer objects, keyed by irc_lower(name)
+        self.prefixModes = "qaohv" # channel modes giving users a status
+        self.prefixes = "~&@%+"  # the corresponding nick-list prefixes
+        self.chanModes = ("beI", "k", "l") # other modes taking a parameter
+        self.stopThreadRequest = threading.Event()
+        self.sendQueue = None    # SendQueue for the current connection
+        self.fastPath = None     # FastPath answering PINGs, if fastReplies
+        self.dispatcher = Dispatcher()
+        self.shedder = LoadShedder(self.dispatcher.handlers, self.rxShedCommands)
+        self.rxQueue = ReceiveQueue(self.rxQueueSize, self.rxOverload,
+                                    self.shedder) # (arrival time, line)
+        self.rxPending = collections.deque()
+        self.rxLag = 0.0         # how late the last batch was (asyncio only)
+        self.rxLagAt = 0.0       # ... and when it was handled
+        self.shedCounts = {}     # lines dropped but not reported, by command
+        self.shedReported = 0.0
+        self.resyncPending = False # nick-lists to be fetched once caught up
+        self.lagRecheck = False
+        self.rxMaxDepth = 0      # most messages ever found waiting by poll()
+        self.pollHandled = 0     # messages handled by the most recent poll()
+        self.framer = None       # LineFramer of the current connection
+        self.nickChanges = {}    # Buffer -> nick-list changes not yet shown
+        self.churn = {}          # Buffer -> joins etc. not yet reported
+        self.churnScheduled = False
+        self.churnDeferrals = 0  # windows waited for a batch to end
+        self.splitNicks = {}     # irc_lower(nick) -> (when they split away,
+                                 # channels they haven't rejoined yet)
+        self.batches = {}        # open IRCv3 batches: reference -> (type, params)
+        self.enabledCaps = set()
+        for command, method in self.messageHandlers:
+            self.register_handler(command, getattr(self, method))
 
     def start_thread(self):
         # Spawn a new thread to handle incoming data. This function expects that
@@ -48,123 +155,397 @@ class IRC:
                                          self.rxQueue,
                                          self.server,
                                          self.port,
-                                         self.sock)
+                                         self.sock,
+                                         self.make_framer(),
+                                         self.session.rxEvent.set,
+                                         self.fastPath,
+                                         lambda e, q=self.sendQueue:
+                                         self.run_on_ui(self.socket_lost, q, e))
         self.stopThreadRequest.clear()
         self.socketThread.start()
+        self.senderThread = SenderThread(self.sendQueue, self.sock)
+        self.senderThread.start()
 
     def stop_thread(self):
         # Signal the socket thread to terminate by setting a shared event flag.
+        # The sender thread finishes once it has sent anything urgent (like
+        # our QUIT) still queued.
         self.stopThreadRequest.set()
+        self.sendQueue.close()
+
+    def make_framer(self):
+        # Create a line framer for a new connection, using our settings.
+        self.framer = LineFramer(self.rxBufferSize, self.maxLineLength,
+                                 self.encoding, self.fallbackEncoding)
+        return self.framer
 
     def connect(self, server, port):
-        # Connect to an IRC server using a given host name and port. Creates a
-        # network socket that is used by a separate thread when receiving data.
+        # Connect to an IRC server using a given host name and port. Returns
+        # right away: the connection is made by another thread, which creates
+        # a network socket that is used by a separate thread when receiving
+        # data (or handed to the asyncio engine). Anything we send is held back
+        # until the connection has been established.
         if (not self.connected):
             self.server = server
             self.port = port
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((server, port))
-            self.start_thread()
+            self.sendQueue = SendQueue()
+            self.shedder.nick = self.nick
+            self.fastPath = None
+            if (self.fastReplies):
+                self.fastPath = FastPath(self.sendQueue, self.version)
+            engine = self.session.get_engine()
+            if (engine is None):
+                threading.Thread(target=self.connect_thread,
+                                 args=(server, port, self.sendQueue),
+                                 daemon=True).start()
+            else:
+                self.conn = engine.connect(server, port, self.make_framer(),
+                                           self.receive_lines,
+                                           self.connection_lost,
+                                           self.sendQueue, self.fastPath,
+                                           lambda: self.open_socket(server,
+                                                                    port),
+                                           self.rxQueueSize, self.rxOverload,
+                                           self.shedder)
             ui.add_status_message("connecting to %s:%s" % (server, str(port)))
             self.connected = True
             self.login(self.nick, self.user, self.name, self.host, server)
         else:
             ui.add_status_message("already connected")
 
+    def open_socket(self, server, port):
+        # Resolve the server's name (unless we did so recently) and connect to
+        # whichever of its addresses answers first, reporting progress in the
+        # status buffer. Returns the connected socket, or raises OSError.
+        # Blocks, so runs on a thread of its own.
+        infos, cached = self.session.addressCache.resolve(server, port)
+        addresses = [format_address(info[4]) for info in infos]
+        self.run_on_ui(ui.add_status_message, "%s is %s%s" % (server,
+                       ", ".join(addresses), " (cached)" if cached else ""))
+        sock, address = open_connection(infos, self.connectAttemptDelay,
+                                        self.connectTimeout,
+                                        lambda s: self.run_on_ui(
+                                            ui.add_status_message, s))
+        self.run_on_ui(ui.add_status_message, "connected to %s" %
+                       format_address(address))
+        return sock
+
+    def connect_thread(self, server, port, sendQueue):
+        # Open a connection for the threaded engine, then pass it back to the
+        # UI thread.
+        try:
+            sock = self.open_socket(server, port)
+        except OSError as e:
+            self.run_on_ui(self.connect_failed, sendQueue, e)
+            return
+        self.run_on_ui(self.connect_done, sendQueue, sock)
+
+    def connect_done(self, sendQueue, sock):
+        # Start using a newly opened socket, unless the user gave up on this
+        # connection (or started another) in the meantime.
+        if (sendQueue is not self.sendQueue or not self.connected):
+            sock.close()
+            return
+        self.sock = sock
+        self.start_thread()
+
+    def connect_failed(self, sendQueue, e):
+        if (sendQueue is self.sendQueue and self.connected):
+            self.sendQueue.close()
+            self.connection_closed()
+            ui.add_status_message("connection failed: %s" % e)
+            ui.update_status()
+
+    def socket_lost(self, sendQueue, e):
+        # The socket thread has found the connection closed by the server (or
+        # failed), as the asyncio engine reports through connection_lost().
+        if (sendQueue is self.sendQueue and self.connected and
+            self.conn is None):
+            self.sendQueue.close()
+            self.connection_closed()
+            if (e is not None):
+                ui.add_status_message("connection failed: %s" % e)
+            else:
+                ui.add_status_message("connection closed by server")
+            ui.update_status()
+
+    def run_later(self, delay, f, *args):
+        # Have f(*args) called on the UI thread after the given delay.
+        engine = self.session.get_engine()
+        if (engine is None):
+            timer = threading.Timer(delay, self.session.call_soon,
+                                    (f,) + args)
+            timer.daemon = True
+            timer.start()
+        else:
+            engine.call(engine.call_later, delay, engine.deliver, f, *args)
+
+    def run_on_ui(self, f, *args):
+        # Have f(*args) called on the UI thread. Safe to call from any thread.
+        engine = self.session.get_engine()
+        if (engine is None):
+            self.session.call_soon(f, *args)
+        else:
+            engine.call(engine.deliver, f, *args)
+
     def send(self, command):
-        # Send data to a connected IRC server.
+        # Send data to a connected IRC server. Messages are queued, and written
+        # by the sender thread (or the asyncio engine) as flood control allows;
+        # PONGs and QUITs jump the queue. Over-long messages are split.
         if (self.connected):
-            self.sock.send(bytes(command + '\n', 'UTF-8'))
-            ui.add_debug_message("-> " + command)
+            self.sendQueue.put(command, reserve=self.prefix_length())
+            if (self.conn is not None):
+                self.conn.pump()
+            self.session.capture_traffic(self.server, SENT, command)
 
-    def send_message(self, s):
-        # Send a message to the currently joined channel.
-        if (self.joined):
-            ui.add_nick_message(irc.get_nick(), s)
-            self.send("PRIVMSG %s :%s" % (self.channel, s))
-        else:
-            ui.add_status_message("not in a channel")
+    def prefix_length(self):
+        # Return the most bytes the server may add in front of our messages
+        # when relaying them (":nick!user@host ", allowing for the longest
+        # host name).
+        return len(self.nick) + len(self.user) + 63 + 5
+
+    def get_send_stats(self):
+        # Return the send queue's depth, latency etc. (see SendQueue).
+        if (self.sendQueue is None):
+            return {}
+        return self.sendQueue.get_stats()
+
+    def get_stats(self):
+        # Return the traffic received so far, the receive and send queues, and
+        # the size of each channel's nick-list.
+        stats = {"server": self.server, "bytesReceived": 0, "linesReceived": 0,
+                 "rxQueue": self.get_backlog(), "rxMaxDepth": self.rxMaxDepth,
+                 "send": self.get_send_stats(), "nicks": {},
+                 "lag": self.get_lag(), "shed": self.shedder.total,
+                 "receive": self.rxQueue.get_stats()}
+        if (self.conn is not None):
+            stats["receive"] = self.conn.get_stats()
+        if (self.fastPath is not None):
+            stats["fastPath"] = self.fastPath.get_stats()
+        if (self.framer is not None):
+            stats["bytesReceived"] = self.framer.bytesReceived
+            stats["linesReceived"] = self.framer.linesFramed
+        for chan in list(self.channels.values()):
+            stats["nicks"][chan.name] = len(chan.nicklist)
+        return stats
+
+    def send_message(self, chan, s):
+        # Send a message to the given channel.
+        ui.add_nick_message(self.nick, s, chan)
+        self.session.record(self.server, chan.name, self.nick, s)
+        self.send("PRIVMSG %s :%s" % (chan.name, s))
 
     def send_private_message(self, nick, s):
         # Send a private message to the given nickname.
         if (self.connected):
             self.send("PRIVMSG %s :%s" % (nick, s))
-            ui.add_nick_message(irc.get_nick(), "[%s] %s" % (nick, s))
+            ui.add_nick_message(self.nick, "[%s] %s" % (nick, s))
+            self.session.record(self.server, nick, self.nick, s)
         else:
             ui.add_status_message("not connected")
 
-    def get_status(self):
-        return (self.nick, self.server, self.channel, self.topic)
-
     def disconnect(self):
         # Disconnect from the currently connected IRC server.
         if (self.connected):
             self.send("QUIT :%s" % self.quitMessage)
-            self.stop_thread()
-            self.connected = False
-            self.server = ""
+            if (self.conn is not None):
+                self.conn.close()
+                self.conn = None
+            else:
+                self.stop_thread()
+            self.connection_closed()
             ui.add_status_message("disconnected")
             ui.update_status()
         else:
             ui.add_status_message("not connected")
 
+    def connection_closed(self):
+        # Forget about our channels and drop out of the session.
+        self.session.remove_connection(self)
+        for chan in list(self.channels.values()):
+            self.session.remove_buffer(chan)
+        self.channels = {}
+        self.nickChanges = {}
+        self.churn = {}
+        self.batches = {}
+        self.enabledCaps = set()
+        self.connected = False
+        self.server = ""
+
     def login(self, nick, user, name, host, server):
-        # Send a log-in stanza to the currently connected server.
+        # Send a log-in stanza to the currently connected server. Servers that
+        # know about IRCv3 capabilities wait for us to finish asking for them
+        # (see handle_cap()); others just ignore the request.
+        if (self.capabilities):
+            self.send("CAP REQ :%s" % " ".join(self.capabilities))
         self.send("USER %s %s %s %s" % (user, host, server, name))
         self.send("NICK %s" % nick)
         ui.add_status_message("using nickname %s" % nick)
 
     def join(self, channel):
-        # Join the given channel.
+        # Join the given channel, or switch to it if we're already there.
         if (self.connected):
-            if (not self.joined):
+            chan = self.get_channel(channel)
+            if (chan is None):
                 self.send("JOIN %s" % channel)
             else:
-                ui.add_status_message("already in a channel")
+                self.session.switch_buffer(chan)
         else:
             ui.add_status_message("not connected")
 
-    def part(self):
-        # Leave the current channel.
-        if (self.joined):
-            self.send("PART %s" % self.channel)
-            self.set_nicklist([])
-            ui.add_status_message("left channel %s " % self.channel)
-            self.joined = False
-            self.channel = ""
-            ui.update_status()
-        else:
-            ui.add_status_message("not in a channel")
+    def part(self, chan):
+        # Leave the given channel.
+        self.send("PART %s" % chan.name)
+        del self.channels[irc_lower(chan.name)]
+        self.session.remove_buffer(chan)
+        ui.add_status_message("left channel %s " % chan.name)
+        ui.update_status()
 
-    def add_nick(self, s):
+    def get_channel(self, name):
+        # Return the buffer of the given channel, or None if we're not in it.
+        return self.channels.get(irc_lower(name))
+
+    def add_nick(self, chan, s):
         # Add a nickname to the list of nicknames we think are in the channel.
         # Called when a user joins the current channel, in response to a join.
-        self.nicklist.append(s)
-        self.nicklist.sort()
-        ui.set_nicklist(self.nicklist)
+        # A names reply being received at the same time gets it too.
+        if (chan.pendingNames is not None):
+            chan.pendingNames.add(s)
+        added, removed = chan.nicklist.add(s)
+        self.nicklist_changed(chan, added, removed)
 
-    def del_nick(self, s):
+    def del_nick(self, chan, s):
         # Remove a nickname the list of nicknames we think are in the channel.
-        if s in self.nicklist:
-            self.nicklist.remove(s)
-            ui.set_nicklist(self.nicklist)
+        if (chan.pendingNames is not None):
+            chan.pendingNames.remove(s)
+        added, removed = chan.nicklist.remove(s)
+        self.nicklist_changed(chan, added, removed)
+
+    def nicklist_changed(self, chan, added, removed):
+        # Note a change to a channel's nick-list, to be shown once the current
+        # batch of messages has been handled (see flush_nicklists()). Changes
+        # to the same names cancel out.
+        if (not added and not removed):
+            return
+        pending = self.nickChanges.get(chan)
+        if (pending is None):
+            pending = self.nickChanges[chan] = ({}, {})
+        pendingAdded, pendingRemoved = pending
+        for name in removed:
+            if (name in pendingAdded):
+                del pendingAdded[name]
+            else:
+                pendingRemoved[name] = True
+        for name in added:
+            if (name in pendingRemoved):
+                del pendingRemoved[name]
+            else:
+                pendingAdded[name] = True
+
+    def flush_nicklists(self):
+        # Show the nick-list changes made since the last call, as a single
+        # update per channel.
+        if (self.nickChanges):
+            changes = self.nickChanges
+            self.nickChanges = {}
+            for chan, (added, removed) in changes.items():
+                if (added or removed):
+                    ui.update_nicklist(chan, list(added), list(removed))
+
+    def note_churn(self, chan, kind, nick, detail=""):
+        # Note a user joining ("join", or "rejoin" after a netsplit), leaving
+        # ("part"), or quitting ("quit", or "split" in a netsplit, with the
+        # reason as detail), to be reported in the status buffer at the end of
+        # a short window. A storm of these is reported as a few summary lines.
+        self.churn.setdefault(chan, []).append((kind, nick, detail))
+        if (not self.churnScheduled):
+            self.churnScheduled = True
+            self.run_later(self.churnWindow, self.flush_churn)
+
+    def flush_churn(self, force=False):
+        # Report the joins, parts and quits noted since the last call. Waits
+        # (a while) for the end of any batch still open, unless forced.
+        if (self.batches and not force and self.churnDeferrals < 10):
+            self.churnDeferrals += 1
+            self.run_later(self.churnWindow, self.flush_churn)
+            return
+        self.churnDeferrals = 0
+        self.churnScheduled = False
+        self.flush_nicklists()
+        churn = self.churn
+        self.churn = {}
+        for chan, events in churn.items():
+            self.report_churn(chan, events)
+        if (self.splitNicks):
+            # Forget users who never came back.
+            expired = time.monotonic() - self.splitMemory
+            for key, (when, channels) in list(self.splitNicks.items()):
+                if (when < expired):
+                    del self.splitNicks[key]
+
+    def report_churn(self, chan, events):
+        if (len(events) <= self.churnSummary):
+            for kind, nick, detail in events:
+                if (kind in ("join", "rejoin")):
+                    s = "%s joined the channel" % nick
+                elif (kind == "part"):
+                    s = "%s left the channel" % nick
+                else:
+                    s = "%s quit (%s)" % (nick, detail)
+                ui.add_status_message(s, chan)
+            return
+        groups = collections.OrderedDict()
+        for kind, nick, detail in events:
+            groups.setdefault((kind, detail), []).append(nick)
+        for (kind, detail), nicks in groups.items():
+            n = len(nicks)
+            users = "%d user%s" % (n, "s" if n != 1 else "")
+            if (kind == "rejoin"):
+                s = "%s rejoined after netsplit" % users
+            elif (kind == "join"):
+                s = "%s joined: %s" % (users, summarize_nicks(nicks))
+            elif (kind == "part"):
+                s = "%s left: %s" % (users, summarize_nicks(nicks))
+            elif (kind == "split"):
+                s = "%s lost in netsplit (%s)" % (users, detail)
+            else:
+                s = "%s quit: %s" % (users, summarize_nicks(nicks))
+            ui.add_status_message(s, chan)
+
+    def get_batch(self, msg):
+        # Return the type and parameters of the IRCv3 batch a message is part
+        # of, or None.
+        if (not self.batches):
+            return None
+        return self.batches.get(msg.tags.get("batch"))
 
     def replace_nick(self, old, new):
-        self.del_nick(old)
-        self.add_nick(new)
-        ui.set_nicklist(self.nicklist)
-        ui.add_status_message("%s is now known as %s" % (old, new))
+        # Rename a user in every channel we share with them.
+        renamed = False
+        for chan in self.channels.values():
+            if (chan.pendingNames is not None):
+                chan.pendingNames.rename(old, new)
+            if (old in chan.nicklist):
+                added, removed = chan.nicklist.rename(old, new)
+                self.nicklist_changed(chan, added, removed)
+                ui.add_status_message("%s is now known as %s" % (old, new), chan)
+                renamed = True
+        if (not renamed):
+            ui.add_status_message("%s is now known as %s" % (old, new))
 
-    def request_nicklist(self):
+    def request_nicklist(self, chan):
         # Send a request to the IRC server to give us a list of nicknames
-        # visible in the current channel.
-        if (self.joined):
-            self.send("NAMES %s" % self.channel)
+        # visible in the given channel.
+        self.send("NAMES %s" % chan.name)
 
-    def set_nicklist(self, a):
-        # Replace the list of nicknames with the list given.
-        self.nicklist = a
-        ui.set_nicklist(self.nicklist)
+    def set_nicklist(self, chan, a):
+        # Replace the list of nicknames with the list given, in one update.
+        nicklist = NickList(self.prefixes)
+        for s in a:
+            nicklist.add(s)
+        added, removed = chan.nicklist.replace(nicklist)
+        self.nicklist_changed(chan, added, removed)
+        self.flush_nicklists()
 
     def set_nick(self, s):
         # Change our own nickname.
@@ -175,217 +556,1028 @@ class IRC:
         # Return our own nickname.
         return self.nick
 
-    def get_channel(self):
-        # Return the name of the currently joined channel.
-        if (self.joined):
-            return self.channel
-        else:
-            return "~"
-
     def is_connected(self):
         # Return our IRC server connection state.
         return self.connected
 
-    def handle_ctcp(self, cmd, msg):
+    def handle_ctcp(self, nick, target, cmd, msg):
+        # VERSION and PING requests are answered here only if the fast path
+        # is off (otherwise it has done so already). An ACTION goes to the
+        # buffer of the channel it was sent to, like any other message.
         ui.add_status_message("got CTCP message: " + cmd)
-        if (cmd == "VERSION"):
-            self.send("VERSION pynapple-irc %s" % self.version)
         if (cmd == "ACTION"):
-            ui.add_emote_message(self.nick, msg)
+            chan = self.get_channel(target)
+            if (chan is not None):
+                ui.add_emote_message(nick, msg, chan)
+                self.session.record(self.server, chan.name, nick, msg)
+            else:
+                ui.add_emote_message(nick, "[private] " + msg)
+                self.session.record(self.server, nick, nick, msg)
+        elif (cmd == "VERSION" and self.fastPath is None):
+            self.send("NOTICE %s :\x01VERSION pynapple-irc %s\x01" %
+                      (nick, self.version))
+        elif (cmd == "PING" and self.fastPath is None):
+            self.send("NOTICE %s :\x01PING %s\x01" % (nick, msg))
 
     def get_version(self):
         return self.version
 
-    def logToFile(self, s):
-        # Write the given string to a log file on disk, appending a newline.
-        # The logfile is opened for writing if not already open.
-        if (not self.logEnabled):
-            self.logEnabled = True
-            self.file = open(self.logfile, 'w')
-        self.file.write(s + "\n")
-        self.file.flush()
-
-    def poll(self):
+    def poll(self, timeout=None):
         # Check for incoming messages from the IRC server by polling a shared
         # message-queue populated by the socket handling thread. Strings read
         # from the queue have been buffered from the receiving socket and each
         # string represents a logical message sent by the server.
-        rx = ""
-        try:
-            rx = self.rxQueue.get(True, 0.01)
-        except:
-            pass
-        if (rx != ""):
-            ui.add_debug_message("<- " + rx)
-            self.logToFile(rx)
+        #
+        # Rather than handling a single message per call, everything queued is
+        # drained in one go (up to pollBatchSize messages), logged as a batch,
+        # and then handled until either the count or the time budget for this
+        # call runs out. Anything left over stays pending for the next call.
+        # Returns the number of messages handled; see also get_backlog().
+        if (timeout is None):
+            timeout = self.pollTimeout
+        if (not self.rxPending):
+            self.drain_queue(timeout)
+        else:
+            self.drain_queue(0)
+        handled = 0
+        deadline = time.monotonic() + self.pollBatchTime
+        while (self.rxPending and handled < self.pollBatchSize):
+            arrived, rx = self.rxPending.popleft()
+            self.process(rx, arrived)
+            handled += 1
+            if (time.monotonic() >= deadline):
+                break
+        self.flush_nicklists()
+        self.pollHandled = handled
+        self.check_overload()
+        return handled
+
+    def drain_queue(self, timeout):
+        # Move every message currently waiting in the receive queue (up to the
+        # per-poll budget) in to the pending batch, blocking for at most the
+        # given timeout if nothing is waiting yet. Newly received lines are
+        # shown in the debug window and logged as one batch.
+        batch = []
+        limit = self.pollBatchSize - len(self.rxPending)
+        depth = self.rxQueue.qsize() + len(self.rxPending)
+        if (depth > self.rxMaxDepth):
+            self.rxMaxDepth = depth
+        batch = [item for item in self.rxQueue.take(limit, timeout)
+                 if item[1] != ""]
+        if (batch):
+            self.log_received([rx for arrived, rx in batch])
+            self.rxPending.extend(batch)
+        return len(batch)
+
+    def log_received(self, lines):
+        # Pass a batch of received lines to the logger and the traffic capture
+        # (see TrafficCapture) as a single record.
+        text = "\n".join(lines)
+        self.session.log(self.server, Session.rawLogName, text)
+        self.session.capture_traffic(self.server, RECEIVED, text)
+
+    def receive_lines(self, lines, arrived=None):
+        # Handle a batch of lines as soon as they arrive from the server. Used
+        # by the asyncio engine instead of polling the receive queue.
+        self.log_received(lines)
+        for rx in lines:
+            self.process(rx, arrived)
+        self.flush_nicklists()
+        if (arrived is not None):
+            self.rxLagAt = time.monotonic()
+            self.rxLag = self.rxLagAt - arrived
+        if (self.conn is not None):
+            self.conn.lines_handled(len(lines))
+        self.check_overload()
+        ui.check_lag()
+        if (ui.lagShown and not self.lagRecheck):
+            # Nothing else may come along to notice we've caught up.
+            self.lagRecheck = True
+            self.run_later(1.0, self.recheck_lag)
+
+    def recheck_lag(self):
+        self.lagRecheck = False
+        ui.check_lag()
+
+    def process(self, rx, arrived=None):
+        # Parse and handle one received line. Unless metrics are disabled, the
+        # time it spent waiting since it arrived (a time.monotonic() value),
+        # being parsed, in the handlers, and being drawn, are recorded.
+        metrics = self.session.metrics
+        if (metrics is None):
             self.handle_message(self.parse_message(rx))
+            return
+        histograms = metrics.histograms
+        start = time.monotonic()
+        if (arrived is not None):
+            histograms["queued"].add(start - arrived)
+        msg = self.parse_message(rx)
+        parsed = time.monotonic()
+        drawing = metrics.uiSeconds
+        self.handle_message(msg)
+        drawing = metrics.uiSeconds - drawing
+        histograms["parse"].add(parsed - start)
+        histograms["dispatch"].add(time.monotonic() - parsed - drawing)
+        if (drawing > 0):
+            histograms["ui"].add(drawing)
+
+    def connection_lost(self, conn, exc):
+        # Called by the asyncio engine once a connection has been closed by the
+        # server, or couldn't be established in the first place.
+        if (conn is self.conn):
+            self.conn = None
+            self.connection_closed()
+            if (exc is not None):
+                ui.add_status_message("connection failed: %s" % exc)
+            else:
+                ui.add_status_message("connection closed by server")
+            ui.update_status()
+
+    def get_backlog(self):
+        # Return the number of received messages still waiting to be handled.
+        return len(self.rxPending) + self.rxQueue.qsize()
+
+    def get_lag(self):
+        # Return how far behind the server we are: how long ago the oldest
+        # message still waiting to be handled arrived (with asyncio, how late
+        # the last batch handled was, if that was within the last second).
+        now = time.monotonic()
+        if (self.conn is not None):
+            if (now - self.rxLagAt < 1.0):
+                return self.rxLag
+            return 0.0
+        if (self.rxPending):
+            return now - self.rxPending[0][0]
+        oldest = self.rxQueue.oldest()
+        if (oldest is not None):
+            return now - oldest
+        return 0.0
+
+    def check_overload(self):
+        # Report the lines the receive queue has dropped to keep up, at most
+        # once every shedReportInterval seconds, as a single summary. Once
+        # we've caught up, fetch the nick-lists again if joins etc. were
+        # among them.
+        dropped = self.shedder.take()
+        for command, count in dropped.items():
+            self.shedCounts[command] = self.shedCounts.get(command, 0) + count
+            if (command in self.rxShedCommands):
+                self.resyncPending = True
+        backlog = self.get_backlog()
+        if (self.conn is not None):
+            backlog = self.conn.get_backlog()
+        now = time.monotonic()
+        if (self.shedCounts and (backlog == 0 or
+            now - self.shedReported >= self.shedReportInterval)):
+            self.report_shed()
+            self.shedReported = now
+        if (self.resyncPending and backlog == 0):
+            self.resyncPending = False
+            ui.add_status_message("caught up; fetching nick-lists again")
+            for chan in list(self.channels.values()):
+                self.request_nicklist(chan)
+
+    def report_shed(self):
+        counts = sorted(self.shedCounts.items(), key=lambda x: (-x[1], x[0]))
+        self.shedCounts = {}
+        total = sum(count for command, count in counts)
+        details = ", ".join("%d %s" % (count, command or "blank")
+                            for command, count in counts[:5])
+        if (len(counts) > 5):
+            details += ", ..."
+        ui.add_status_message("falling behind: dropped %d message%s (%s)" %
+                              (total, "s" if total != 1 else "", details))
 
     def parse_message(self, s):
         # Transform incoming message strings received by the IRC server in to
-        # component parts common to all messages.
-        prefix = ''
-        trailing = []
-        if (s[0] == ':'):
-            prefix, s = s[1:].split(' ', 1)
-        if (s.find(' :')) != -1:
-            s, trailing = s.split(' :', 1)
-            args = s.split()
-            args.append(trailing)
-        else:
-            args = s.split()
-        command = args.pop(0)
-        return prefix, command, args
+        # Message records (see pynapple_proto.py).
+        return parse_message(s)
+
+    def register_handler(self, command, handler):
+        # Have handler(msg) called for every incoming message with the given
+        # command or numeric reply, in addition to any existing handlers.
+        self.dispatcher.register(command, handler)
 
     def handle_message(self, msg):
-        # Respond to incoming IRC messages by handling them here or passing
-        # control to other class methods for further processing.
-        prefix, cmd, args = msg
-        if (cmd == "PING"):
-            # Reply to PING, per RFC 1459 otherwise we'll get disconnected.
-            irc.send("PONG %s" % args[0])
-        if (cmd == "PRIVMSG"):
-            # Either a channel message or a private message; check and display.
-            message = ' '.join(args[1:])
-            nick = prefix[:prefix.find('!')]
-            if (args[1].startswith(chr(1))):
-                ctcp = message.translate(None, chr(1)).split()
-                ctcp_cmd = ctcp[0]
-                ctcp_msg = ' '.join(ctcp[1:])
-                self.handle_ctcp(ctcp_cmd, ctcp_msg)
-            elif (args[0] == irc.channel):
-                ui.add_nick_message(nick, message)
-            else:
-                ui.add_private_message(nick, message)
-        if (cmd == "JOIN"):
-            nick = prefix[:prefix.find('!')]
-            if (not self.joined):
-                # We weren't joined, so join message must be us joining.
-                self.joined = True
-                self.channel = args[0]
-                ui.update_status()
-                ui.add_status_message("joined channel %s " % self.channel)
-            elif (nick != self.nick):
-                # A user has joined the channel. Update nick list.
-                irc.add_nick(prefix[:prefix.find('!')])
-                ui.add_status_message("%s joined the channel" % nick)
-        if (cmd == "PART" and args[0] == irc.channel):
-            # A user has left the channel. Update nick list.
-            nick = prefix[:prefix.find('!')]
-            irc.del_nick(nick)
-            ui.add_status_message("%s left the channel" % nick)
-        if (cmd == "353"):
-            # Receiving a list of users in the channel (aka RPL_NAMEREPLY).
-            # Note that the user list may span multiple 353 messages.
-            nicklist = ' '.join(args[3:]).split()
-            irc.set_nicklist(nicklist)
-        if (cmd == "376"):
-            # Finished receiving the message of the day (MOTD).
-            ui.add_status_message("MOTD received, ready for action")
-            ui.update_status()
-        if (cmd == "NICK"):
-            old = prefix[:prefix.find('!')]
-            new = args[0]
-            if (old == self.nick):
-                # server acknowledges we changed our own nick
-                self.nick = new
-            self.replace_nick(old, new)
-            ui.update_status()
+        # Respond to incoming IRC messages by passing them to the handlers
+        # registered for their command.
+        self.dispatcher.dispatch(msg)
+
+    def handle_ping(self, msg):
+        # Reply to PING, per RFC 1459 otherwise we'll get disconnected. (The
+        # fast path, if on, has done so already.)
+        if (self.fastPath is None):
+            self.send("PONG %s" % msg.args[0])
+
+    def handle_privmsg(self, msg):
+        # Either a channel message or a private message; check and display.
+        args = msg.args
+        if (len(args) < 2):
+            return # no text; nothing to show
+        message = ' '.join(args[1:])
+        chan = self.get_channel(args[0])
+        if (args[1].startswith(chr(1))):
+            ctcp = message.strip(chr(1)).split()
+            if (not ctcp):
+                return # an empty CTCP request; ignore it
+            ctcp_cmd = ctcp[0]
+            ctcp_msg = ' '.join(ctcp[1:])
+            self.handle_ctcp(msg.nick, args[0], ctcp_cmd, ctcp_msg)
+        elif (chan is not None):
+            ui.add_nick_message(msg.nick, message, chan)
+            self.session.record(self.server, chan.name, msg.nick, message)
+        else:
+            ui.add_private_message(msg.nick, message)
+            self.session.record(self.server, msg.nick, msg.nick, message)
+
+    def handle_join(self, msg):
+        nick = msg.nick
+        chan = self.get_channel(msg.args[0])
+        if (nick == self.nick and chan is None):
+            # We've joined a channel; give it a buffer and switch to it.
+            chan = Buffer(self, msg.args[0])
+            self.channels[irc_lower(chan.name)] = chan
+            self.session.backfill(chan)
+            self.session.add_buffer(chan)
+            self.session.switch_buffer(chan)
+            ui.add_status_message("joined channel %s " % chan.name, chan)
+        elif (chan is not None and nick != self.nick):
+            # A user has joined the channel. Update nick list.
+            self.add_nick(chan, nick)
+            kind = "join"
+            batch = self.get_batch(msg)
+            key = irc_lower(nick)
+            split = self.splitNicks.get(key)
+            if (split is not None and irc_lower(chan.name) in split[1]):
+                kind = "rejoin"
+                split[1].discard(irc_lower(chan.name))
+                if (not split[1]):
+                    del self.splitNicks[key]
+            elif (batch is not None and batch[0] == "netjoin"):
+                kind = "rejoin"
+            self.note_churn(chan, kind, nick)
+
+    def handle_part(self, msg):
+        # A user has left the channel. Update nick list.
+        nick = msg.nick
+        chan = self.get_channel(msg.args[0])
+        if (chan is not None and nick != self.nick):
+            self.del_nick(chan, nick)
+            self.note_churn(chan, "part", nick)
+
+    def handle_quit(self, msg):
+        # A user has quit IRC; take them out of every channel we share. Quits
+        # caused by a netsplit are told apart by their reason (the names of
+        # the two servers which lost touch), or by being part of a netsplit
+        # batch, and their nicks are remembered so that we can tell they've
+        # come back when they rejoin.
+        nick = msg.nick
+        if (nick == self.nick):
+            return
+        reason = ""
+        if (msg.args):
+            reason = msg.args[0]
+        kind = "quit"
+        batch = self.get_batch(msg)
+        if (batch is not None and batch[0] == "netsplit"):
+            kind = "split"
+            reason = " ".join(batch[1]) or reason
+        elif (netsplitReason.match(reason)):
+            kind = "split"
+        channels = set()
+        for key, chan in list(self.channels.items()):
+            if (nick in chan.nicklist or (chan.pendingNames is not None and
+                                          nick in chan.pendingNames)):
+                self.del_nick(chan, nick)
+                self.note_churn(chan, kind, nick, reason)
+                channels.add(key)
+        if (kind == "split" and channels):
+            self.splitNicks[irc_lower(nick)] = (time.monotonic(), channels)
+
+    def handle_cap(self, msg):
+        # The server's answer to our capability request (see login()), after
+        # which we can let it finish logging us in.
+        if (len(msg.args) >= 3 and msg.args[1] in ("ACK", "NAK")):
+            if (msg.args[1] == "ACK"):
+                self.enabledCaps.update(msg.args[2].split())
+            self.send("CAP END")
+
+    def handle_batch(self, msg):
+        # The start ("+reference type params...") or end ("-reference") of an
+        # IRCv3 batch of related messages. Joins and quits are reported as
+        # soon as a netsplit or netjoin batch ends.
+        if (not msg.args or len(msg.args[0]) < 2):
+            return
+        ref = msg.args[0]
+        if (ref[0] == "+"):
+            kind = ""
+            if (len(msg.args) > 1):
+                kind = msg.args[1].lower()
+            self.batches[ref[1:]] = (kind, msg.args[2:])
+        elif (ref[0] == "-"):
+            batch = self.batches.pop(ref[1:], None)
+            if (batch is not None and batch[0] in ("netsplit", "netjoin") and
+                    not self.batches):
+                self.flush_churn()
+
+    def handle_namreply(self, msg):
+        # Receiving a list of users in the channel (aka RPL_NAMEREPLY).
+        # Note that the user list may span multiple 353 messages, so names are
+        # collected until the end of the list (366) is received.
+        chan = self.get_channel(msg.args[2])
+        if (chan is not None):
+            if (chan.pendingNames is None):
+                chan.pendingNames = NickList(self.prefixes)
+            for s in ' '.join(msg.args[3:]).split():
+                chan.pendingNames.add(s)
+
+    def handle_endofnames(self, msg):
+        # The list of users in the channel is complete (RPL_ENDOFNAMES), so
+        # replace the nick-list with it in one go.
+        chan = self.get_channel(msg.args[1])
+        if (chan is not None and chan.pendingNames is not None):
+            added, removed = chan.nicklist.replace(chan.pendingNames)
+            chan.pendingNames = None
+            self.nicklist_changed(chan, added, removed)
+
+    def handle_isupport(self, msg):
+        # The server tells us about its features (RPL_ISUPPORT). We want to
+        # know which channel modes give users a status, and which prefixes
+        # show them, e.g. PREFIX=(ov)@+
+        for token in msg.args[1:-1]:
+            name, sep, value = token.partition("=")
+            if (name == "PREFIX" and value.startswith("(") and ")" in value):
+                modes, prefixes = value[1:].split(")", 1)
+                if (len(modes) == len(prefixes)):
+                    self.prefixModes = modes
+                    self.prefixes = prefixes
+            elif (name == "CHANMODES" and value.count(",") >= 2):
+                self.chanModes = tuple(value.split(",")[:3])
+
+    def handle_mode(self, msg):
+        # Channel mode changes may give or take away a user's status.
+        chan = self.get_channel(msg.args[0])
+        if (chan is None or len(msg.args) < 2):
+            return
+        params = msg.args[2:]
+        on = True
+        for c in msg.args[1]:
+            if (c == "+" or c == "-"):
+                on = (c == "+")
+            elif (c in self.prefixModes):
+                if (params):
+                    prefix = self.prefixes[self.prefixModes.find(c)]
+                    added, removed = chan.nicklist.set_modes(params.pop(0),
+                                                             prefix, on)
+                    self.nicklist_changed(chan, added, removed)
+            elif (c in self.chanModes[0] or c in self.chanModes[1] or
+                  (on and c in self.chanModes[2])):
+                if (params):
+                    params.pop(0)
+
+    def handle_endofmotd(self, msg):
+        # Finished receiving the message of the day (MOTD).
+        ui.add_status_message("MOTD received, ready for action")
+        ui.update_status()
+        for channel in self.autoJoin:
+            self.join(channel)
+
+    def handle_nick(self, msg):
+        old = msg.nick
+        new = msg.args[0]
+        if (old == self.nick):
+            # server acknowledges we changed our own nick
+            self.nick = new
+            self.shedder.nick = new
+        self.replace_nick(old, new)
+        ui.update_status()
+
+# A quit reason naming two servers, as given to users lost in a netsplit.
+netsplitReason = re.compile(r"^[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+$")
+
+def summarize_nicks(nicks, limit=10):
+    # Return the first few of a list of nicks, and how many more there are.
+    s = ", ".join(nicks[:limit])
+    if (len(nicks) > limit):
+        s += " and %d more" % (len(nicks) - limit)
+    return s
+
+class Session:
+    # The set of server connections and buffers (channels, plus a status
+    # buffer) in use. Connections are indexed by "server:port", and the user
+    # interface shows one buffer at a time. Commands entered by the user apply
+    # to the current buffer's connection, or while the status buffer is shown,
+    # to the connection used most recently.
+    netEngine = "thread"         # "thread" (SocketThread) or "asyncio"
+    logDirectory = "logs"        # where the per-network logs are written
+    logRaw = True                # log all traffic received from servers
+    logChat = True               # log the messages shown in each channel
+    logCloseTimeout = 5.0        # seconds to wait for the logs on /quit
+    rawLogName = "~raw"          # log name for received traffic
+    historyEnabled = True        # keep a searchable history of messages
+    historyDirectory = "history" # where the searchable history is kept
+    historyWordIndex = True      # index every word, for a faster /search
+    historyBackfill = 20         # messages of history shown on joining
+    searchLimit = 20             # results shown by /search
+    metricsEnabled = True        # time every received message (see /stats)
+    statsFile = None             # file to append a snapshot of /stats to
+    statsInterval = 60.0         # seconds between snapshots
+    captureSize = 1 << 20        # characters of traffic kept for /debug
+
+    def __init__(self):
+        self.connections = {}
+        self.status = Buffer(None, "~")
+        self.buffers = [self.status]
+        self.current = self.status
+        self.active = None       # connection that commands apply to
+        self.rxEvent = WakeupPipe() # set by socket threads on new data
+        self.callbacks = collections.deque() # see call_soon()
+        self.addressCache = AddressCache()
+        self.logger = Logger(self.logDirectory)
+        self.capture = TrafficCapture(self.captureSize)
+        self.histories = {}      # network -> History
+        self.metrics = None
+        if (self.metricsEnabled):
+            self.metrics = Metrics()
+        self.statsWriter = None
+        if (self.statsFile):
+            self.statsWriter = StatsWriter(self.statsFile, self.statsInterval,
+                                           self.get_stats)
+            self.statsWriter.start()
+
+    def get_engine(self):
+        # Return the AsyncEngine servicing our connections, or None if we're
+        # using the threaded engine (SocketThreads polled through poll()).
+        if (self.netEngine == "asyncio"):
+            return get_default_engine()
+        return None
+
+    def get_connection(self):
+        # Return the connection that user commands currently apply to.
+        if (self.current.conn is not None):
+            return self.current.conn
+        return self.active
+
+    def connect(self, server, port):
+        # Open a new connection to the given server, unless we already have one.
+        key = "%s:%d" % (server, port)
+        conn = self.connections.get(key)
+        if (conn is None):
+            conn = IRC(self)
+            self.connections[key] = conn
+        self.active = conn
+        conn.connect(server, port)
+
+    def remove_connection(self, conn):
+        key = "%s:%d" % (conn.server, conn.port)
+        if (self.connections.get(key) is conn):
+            del self.connections[key]
+        if (self.active is conn):
+            self.active = None
+            if (self.connections):
+                self.active = next(iter(self.connections.values()))
+
+    def disconnect(self):
+        # Disconnect from the server that commands currently apply to.
+        conn = self.get_connection()
+        if (conn is None):
+            ui.add_status_message("not connected")
+        else:
+            for chan in list(conn.channels.values()):
+                conn.part(chan)
+            conn.disconnect()
+
+    def quit(self):
+        # Disconnect from every server.
+        for conn in list(self.connections.values()):
+            for chan in list(conn.channels.values()):
+                conn.part(chan)
+            conn.disconnect()
+
+    def join(self, channel):
+        conn = self.get_connection()
+        if (conn is None):
+            ui.add_status_message("not connected")
+        else:
+            conn.join(channel)
+
+    def part(self):
+        # Leave the channel shown in the current buffer.
+        if (self.current.is_channel()):
+            self.current.conn.part(self.current)
+        else:
+            ui.add_status_message("not in a channel")
+
+    def send_message(self, s):
+        # Send a message to the channel shown in the current buffer.
+        if (self.current.is_channel()):
+            self.current.conn.send_message(self.current, s)
+        else:
+            ui.add_status_message("not in a channel")
+
+    def send_private_message(self, nick, s):
+        conn = self.get_connection()
+        if (conn is None):
+            ui.add_status_message("not connected")
+        else:
+            conn.send_private_message(nick, s)
+
+    def set_nick(self, s):
+        conn = self.get_connection()
+        if (conn is not None):
+            conn.set_nick(s)
+
+    def request_nicklist(self):
+        if (self.current.is_channel()):
+            self.current.conn.request_nicklist(self.current)
+
+    def add_buffer(self, buf):
+        self.buffers.append(buf)
+
+    def remove_buffer(self, buf):
+        if (buf in self.buffers):
+            self.buffers.remove(buf)
+        if (self.current is buf):
+            self.switch_buffer(self.status)
+
+    def switch_buffer(self, buf):
+        # Show the given buffer in the user interface.
+        self.current = buf
+        if (buf.conn is not None):
+            self.active = buf.conn
+        buf.unread = 0
+        ui.show_buffer(buf)
+
+    def find_buffer(self, s):
+        # Look up a buffer by its number (as listed by /buffers) or its name,
+        # preferring channels on the connection currently in use.
+        if (s.isdigit()):
+            n = int(s) - 1
+            if (0 <= n < len(self.buffers)):
+                return self.buffers[n]
+            return None
+        if (s == self.status.name):
+            return self.status
+        conn = self.get_connection()
+        if (conn is not None and conn.get_channel(s) is not None):
+            return conn.get_channel(s)
+        for conn in self.connections.values():
+            if (conn.get_channel(s) is not None):
+                return conn.get_channel(s)
+        return None
+
+    def get_nick(self):
+        # Return our own nickname on the connection in use.
+        conn = self.get_connection()
+        if (conn is None):
+            return IRC.nick
+        return conn.get_nick()
+
+    def get_channel(self):
+        # Return the name of the channel shown in the current buffer.
+        if (self.current.is_channel()):
+            return self.current.name
+        else:
+            return "~"
+
+    def get_status(self):
+        conn = self.get_connection()
+        server = ""
+        if (conn is not None):
+            server = conn.server
+        channel = ""
+        if (self.current.is_channel()):
+            channel = self.current.name
+        return (self.get_nick(), server, channel, self.current.topic)
+
+    def get_version(self):
+        return IRC.version
+
+    def poll(self, timeout=None):
+        # Handle messages received on any of our connections (threaded engine
+        # only), waiting up to the given timeout for some to arrive. Returns
+        # the number of messages handled.
+        if (timeout is None):
+            timeout = IRC.pollTimeout
+        if (self.get_backlog() == 0 and timeout > 0):
+            self.rxEvent.wait(timeout)
+        self.rxEvent.clear()
+        while (self.callbacks):
+            f, args = self.callbacks.popleft()
+            f(*args)
+        handled = 0
+        for conn in list(self.connections.values()):
+            handled += conn.poll(0)
+        ui.check_lag()
+        return handled
+
+    def call_soon(self, f, *args):
+        # Have f(*args) called on the UI thread, the next time we poll.
+        # Safe to call from any thread (threaded engine only).
+        self.callbacks.append((f, args))
+        self.rxEvent.set()
+
+    def get_wakeup(self):
+        # Return the WakeupPipe set whenever a socket thread has received new
+        # messages, for the UI to wait on (threaded engine only).
+        return self.rxEvent
+
+    def get_backlog(self):
+        # Return the number of received messages still waiting to be handled.
+        return sum(conn.get_backlog() for conn in self.connections.values())
+
+    def get_lag(self):
+        # Return how far behind the most lagging connection we are, in seconds.
+        return max([conn.get_lag() for conn in self.connections.values()] +
+                   [0.0])
+
+    def log(self, network, name, s):
+        # Log a line of text (or several, separated by newlines) to the file
+        # for the given network and channel. Writing happens in the background.
+        if (name == self.rawLogName):
+            if (self.logRaw):
+                self.logger.log(network, name, s)
+        elif (self.logChat):
+            self.logger.log(network, name, s)
+
+    def capture_traffic(self, server, direction, text):
+        # Keep some traffic sent to (SENT) or received from (RECEIVED) a
+        # server for the debug view, only showing it right away if the view
+        # is open.
+        self.capture.add(server, direction, text)
+        if (ui is not None and ui.debugShown):
+            ui.add_debug_traffic(direction, text)
+
+    def set_debug_shown(self, shown):
+        # Called by the UI backend when its debug view is opened or closed.
+        if (ui is not None):
+            ui.set_debug_shown(shown)
+
+    def refresh_debug(self):
+        # Called by the UI backend to have its debug view filled again, e.g.
+        # after recreating it.
+        if (ui is not None):
+            ui.refresh_debug()
+
+    def set_debug_filter(self, directions=None, commands=False, excluded=None):
+        # Change the parts of the debug view's filter given (see
+        # TrafficCapture.set_filter(); commands=None shows every command).
+        capture = self.capture
+        if (directions is None):
+            directions = capture.directions
+        if (commands is False):
+            commands = capture.commands
+        if (excluded is None):
+            excluded = capture.excluded
+        capture.set_filter(directions, commands, excluded)
+        ui.refresh_debug()
+        ui.add_status_message("debug view: " + capture.describe_filter())
+
+    def dump_capture(self, path=None):
+        # Write the captured traffic passing the debug view's filter to a file
+        # (by default a new one in the log directory).
+        if (path is None):
+            path = os.path.join(self.logDirectory, datetime.now().strftime(
+                                "debug-%Y%m%d-%H%M%S.log"))
+        try:
+            directory = os.path.dirname(path)
+            if (directory):
+                os.makedirs(directory, exist_ok=True)
+            count = self.capture.dump(path)
+        except OSError as e:
+            ui.add_status_message("can't write %s: %s" % (path, e.strerror))
+            return
+        ui.add_status_message("%d lines written to %s" % (count, path))
+
+    def close_log(self):
+        # Write out everything still waiting to be logged before we exit.
+        if (self.statsWriter is not None):
+            self.statsWriter.stop()
+        for history in self.histories.values():
+            history.close()
+        if (not self.logger.close(self.logCloseTimeout)):
+            print("pynapple: %d log records could not be written" %
+                  self.logger.get_queued())
+
+    def get_history(self, network):
+        # Return the message history of the given network, opening it first if
+        # necessary, or None if the history is off. If it can't be opened, the
+        # history is turned off for the rest of the session.
+        history = self.histories.get(network)
+        if (history is None):
+            if (not self.historyEnabled):
+                return None
+            name = network.replace(os.sep, "_") or "_"
+            path = os.path.join(self.historyDirectory, name)
+            try:
+                history = History(path, self.historyWordIndex)
+            except OSError as e:
+                self.historyEnabled = False
+                ui.add_status_message("can't open the history in %s: %s; "
+                                      "history turned off" % (path, e.strerror))
+                return None
+            self.histories[network] = history
+        return history
+
+    def record(self, network, channel, nick, s):
+        # Add a message sent to a channel (or, if channel is a nick, a private
+        # message) to the network's history.
+        if (self.historyEnabled):
+            history = self.get_history(network)
+            if (history is not None):
+                history.add(channel, nick, s)
+
+    def backfill(self, buf):
+        # Fill a newly opened buffer with the last messages we saw in it.
+        if (self.historyEnabled and self.historyBackfill > 0):
+            history = self.get_history(buf.conn.server)
+            if (history is None):
+                return
+            records = history.recent(buf.name, self.historyBackfill)
+            if (records):
+                ui.add_history(records, buf)
+
+    def search(self, s):
+        # Search the history of the current connection's network for messages
+        # containing all the given words, optionally in a given channel.
+        conn = self.get_connection()
+        if (conn is None):
+            ui.add_status_message("not connected")
+            return
+        terms = s.split()
+        channel = None
+        if (terms and terms[0][0] in "#&+!"):
+            channel = terms.pop(0)
+        if (not terms):
+            ui.add_status_message("usage: /search [channel] <words>")
+            return
+        history = self.get_history(conn.server)
+        if (history is None):
+            ui.add_status_message("the history is turned off")
+            return
+        start = time.perf_counter()
+        try:
+            records = history.search(terms, channel, limit=self.searchLimit)
+        except OSError as e:
+            ui.add_status_message("can't search the history: " + e.strerror)
+            return
+        elapsed = (time.perf_counter() - start) * 1000
+        ui.add_history(records)
+        ui.add_status_message("%d results for \"%s\" (%.1f ms)" %
+                              (len(records), " ".join(terms), elapsed))
+
+    def get_stats(self):
+        # Return a snapshot of everything we measure, as a dictionary (see
+        # show_stats()). Also called from the StatsWriter thread.
+        stats = {"connections": [conn.get_stats() for conn in
+                                 list(self.connections.values())],
+                 "log": self.logger.get_stats(),
+                 "capture": self.capture.get_stats(), "ui": {}}
+        if (self.metrics is not None):
+            stats["metrics"] = self.metrics.get_stats()
+        if (ui is not None):
+            stats["ui"] = ui.get_stats()
+        return stats
+
+    def show_stats(self):
+        # Print a summary of the metrics in the status buffer.
+        for conn in list(self.connections.values()):
+            stats = conn.get_stats()
+            ui.add_status_message("%s: received %d bytes, %d lines; %d waiting "
+                                  "(at most %d)" % (conn.server,
+                                  stats["bytesReceived"],
+                                  stats["linesReceived"], stats["rxQueue"],
+                                  stats["rxMaxDepth"]))
+            receive = stats["receive"]
+            ui.add_status_message("  receive queue: %d lines at most, %d "
+                                  "dropped, reading paused %d times for %.1f "
+                                  "s, %.1f s behind" % (receive["capacity"],
+                                  stats["shed"], receive["pauses"],
+                                  receive["pausedSeconds"], stats["lag"]))
+            send = stats["send"]
+            if (send):
+                ui.add_status_message("  send queue: %d waiting (at most %d), "
+                                      "%d sent, %d throttled, latency avg "
+                                      "%.1f max %.1f ms" % (send["depth"],
+                                      send["maxDepth"], send["sent"],
+                                      send["throttled"],
+                                      send["latencyAverage"] * 1000,
+                                      send["latencyMax"] * 1000))
+            fast = stats.get("fastPath")
+            if (fast):
+                ui.add_status_message("  fast path: %d PONGs, %d CTCP replies "
+                                      "(%d ignored), latency avg %.3f max "
+                                      "%.3f ms" % (fast["pongs"],
+                                      fast["ctcpReplies"], fast["ctcpIgnored"],
+                                      fast["latency"]["average"] * 1000,
+                                      fast["latency"]["max"] * 1000))
+            for name, count in sorted(stats["nicks"].items()):
+                ui.add_status_message("  %s: %d nicks" % (name, count))
+        if (self.metrics is not None):
+            for name in self.metrics.names:
+                ui.add_status_message("%s: %s" % (name,
+                                      self.metrics.histograms[name].summary()))
+        log = self.logger.get_stats()
+        ui.add_status_message("log: %d waiting, %d written, %d dropped" %
+                              (log["pending"], log["written"], log["dropped"]))
+        capture = self.capture.get_stats()
+        ui.add_status_message("capture: %d records, %d of %d characters, %d "
+                              "dropped" % (capture["records"], capture["size"],
+                              capture["capacity"], capture["dropped"]))
+        for name, value in sorted(ui.get_stats().items()):
+            ui.add_status_message("ui %s: %s" % (name, value))
 
 class SocketThread(threading.Thread):
     # A worker thread used to receive data from the connected IRC server. Once
     # started, sits in a loop reading data and assembling line-based messages
     # from the server. This thread terminates after a shared status flag is set
-    # by the main thread in response to a disconnect command.
+    # by the main thread in response to a disconnect command, or once the
+    # server closes the connection (or it fails), in which case onLost(exc)
+    # is called first, with the error if there was one.
     running = True
-    def __init__(self, event, rxQueue, server, port, sock):
+    def __init__(self, event, rxQueue, server, port, sock, framer=None,
+                 notify=None, fastPath=None, onLost=None):
         super(SocketThread, self).__init__()
         self.stopThreadRequest = event
         self.rxQueue = rxQueue
+        self.notify = notify # called after new messages have been queued
+        self.fastPath = fastPath # answers PINGs before the UI sees them
+        self.onLost = onLost
         self.server = server
         self.port = port
         self.sock = sock
+        if (framer is None):
+            framer = LineFramer()
+        self.framer = framer
 
     def run(self):
         # Continuously read from our (blocking) socket. We want to add complete
         # messages from the IRC server to our queue to be handled downstream, but
-        # since the network buffer may contain only part of a message, we'll use
-        # a local buffer to store incomplete messages.
-        rx = ""
+        # since the network buffer may contain only part of a message, the line
+        # framer keeps incomplete messages around until the rest arrives.
         while(not self.stopThreadRequest.isSet()):
-            rx = rx + self.sock.recv(1024).decode("utf-8")
-            if (rx != ""):
-                temp = rx.split("\n")
-                rx = temp.pop( ) # put left-over data back in our local buffer
-                for line in temp:
-                    line = line.rstrip()
-                    self.rxQueue.put(line)
+            error = None
+            try:
+                n = self.framer.fill(self.sock)
+            except OSError as e:
+                error = e
+                n = 0
+            if (n > 0):
+                lines = self.framer.lines()
+                arrived = time.monotonic()
+                if (lines):
+                    if (self.fastPath is not None):
+                        self.fastPath.scan(lines, arrived)
+                    # Blocks while the receive queue is full (see
+                    # ReceiveQueue), leaving the rest to TCP flow control.
+                    self.rxQueue.put(lines, arrived, self.stopThreadRequest)
+                    if (self.notify is not None):
+                        self.notify()
             else:
                 # remote end disconnected, so commit thread suicide!
+                if (not self.stopThreadRequest.is_set() and
+                    self.onLost is not None):
+                    self.onLost(error)
                 self.stopThreadRequest.set()
         return
 
 class UserInterface:
-    # Uses the curses terminal handling library to display a chat log,
-    # a list of users in the current channel, and a command prompt for
-    # entering messages and application commands.
+    # Uses one of the user interface backends (Tk, curses, or none at all) to
+    # display a chat log, a list of users in the current channel, and a
+    # command prompt for entering messages and application commands.
     badwords = []
     hilites = []
-    def __init__(self):
-        self.badwords = self.load_list("badwords.txt")
-        self.hilites = self.load_list("hilites.txt")
-        self.uiPlugin = UserInterfacePlugin(irc, kb)
+    badwordsFile = "badwords.txt"
+    hilitesFile = "hilites.txt"
+    wholeWords = False      # only censor/highlight whole words
+    ignoreCase = False      # censor/highlight regardless of case
+    listCheckInterval = 1.0 # seconds between checks for changed list files
+    debugLines = 1000       # captured lines shown on opening the debug view
+    lagThreshold = 1.0      # seconds behind the server before showing the lag
+    def __init__(self, backend=defaultBackend):
+        self.debugShown = False
+        self.lagShown = 0.0
+        self.matcher = None
+        self.matcherNick = None
+        self.listTimes = None
+        self.listChecked = 0
+        self.update_matcher()
+        self.uiPlugin = load_backend(backend)(session, kb)
+        self.uiPlugin.set_scrollback(session.current.lines)
         self.colors = self.uiPlugin.get_max_colors()
         self.draw_pineapple()
-        self.add_status_message("welcome to pynapple-irc v" + irc.get_version())
+        self.add_status_message("welcome to pynapple-irc v" + session.get_version())
         self.add_status_message("type /help for a list of commands")
 
     def run(self):
         self.uiPlugin.run()
 
-    def add_message(self, s, color, hilite):
-        msgtxt = self.censor(s)
-        msg = self.time_stamp() + " " + msgtxt
-        self.uiPlugin.add_message(msg, color, hilite)
+    def add_message(self, s, color, hilite, buf=None):
+        # Add a message to the given buffer (by default the current one). The
+        # message is only drawn if that buffer is the one being shown.
+        self.add_line(self.censor(s), color, hilite, buf)
 
-    def add_nick_message(self, nick, s):
+    def add_line(self, s, color, hilite, buf=None, log=True):
+        # Add an already censored message to the given buffer.
+        if (buf is None):
+            buf = session.current
+        msg = self.time_stamp() + " " + s
+        if (log and buf.conn is not None):
+            session.log(buf.conn.server, buf.name,
+                        datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ") + s)
+        buf.lines.append((msg, color, hilite))
+        if (buf is session.current):
+            if (session.metrics is not None):
+                start = time.monotonic()
+                self.uiPlugin.add_message(msg, color, hilite)
+                session.metrics.uiSeconds += time.monotonic() - start
+            else:
+                self.uiPlugin.add_message(msg, color, hilite)
+        else:
+            buf.unread += 1
+
+    def add_nick_message(self, nick, s, buf=None):
         # Add another user's message in the chat window.
-        color = self.get_nick_color(nick)
-        hilite = False
-        if (nick != irc.get_nick()):
-            hilite = self.hilite(s)
-        self.add_message("<" + nick + "> " + s, color, hilite)
+        self.add_user_message(nick, "<" + nick + "> ", s, buf)
 
-    def add_emote_message(self, nick, s):
+    def add_emote_message(self, nick, s, buf=None):
         # Add another user's "emoted" message in the chat window.
-        color = self.get_nick_color(nick)
-        if (nick != irc.get_nick()):
-            hilite = self.hilite(s)
-        self.add_message("* " + nick + " " + s, color, hilite)
+        self.add_user_message(nick, "* " + nick + " ", s, buf)
+
+    def add_user_message(self, nick, prefix, s, buf=None):
+        # Censor a user's message and check it for highlights in one go. Only
+        # the text itself is checked for highlights (not the nick in front of
+        # it), and never in our own messages.
+        hiliteFrom = len(prefix)
+        if (nick == session.get_nick()):
+            hiliteFrom = -1
+        msg, hilite = self.get_matcher().process(prefix + s, hiliteFrom)
+        self.add_line(msg, self.get_nick_color(nick), hilite, buf)
 
     def add_private_message(self, nick, s):
         # Add another user's private message in the chat window.
         self.add_nick_message(nick, "[private] " + s)
 
-    def add_status_message(self, s):
+    def add_status_message(self, s, buf=None):
         # Add a status message in the chat window.
-        self.add_message("== " + s, 7, False)
+        self.add_message("== " + s, 7, False, buf)
+
+    def add_history(self, records, buf=None):
+        # Add messages read back from the history, with the date and channel
+        # they were seen in. These aren't logged again.
+        for record in records:
+            stamp = datetime.fromtimestamp(record.time).strftime("%Y-%m-%d %H:%M")
+            s = "%s %s <%s> %s" % (stamp, record.channel, record.nick,
+                                   record.text)
+            self.add_line(self.censor(s), 7, False, buf, False)
+
+    def show_buffer(self, buf):
+        # Replace the contents of the chat window and nick-list with those of
+        # the given buffer.
+        self.uiPlugin.set_scrollback(buf.lines)
+        self.set_nicklist(buf)
+        self.update_status()
 
     def add_debug_message(self, s):
         self.uiPlugin.add_debug_message(s)
 
+    def add_debug_traffic(self, direction, text):
+        # Show captured traffic (one or more lines) in the open debug view, if
+        # it passes the filter.
+        for line in session.capture.select(direction, text):
+            self.uiPlugin.add_debug_message(direction + " " + line)
+
+    def set_debug_shown(self, shown):
+        # The debug view has been opened or closed. Traffic is only drawn while
+        # it is open, so on opening, it is filled from the capture.
+        if (shown != self.debugShown):
+            self.debugShown = shown
+            self.refresh_debug()
+
+    def refresh_debug(self):
+        # Redraw the debug view from the capture, if it is open.
+        if (self.debugShown):
+            self.uiPlugin.set_debug_lines(session.capture.last_lines(
+                                          self.debugLines))
+
     def hilite(self, s):
         # Return an true if the given word matches our highlight list.
         # The attribute is combined with any other attributes (e.g. colors)
         # when printing string. It is typical for IRC clients to highlight
         # incoming messages containing our own nick.
-        if any(w in s for w in self.hilites + [irc.get_nick()]):
-            return True
-        else:
-            return False
+        return self.get_matcher().process(s)[1]
 
-    def set_nicklist(self, a):
-        # Populate the nick-list with an alphabetically sorted array of nicks.
-        self.uiPlugin.set_nicklist(a)
+    def set_nicklist(self, buf):
+        # Populate the nick-list with the given buffer's sorted array of nicks,
+        # if that buffer is the one being shown.
+        if (buf is session.current):
+            self.uiPlugin.set_nicklist(buf.nicklist.names())
+
+    def update_nicklist(self, buf, added, removed):
+        # Tell the UI about users added to or removed from a buffer's nick-list,
+        # if that buffer is the one being shown.
+        if (buf is session.current and (added or removed)):
+            self.uiPlugin.update_nicklist(buf.nicklist, added, removed)
 
     def init_colors(self):
         self.uiPlugin.init_colors()
@@ -400,9 +1592,31 @@ class UserInterface:
     def shutdown(self):
         self.uiPlugin.shutdown()
 
+    def get_stats(self):
+        # Return whatever the backend measures about its drawing and wakeups.
+        stats = {}
+        if (hasattr(self.uiPlugin, "get_wakeup_stats")):
+            stats.update(self.uiPlugin.get_wakeup_stats())
+        if (hasattr(self.uiPlugin, "get_refresh_stats")):
+            refreshes, skipped = self.uiPlugin.get_refresh_stats()
+            stats["refreshes"] = refreshes
+            stats["skippedRefreshes"] = skipped
+        return stats
+
     def toggle_debug(self):
         self.uiPlugin.toggle_debug()
 
+    def check_lag(self):
+        # Show how far behind the server the display is, to a tenth of a
+        # second, once that's over lagThreshold seconds (or hide it again).
+        lag = session.get_lag()
+        if (lag < self.lagThreshold):
+            lag = 0.0
+        lag = round(lag, 1)
+        if (lag != self.lagShown):
+            self.lagShown = lag
+            self.uiPlugin.set_lag(lag)
+
     def draw_pineapple(self):
         # Draw a sweet ASCII art rendition of a pinapple. Come to think of it,
         # it has been getting increasingly difficult to type the word pinapple
@@ -430,9 +1644,44 @@ class UserInterface:
 
     def censor(self, s):
         # Replace bad words with an equal length string of asterisks
-        for tag in self.badwords:
-            s = s.replace(tag, "*" * len(tag))
-        return s
+        return self.get_matcher().censor(s)
+
+    def get_matcher(self):
+        # Return the matcher used to censor and highlight messages, rebuilding
+        # it first if our nick or the word lists have changed since it was
+        # built. The list files are only looked at every listCheckInterval
+        # seconds, as this is called for every message.
+        now = time.time()
+        if (now - self.listChecked >= self.listCheckInterval):
+            self.listChecked = now
+            if (self.list_times() != self.listTimes):
+                self.update_matcher()
+        if (session.get_nick() != self.matcherNick):
+            self.update_matcher(False)
+        return self.matcher
+
+    def list_times(self):
+        # Return the modification times of the word list files (None for a
+        # missing file).
+        times = []
+        for name in (self.badwordsFile, self.hilitesFile):
+            try:
+                times.append(os.stat(name).st_mtime)
+            except OSError:
+                times.append(None)
+        return times
+
+    def update_matcher(self, reload=True):
+        # (Re)compile the matcher from the word lists and our current nick,
+        # re-reading the lists first unless told otherwise.
+        if (reload):
+            self.listTimes = self.list_times()
+            self.badwords = self.load_list(self.badwordsFile)
+            self.hilites = self.load_list(self.hilitesFile)
+        self.matcherNick = session.get_nick()
+        self.matcher = Matcher(self.badwords,
+                               self.hilites + [self.matcherNick],
+                               self.wholeWords, self.ignoreCase)
 
     def update_status(self):
         self.uiPlugin.update_status()
@@ -452,7 +1701,7 @@ class KeyboardHandler:
                 self.handle_cmd(s[1:])
         else:
             # otherwise send input as a channel message
-            irc.send_message(s)
+            session.send_message(s)
 
     def handle_cmd(self, s):
         # Respond to a command string intended to be processed locally.
@@ -460,46 +1709,63 @@ class KeyboardHandler:
         args = s.split()[1:]
         if (cmd == "connect"):
             # Connect to the given IRC server.
-            if (len(args) == 1) and (args[0].count(":") == 1):
-                server, port = args[0].split(':')
+            if (len(args) == 1) and (":" in args[0]):
+                server, sep, port = args[0].rpartition(":")
+                if (server.startswith("[") and server.endswith("]")):
+                    server = server[1:-1] # an IPv6 address
                 if port.isdigit():
-                    ui.add_status_message("connecting to " + server + ":" + port)
-                    irc.connect(server, int(port))
+                    session.connect(server, int(port))
                 else:
                     ui.add_status_message("port must be specified as an integer")
             else:
                 ui.add_status_message("usage: connect <server:port>")
         elif (cmd == "disconnect"):
             # Disconnect from the current IRC server.
-            irc.part()
-            irc.disconnect()
+            session.disconnect()
         elif (cmd == "join"):
             # Join the given channel.
             if (len(args) < 1):
                 ui.add_status_message("usage: join <channel>")
             else:
-                irc.join(args[0])
+                session.join(args[0])
         elif (cmd == "part"):
             # Leave the current channel.
-            irc.part()
+            session.part()
         elif (cmd == "msg"):
             # Send a private message to the given user.
             if (len(args) < 2):
                 ui.add_status_message("usage: msg <nick> <message>")
             else:
                 msg = ' '.join(args[1:])
-                irc.send_private_message(args[0], msg)
+                session.send_private_message(args[0], msg)
         elif (cmd == "nick"):
             if (len(args) < 1):
                 ui.add_status_message("usage: nick <new nick>")
             else:
-                irc.set_nick(args[0])
+                session.set_nick(args[0])
         elif (cmd == "debug"):
-            # Show or hide the debug window.
-            ui.toggle_debug()
+            # Show or hide the debug window, or filter or dump its traffic.
+            if (len(args) == 0):
+                ui.toggle_debug()
+            elif (args[0] in ("in", "out", "both")):
+                directions = {"in": (RECEIVED,), "out": (SENT,),
+                              "both": (SENT, RECEIVED)}[args[0]]
+                session.set_debug_filter(directions=directions)
+            elif (args[0] == "only"):
+                session.set_debug_filter(commands=args[1:] or None)
+            elif (args[0] == "hide"):
+                session.set_debug_filter(excluded=args[1:])
+            elif (args[0] == "all"):
+                session.set_debug_filter((SENT, RECEIVED), None, ())
+            elif (args[0] == "dump" and len(args) <= 2):
+                session.dump_capture(*args[1:])
+            else:
+                ui.add_status_message("usage: debug [in|out|both|all|"
+                                      "only <commands>|hide <commands>|"
+                                      "dump [file]]")
         elif (cmd == "names"):
             # Ask server for a list of nicks in the channel. TODO: Remove this.
-            irc.request_nicklist()
+            session.request_nicklist()
         elif (cmd == "help"):
             # Print a list of commands.
             ui.add_status_message("available commands:")
@@ -509,26 +1775,106 @@ class KeyboardHandler:
             ui.add_status_message("/part")
             ui.add_status_message("/msg <nick> <message>")
             ui.add_status_message("/nick <new nick>")
+            ui.add_status_message("/buffers")
+            ui.add_status_message("/buffer <number or name>")
+            ui.add_status_message("/search [channel] <words> (whole words "
+                                  "only)")
+            ui.add_status_message("/debug [in|out|both|all|only <commands>|"
+                                  "hide <commands>|dump [file]]")
+            ui.add_status_message("/stats")
             ui.add_status_message("/quit")
         elif (cmd == "quit"):
             # Quit the program.
-            irc.part()
-            irc.disconnect()
+            session.quit()
             ui.shutdown()
+            session.close_log()
             exit()
+        elif (cmd == "stats"):
+            # Show what the client has been up to.
+            session.show_stats()
+        elif (cmd == "search"):
+            # Search the history of the current network.
+            session.search(" ".join(args))
+        elif (cmd == "buffers"):
+            # List the open buffers, with the number of unread lines in each.
+            for i, buf in enumerate(session.buffers):
+                s = "%d: %s" % (i + 1, buf.name)
+                if (buf.conn is not None):
+                    s += " (%s)" % buf.conn.server
+                if (buf.unread):
+                    s += " [%d unread]" % buf.unread
+                ui.add_status_message(s)
+        elif (cmd == "buffer"):
+            # Switch to another buffer.
+            if (len(args) < 1):
+                ui.add_status_message("usage: buffer <number or name>")
+            else:
+                buf = session.find_buffer(args[0])
+                if (buf is None):
+                    ui.add_status_message("no such buffer: " + args[0])
+                else:
+                    session.switch_buffer(buf)
         elif (cmd == "test"):
-            irc.connect("localhost", 6667)
-            irc.join("#pynapple")
+            # Connect to a local server, such as pynapple_fakeircd.py.
+            session.connect("localhost", 6667)
+            session.join("#pynapple")
         else:
             # The user entered an unknown command, punish them!
             msg = "unknown command: " + cmd
             ui.add_status_message(msg)
         self.lastCommandString = s
 
-# I suppose the program actually starts here. Create some global objects which
-# initialize themselves, and then jump in to a polling loop, checking for input
-# from the keyboard and network. The program exits when the user types /quit.
-irc = IRC()
-kb = KeyboardHandler()
-ui = UserInterface()
-ui.run()
+# The client's global objects. Nothing is created when this module is imported
+# (so the protocol code can be used on its own, e.g. in a bot or a test); call
+# start() to create them.
+session = None
+kb = None
+ui = None
+
+def start(backend=defaultBackend):
+    # Create the session, keyboard handler and user interface, using the given
+    # backend. Returns the UserInterface; call its run() method to enter the
+    # main loop.
+    global session, kb, ui
+    session = Session()
+    kb = KeyboardHandler()
+    ui = UserInterface(backend)
+    return ui
+
+def main(argv=None):
+    # I suppose the program actually starts here. Create the global objects,
+    # run any commands given on the command line, and then jump in to the
+    # main loop, waiting for input from the keyboard and network. The program
+    # exits when the user types /quit.
+    parser = argparse.ArgumentParser(description="Pynapple IRC client")
+    parser.add_argument("--ui", choices=sorted(backends), default=defaultBackend,
+                        help="user interface backend (default: %(default)s)")
+    parser.add_argument("--engine", choices=("thread", "asyncio"),
+                        default=Session.netEngine,
+                        help="network engine (default: %(default)s)")
+    parser.add_argument("--nick", help="nickname to use")
+    parser.add_argument("--connect", metavar="SERVER:PORT",
+                        help="server to connect to on startup")
+    parser.add_argument("--join", metavar="CHANNEL", action="append",
+                        default=[], help="channel to join once connected "
+                        "(may be repeated)")
+    parser.add_argument("--quiet", action="store_true",
+                        help="headless: don't echo messages to stdout")
+    parser.add_argument("--stats-file", metavar="FILE",
+                        help="append a snapshot of /stats to FILE (as JSON) "
+                        "every %d seconds" % Session.statsInterval)
+    args = parser.parse_args(argv)
+    Session.netEngine = args.engine
+    Session.statsFile = args.stats_file
+    if (args.nick):
+        IRC.nick = args.nick
+    IRC.autoJoin = args.join
+    start(args.ui)
+    if (args.quiet):
+        ui.uiPlugin.quiet = True
+    if (args.connect):
+        kb.parse_input("/connect " + args.connect)
+    ui.run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Micro-benchmarks for the hot paths of the client. Run as:
+#
+#   python3 pynapple_bench.py [megabytes]
+#
+# Each benchmark compares the current implementation against a copy of the
+# code it replaced, so that the speedup (or lack of one) stays measurable.
+
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from pynapple_history import History
+from pynapple_match import Matcher
+from pynapple_net import LineFramer
+from pynapple_proto import Dispatcher, parse_message
+
+def make_traffic(size):
+    # Generate roughly size bytes of server traffic: mostly ordinary channel
+    # chatter, with some multibyte UTF-8 text and the occasional long line.
+    rng = random.Random(1)
+    words = ["pineapple", "hello", "world", "irc", "python", "über",
+             "naïve", "日本語", "🍍", "ok", "lol", "the", "a", "of"]
+    out = bytearray()
+    n = 0
+    while (len(out) < size):
+        nick = "user%d" % rng.randrange(500)
+        if (n % 200 == 0):
+            text = " ".join(rng.choice(words) for x in range(400))
+        else:
+            text = " ".join(rng.choice(words) for x in range(rng.randrange(1, 20)))
+        line = ":%s!~%s@host.example PRIVMSG #pynapple :%s\r\n" % (nick, nick, text)
+        out += line.encode("utf-8")
+        n += 1
+    return bytes(out)
+
+def chunks(data, size):
+    # Split data in to pieces of the given size, as a socket would deliver it.
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+def legacy_frame(pieces):
+    # The original SocketThread.run() loop: decode each chunk on its own,
+    # append to a string buffer and re-split the whole buffer. Chunks are
+    # decoded with errors="replace" here, since the original code raised
+    # UnicodeDecodeError whenever a character straddled two chunks.
+    count = 0
+    rx = ""
+    for piece in pieces:
+        rx = rx + piece.decode("utf-8", "replace")
+        temp = rx.split("\n")
+        rx = temp.pop()
+        for line in temp:
+            line = line.rstrip()
+            count += 1
+    return count
+
+def framer_frame(pieces):
+    # The same input, fed through a LineFramer.
+    framer = LineFramer()
+    count = 0
+    for piece in pieces:
+        count += len(framer.feed(piece))
+    return count
+
+def framer_socket(data):
+    # Push the data through a real socket pair and read it back using
+    # LineFramer.fill(), the path used by SocketThread.
+    a, b = socket.socketpair()
+    writer = threading.Thread(target=lambda: (a.sendall(data), a.close()))
+    framer = LineFramer()
+    count = 0
+    writer.start()
+    while (framer.fill(b) > 0):
+        count += len(framer.lines())
+    writer.join()
+    b.close()
+    return count
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+def report(name, size, lines, seconds):
+    print("%-36s %8d lines %8.3f s %8.1f MB/s" %
+          (name, lines, seconds, size / seconds / 1e6))
+
+def bench_framing(megabytes):
+    data = make_traffic(int(megabytes * 1e6))
+    size = len(data)
+    print("line framing, %.1f MB of traffic" % (size / 1e6))
+    for chunkSize in (1024, 4096, 65536):
+        pieces = chunks(data, chunkSize)
+        report("legacy, %d byte reads" % chunkSize, size,
+               *timed(legacy_frame, pieces))
+        report("LineFramer.feed, %d byte reads" % chunkSize, size,
+               *timed(framer_frame, pieces))
+    report("LineFramer.fill, socket pair", size, *timed(framer_socket, data))
+    # A single long line trickling in: quadratic for the legacy loop.
+    line = b"PRIVMSG #pynapple :" + b"x" * 2000000 + b"\r\n"
+    pieces = chunks(line, 1024)
+    report("legacy, one 2 MB line", len(line), *timed(legacy_frame, pieces))
+    report("LineFramer.feed, one 2 MB line", len(line),
+           *timed(framer_frame, pieces))
+
+def make_messages(count):
+    # Generate a mix of decoded server lines: mostly channel chatter, with
+    # joins, parts, nick changes, pings, names replies, and a sprinkling of
+    # numerics that nothing handles (as seen during connection and /whois).
+    rng = random.Random(2)
+    lines = []
+    for n in range(count):
+        nick = "user%d" % rng.randrange(500)
+        prefix = ":%s!~%s@host.example" % (nick, nick)
+        kind = rng.randrange(100)
+        if (kind < 70):
+            lines.append("%s PRIVMSG #pynapple :hello there number %d" %
+                         (prefix, n))
+        elif (kind < 78):
+            lines.append("%s JOIN #pynapple" % prefix)
+        elif (kind < 86):
+            lines.append("%s PART #pynapple :bye" % prefix)
+        elif (kind < 88):
+            lines.append("%s NICK %s_" % (prefix, nick))
+        elif (kind < 90):
+            lines.append("PING :irc.example")
+        elif (kind < 92):
+            lines.append(":irc.example 353 pynapple = #pynapple :" +
+                         " ".join("n%d" % x for x in range(50)))
+        elif (kind < 96):
+            lines.append("@time=2013-11-07T12:00:00.000Z;msgid=ab\\s12 %s "
+                         "PRIVMSG #pynapple :tagged message" % prefix)
+        else:
+            lines.append(":irc.example %03d pynapple :some server reply" %
+                         rng.choice((1, 2, 3, 4, 5, 251, 252, 265, 311, 372)))
+    return lines
+
+def legacy_parse_message(s):
+    # The original IRC.parse_message(), returning a loose tuple.
+    prefix = ''
+    trailing = []
+    if (s[0] == ':'):
+        prefix, s = s[1:].split(' ', 1)
+    if (s.find(' :')) != -1:
+        s, trailing = s.split(' :', 1)
+        args = s.split()
+        args.append(trailing)
+    else:
+        args = s.split()
+    command = args.pop(0)
+    return prefix, command, args
+
+def legacy_dispatch(lines):
+    # The original chain of tests in IRC.handle_message(), with the work done
+    # by each branch reduced to extracting the fields it used.
+    handled = 0
+    for line in lines:
+        if (line[0] == "@"):
+            line = line.split(" ", 1)[1] # (the old parser didn't know tags)
+        prefix, cmd, args = legacy_parse_message(line)
+        if (cmd == "PING"):
+            handled += len(args[0]) > 0
+        if (cmd == "PRIVMSG"):
+            message = ' '.join(args[1:])
+            nick = prefix[:prefix.find('!')]
+            handled += 1
+        if (cmd == "JOIN"):
+            nick = prefix[:prefix.find('!')]
+            handled += 1
+        if (cmd == "PART"):
+            nick = prefix[:prefix.find('!')]
+            handled += 1
+        if (cmd == "353"):
+            nicklist = ' '.join(args[3:]).split()
+            handled += 1
+        if (cmd == "376"):
+            handled += 1
+        if (cmd == "NICK"):
+            old = prefix[:prefix.find('!')]
+            handled += 1
+    return handled
+
+def dispatcher_dispatch(lines, extra=0):
+    # The same work done through parse_message() and a Dispatcher, optionally
+    # with handlers for a number of extra numerics registered as well.
+    count = [0]
+    def ping(msg):
+        count[0] += len(msg.args[0]) > 0
+    def privmsg(msg):
+        message = ' '.join(msg.args[1:])
+        nick = msg.nick
+        count[0] += 1
+    def nick(msg):
+        nick = msg.nick
+        count[0] += 1
+    def namreply(msg):
+        nicklist = ' '.join(msg.args[3:]).split()
+        count[0] += 1
+    def other(msg):
+        count[0] += 1
+    d = Dispatcher()
+    d.register("PING", ping)
+    d.register("PRIVMSG", privmsg)
+    d.register("JOIN", nick)
+    d.register("PART", nick)
+    d.register("NICK", nick)
+    d.register("353", namreply)
+    d.register("376", other)
+    for n in range(extra):
+        d.register("%03d" % (400 + n), other)
+    for line in lines:
+        d.dispatch(parse_message(line))
+    return count[0]
+
+def bench_dispatch(count):
+    lines = make_messages(count)
+    print("parse and dispatch, %d messages" % count)
+    for name, f, args in (("legacy if-chain", legacy_dispatch, (lines,)),
+                          ("Dispatcher", dispatcher_dispatch, (lines,)),
+                          ("Dispatcher, 100 more numerics",
+                           dispatcher_dispatch, (lines, 100))):
+        handled, seconds = timed(f, *args)
+        print("%-36s %8d handled %8.3f s %8.2f us/msg" %
+              (name, handled, seconds, seconds / count * 1e6))
+
+def make_words(rng, count, length):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for x in range(rng.randrange(*length)))
+            for n in range(count)]
+
+def legacy_match(lines, badwords, hilites, nick):
+    # The original UserInterface.censor() and hilite() loops.
+    count = 0
+    for s in lines:
+        for tag in badwords:
+            s = s.replace(tag, "*" * len(tag))
+        if any(w in s for w in hilites + [nick]):
+            count += 1
+    return count
+
+def matcher_match(lines, badwords, hilites, nick):
+    # The same, done by a single Matcher.process() call per line. The time
+    # taken to compile the matcher is included.
+    matcher = Matcher(badwords, hilites + [nick])
+    count = 0
+    for s in lines:
+        s, hilite = matcher.process(s)
+        count += hilite
+    return count
+
+def check_matching():
+    # Make sure the Matcher censors what the legacy loops did in the cases
+    # where the two lists meet, e.g. a word to censor starting a word (or our
+    # nick) to highlight.
+    cases = ((["ass"], ["assess"], "you assess", ("you ***ess", True)),
+             (["ass"], ["assess"], "an ass", ("an ***", False)),
+             (["pyn"], ["pynapple"], "hi pynapple", ("hi ***apple", True)),
+             (["ab", "bc"], [], "abc", ("***", False)),
+             (["x"], ["y"], "xyx", ("*y*", True)))
+    for badwords, hilites, s, expected in cases:
+        result = Matcher(badwords, hilites).process(s)
+        if (result != expected):
+            raise AssertionError("Matcher(%r, %r).process(%r) returned %r, "
+                                 "not %r" % (badwords, hilites, s, result,
+                                             expected))
+
+def bench_matching(count):
+    check_matching()
+    rng = random.Random(3)
+    lines = [l.split(" :", 1)[1] for l in make_messages(count)
+             if " PRIVMSG " in l]
+    nick = "pynapple"
+    print("censor and highlight, %d messages" % len(lines))
+    for badCount, hiliteCount in ((10, 5), (2000, 200)):
+        badwords = make_words(rng, badCount, (5, 10))
+        hilites = make_words(rng, hiliteCount, (4, 8)) + ["number 1"]
+        for name, f in (("legacy loops", legacy_match),
+                        ("Matcher", matcher_match)):
+            hilited, seconds = timed(f, lines, badwords, hilites, nick)
+            print("%-36s %8d hilited %8.3f s %8.2f us/msg" %
+                  ("%s, %d/%d words" % (name, badCount, hiliteCount),
+                   hilited, seconds, seconds / len(lines) * 1e6))
+
+def bench_history(count):
+    # Fill a history in a temporary directory, then time the lookups behind
+    # /search and the backfill done on joining a channel.
+    rng = random.Random(4)
+    vocabulary = make_words(rng, 5000, (3, 9))
+    directory = tempfile.mkdtemp()
+    try:
+        history = History(directory)
+        start = time.perf_counter()
+        for n in range(count):
+            text = " ".join(rng.choice(vocabulary) for x in range(rng.randrange(3, 15)))
+            history.add("#chan%d" % rng.randrange(20), "user%d" % rng.randrange(500),
+                        text, 1e9 + n)
+        history.flush()
+        seconds = time.perf_counter() - start
+        size = sum(history.segment_size(x) for x in history.list_segments())
+        print("history, %d messages (%.1f MB)" % (count, size / 1e6))
+        print("%-36s %8.3f s %8.2f us/msg" % ("add and flush", seconds,
+                                              seconds / count * 1e6))
+        for name, f in (("search, one word",
+                         lambda: history.search([vocabulary[0]])),
+                        ("search, two words",
+                         lambda: history.search(vocabulary[1:3])),
+                        ("search, word in channel",
+                         lambda: history.search([vocabulary[3]], "#chan1")),
+                        ("search, last hour",
+                         lambda: history.search([vocabulary[4]],
+                                                since=1e9 + count - 3600)),
+                        ("backfill, 20 messages",
+                         lambda: history.recent("#chan2", 20))):
+            records, seconds = timed(f)
+            print("%-36s %8d found   %8.2f ms" % (name, len(records),
+                                                  seconds * 1000))
+        history.close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    megabytes = 8
+    if (len(sys.argv) > 1):
+        megabytes = float(sys.argv[1])
+    bench_framing(megabytes)
+    bench_dispatch(int(megabytes * 25000))
+    bench_matching(int(megabytes * 2500))
+    bench_history(int(megabytes * 25000))
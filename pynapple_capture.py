@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Raw traffic capture for the debug view. Everything sent to and received from
+# the servers is kept in a bounded in-memory ring, as it arrives (a received
+# batch of lines is kept as the one string it was logged as), so capturing
+# costs next to nothing while the debug view is closed. Lines are only picked
+# apart when they are shown, filtered by direction and command, or dumped to
+# a file.
+
+import collections
+import time
+from datetime import datetime
+
+from pynapple_proto import command_of
+
+SENT = "->"
+RECEIVED = "<-"
+
+class TrafficCapture:
+    # A ring of (time, server, direction, text) records holding at most about
+    # capacity characters of traffic; the oldest records are dropped to make
+    # room. The text of a record may hold several lines, separated by newlines.
+    # A filter, set by set_filter(), decides which lines are shown and dumped.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.records = collections.deque()
+        self.size = 0    # characters held
+        self.dropped = 0 # records thrown away to make room for newer ones
+        self.set_filter()
+
+    def add(self, server, direction, text):
+        # Capture some traffic, dropping the oldest if the ring is full.
+        records = self.records
+        records.append((time.time(), server, direction, text))
+        self.size += len(text)
+        while (self.size > self.capacity and len(records) > 1):
+            self.size -= len(records.popleft()[3])
+            self.dropped += 1
+
+    def clear(self):
+        self.records.clear()
+        self.size = 0
+
+    def set_filter(self, directions=(SENT, RECEIVED), commands=None,
+                   excluded=()):
+        # Only show lines going in the given directions and, if commands is
+        # given, with one of those commands; and never those with one of the
+        # excluded commands. Commands are matched regardless of case.
+        self.directions = tuple(directions)
+        self.commands = None
+        if (commands is not None):
+            self.commands = frozenset(c.upper() for c in commands)
+        self.excluded = frozenset(c.upper() for c in excluded)
+
+    def describe_filter(self):
+        # Return the filter as a short line of text.
+        if (len(self.directions) == 2):
+            s = "both directions"
+        elif (self.directions == (SENT,)):
+            s = "sent only"
+        else:
+            s = "received only"
+        if (self.commands is not None):
+            s += ", only " + " ".join(sorted(self.commands))
+        if (self.excluded):
+            s += ", not " + " ".join(sorted(self.excluded))
+        return s
+
+    def is_filtered(self):
+        return (len(self.directions) < 2 or self.commands is not None or
+                bool(self.excluded))
+
+    def matches(self, line):
+        # Return True if a line (in one of the directions shown) passes the
+        # command filter.
+        if (self.commands is None and not self.excluded):
+            return True
+        command = command_of(line)
+        if (command in self.excluded):
+            return False
+        return self.commands is None or command in self.commands
+
+    def select(self, direction, text):
+        # Return the lines of a record's text that pass the filter.
+        if (direction not in self.directions):
+            return []
+        if (self.commands is None and not self.excluded):
+            return text.split("\n")
+        return [line for line in text.split("\n") if self.matches(line)]
+
+    def last_lines(self, n):
+        # Return the newest n lines passing the filter (fewer if there aren't
+        # as many), oldest first, each prefixed by its direction as shown in
+        # the debug view. Only as many records are looked at as it takes.
+        lines = []
+        for stamp, server, direction, text in reversed(self.records):
+            selected = self.select(direction, text)
+            for line in reversed(selected[-(n - len(lines)):]):
+                lines.append(direction + " " + line)
+            if (len(lines) >= n):
+                break
+        lines.reverse()
+        return lines
+
+    def dump(self, path):
+        # Write every line passing the filter to the given file, oldest first,
+        # along with the time it was captured and the server. Returns the
+        # number of lines written.
+        count = 0
+        with open(path, "w", encoding="utf-8", errors="replace") as f:
+            for stamp, server, direction, text in list(self.records):
+                selected = self.select(direction, text)
+                if (not selected):
+                    continue
+                prefix = "%s %s %s " % (datetime.fromtimestamp(stamp).strftime(
+                                        "%Y-%m-%d %H:%M:%S.%f")[:-3], server,
+                                        direction)
+                for line in selected:
+                    f.write(prefix + line + "\n")
+                count += len(selected)
+        return count
+
+    def get_stats(self):
+        return {"records": len(self.records), "size": self.size,
+                "capacity": self.capacity, "dropped": self.dropped}
@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# A stand-in IRC server for testing without a network, and a load generator.
+# Run as:
+#
+#   python3 pynapple_fakeircd.py [options]
+#
+# to listen on localhost:6667 (where the client's /test command connects),
+# or with --soak SECONDS to also run the client itself against it, in the same
+# process, and report how it holds up under load.
+#
+# The server speaks just enough of the protocol for pynapple: registration,
+# PING and PONG, JOIN, PART, QUIT, NICK, MODE, NAMES (split over as many 353
+# replies as needed) and PRIVMSG between real clients. Every channel is also
+# populated by a crowd of simulated users, who talk at a configurable rate,
+# with optional bursts, and come and go. Their messages carry the time they
+# were sent, so that a client in the same process can tell how long they took
+# to reach the screen. The server pings each client regularly and keeps track
+# of how quickly the PONGs come back.
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+serverName = "irc.fake.example"
+
+def user_prefix(n):
+    return "user%d!~user%d@sim%d.fake.example" % (n, n, n % 251)
+
+class FakeClient(asyncio.Protocol):
+    # One real client connected to the server.
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buf = b""
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.channels = set()
+        self.pings = {} # token -> time the PING was sent
+        self.caps = set() # IRCv3 capabilities enabled
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.clients.add(self)
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+        for channel in self.channels:
+            self.server.channels.get(channel, set()).discard(self)
+
+    def data_received(self, data):
+        lines = (self.buf + data).split(b"\n")
+        self.buf = lines.pop()
+        for line in lines:
+            line = line.rstrip(b"\r").decode("utf-8", "replace")
+            if (line):
+                self.server.received += 1
+                self.handle(line)
+
+    def send(self, line):
+        if (self.transport is not None and not self.transport.is_closing()):
+            data = (line + "\r\n").encode("utf-8")
+            self.transport.write(data)
+            self.server.sent += 1
+            self.server.bytesSent += len(data)
+
+    def prefix(self):
+        return "%s!~%s@localhost" % (self.nick, self.user or self.nick)
+
+    def numeric(self, number, text):
+        self.send(":%s %s %s %s" % (serverName, number, self.nick or "*", text))
+
+    def handle(self, line):
+        if (line[0] == ":"):
+            line = line.split(" ", 1)[1] if " " in line else ""
+        trailing = None
+        if (" :" in line):
+            line, trailing = line.split(" :", 1)
+        args = line.split()
+        if (not args):
+            return
+        if (trailing is not None):
+            args.append(trailing)
+        command = args.pop(0).upper()
+        handler = getattr(self, "on_" + command.lower(), None)
+        if (handler is not None):
+            handler(args)
+        elif (self.registered):
+            self.numeric("421", "%s :Unknown command" % command)
+
+    def on_nick(self, args):
+        if (not args):
+            return
+        new = args[0]
+        if (self.registered):
+            self.send(":%s NICK :%s" % (self.prefix(), new))
+            self.nick = new
+        else:
+            self.nick = new
+            self.register()
+
+    def on_user(self, args):
+        if (args):
+            self.user = args[0]
+        self.register()
+
+    def register(self):
+        if (self.registered or self.nick is None or self.user is None):
+            return
+        self.registered = True
+        self.numeric("001", ":Welcome to the fake IRC network %s" % self.prefix())
+        self.numeric("002", ":Your host is %s" % serverName)
+        self.numeric("003", ":This server was created just now")
+        self.numeric("004", "%s fakeircd-1 io bovimnklt" % serverName)
+        self.numeric("005", "PREFIX=(ov)@+ CHANMODES=b,k,l,imnt NICKLEN=30 "
+                     ":are supported by this server")
+        self.numeric("375", ":- %s Message of the day -" % serverName)
+        self.numeric("372", ":- This server is not real.")
+        self.numeric("376", ":End of /MOTD command.")
+
+    def on_cap(self, args):
+        # Capability negotiation; "batch" is the only one we know.
+        if (not args):
+            return
+        sub = args[0].upper()
+        if (sub == "LS"):
+            self.send(":%s CAP * LS :batch" % serverName)
+        elif (sub == "REQ" and len(args) > 1):
+            wanted = args[1].split()
+            if (all(cap == "batch" for cap in wanted)):
+                self.caps.update(wanted)
+                self.send(":%s CAP * ACK :%s" % (serverName, args[1]))
+            else:
+                self.send(":%s CAP * NAK :%s" % (serverName, args[1]))
+
+    def on_ping(self, args):
+        self.send(":%s PONG %s :%s" % (serverName, serverName,
+                                       args[0] if args else ""))
+
+    def on_pong(self, args):
+        token = args[-1] if args else ""
+        sentAt = self.pings.pop(token, None)
+        if (sentAt is not None):
+            self.server.note_pong(time.monotonic() - sentAt)
+
+    def on_join(self, args):
+        if (not args):
+            return
+        for channel in args[0].split(","):
+            if (channel in self.channels):
+                continue
+            self.channels.add(channel)
+            members = self.server.channels.setdefault(channel, set())
+            for client in members:
+                client.send(":%s JOIN %s" % (self.prefix(), channel))
+            members.add(self)
+            self.send(":%s JOIN %s" % (self.prefix(), channel))
+            self.on_names([channel])
+
+    def on_names(self, args):
+        if (not args):
+            return
+        channel = args[0]
+        names = ["@" + self.nick if self.nick else ""]
+        names += [c.nick for c in self.server.channels.get(channel, ())
+                  if c is not self]
+        names += self.server.simulated_names()
+        head = ":%s 353 %s = %s :" % (serverName, self.nick, channel)
+        line = []
+        size = len(head)
+        for name in names:
+            if (size + len(name) + 1 > 510):
+                self.send(head + " ".join(line))
+                line = []
+                size = len(head)
+            line.append(name)
+            size += len(name) + 1
+        if (line):
+            self.send(head + " ".join(line))
+        self.numeric("366", "%s :End of /NAMES list." % channel)
+
+    def on_part(self, args):
+        if (not args):
+            return
+        for channel in args[0].split(","):
+            if (channel in self.channels):
+                for client in self.server.channels.get(channel, ()):
+                    client.send(":%s PART %s" % (self.prefix(), channel))
+                self.server.channels[channel].discard(self)
+                self.channels.discard(channel)
+
+    def on_quit(self, args):
+        for channel in self.channels:
+            for client in self.server.channels.get(channel, ()):
+                if (client is not self):
+                    client.send(":%s QUIT :%s" % (self.prefix(),
+                                                  args[0] if args else ""))
+            self.server.channels[channel].discard(self)
+        self.channels = set()
+        self.send("ERROR :Closing link")
+        self.transport.close()
+
+    def on_privmsg(self, args, command="PRIVMSG"):
+        if (len(args) < 2):
+            return
+        target, text = args[0], args[1]
+        line = ":%s %s %s :%s" % (self.prefix(), command, target, text)
+        if (target in self.server.channels):
+            for client in self.server.channels[target]:
+                if (client is not self):
+                    client.send(line)
+        else:
+            for client in self.server.clients:
+                if (client.nick == target):
+                    client.send(line)
+
+    def on_notice(self, args):
+        self.on_privmsg(args, "NOTICE")
+
+    def on_mode(self, args):
+        if (args and args[0] in self.channels):
+            self.numeric("324", "%s +nt" % args[0])
+
+class FakeServer:
+    # The server, and the crowd of simulated users in every channel. Each
+    # second, the crowd sends rate messages (spread evenly) to the channels
+    # real clients are in, plus burst messages at once every burstInterval
+    # seconds, and churn joins and parts. Every netsplitInterval seconds (if
+    # set), a third of them are lost in a netsplit, and come back netsplitHeal
+    # seconds later; clients that asked for it get these as IRCv3 batches.
+    tick = 0.01 # seconds between rounds of simulated traffic
+
+    def __init__(self, host="127.0.0.1", port=6667, users=1000, rate=50.0,
+                 burst=0, burstInterval=30.0, churn=0.0, pingInterval=5.0,
+                 netsplitInterval=0.0, netsplitHeal=2.0):
+        self.host = host
+        self.port = port
+        self.users = users
+        self.rate = rate
+        self.burst = burst
+        self.burstInterval = burstInterval
+        self.churn = churn
+        self.pingInterval = pingInterval
+        self.netsplitInterval = netsplitInterval
+        self.netsplitHeal = netsplitHeal
+        self.batches = 0
+        self.clients = set()
+        self.channels = {}     # name -> set of FakeClients
+        self.away = set()      # simulated users currently parted
+        self.rng = random.Random(1)
+        self.loop = None
+        self.sequence = 0
+        self.sent = 0          # lines sent to clients
+        self.bytesSent = 0
+        self.received = 0      # lines received from clients
+        self.pongs = 0
+        self.pongTotal = 0.0
+        self.pongMax = 0.0
+
+    def simulated_names(self):
+        return ["user%d" % n for n in range(self.users) if n not in self.away]
+
+    def note_pong(self, rtt):
+        self.pongs += 1
+        self.pongTotal += rtt
+        self.pongMax = max(self.pongMax, rtt)
+
+    def get_stats(self):
+        average = 0.0
+        if (self.pongs):
+            average = self.pongTotal / self.pongs
+        backlog = sum(c.transport.get_write_buffer_size()
+                      for c in self.clients if c.transport is not None)
+        return {"clients": len(self.clients), "sent": self.sent,
+                "bytesSent": self.bytesSent, "received": self.received,
+                "pongs": self.pongs, "pongAverage": average,
+                "pongMax": self.pongMax, "writeBacklog": backlog}
+
+    async def serve(self, ready=None):
+        self.loop = asyncio.get_running_loop()
+        server = await self.loop.create_server(lambda: FakeClient(self),
+                                               self.host, self.port)
+        if (self.port == 0):
+            self.port = server.sockets[0].getsockname()[1]
+        if (ready is not None):
+            ready.set()
+        async with server:
+            await asyncio.gather(self.generate(), self.ping(),
+                                 self.netsplits())
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    def start_thread(self):
+        # Run the server on a background thread, returning once it's
+        # listening.
+        ready = threading.Event()
+        thread = threading.Thread(target=lambda: asyncio.run(self.serve(ready)),
+                                  daemon=True)
+        thread.start()
+        ready.wait()
+        return thread
+
+    async def ping(self):
+        n = 0
+        while (True):
+            await asyncio.sleep(self.pingInterval)
+            for client in list(self.clients):
+                if (client.registered):
+                    n += 1
+                    token = "fake%d" % n
+                    client.pings[token] = time.monotonic()
+                    client.send("PING :%s" % token)
+
+    async def generate(self):
+        # Send the simulated users' traffic.
+        due = 0.0
+        churnDue = 0.0
+        nextBurst = time.monotonic() + self.burstInterval
+        last = time.monotonic()
+        while (True):
+            await asyncio.sleep(self.tick)
+            now = time.monotonic()
+            due += self.rate * (now - last)
+            churnDue += self.churn * (now - last)
+            last = now
+            count = int(due)
+            due -= count
+            if (self.burst and now >= nextBurst):
+                count += self.burst
+                nextBurst = now + self.burstInterval
+            channels = [c for c, members in self.channels.items() if members]
+            if (not channels or not self.users):
+                continue
+            for i in range(count):
+                self.say(self.rng.choice(channels))
+            while (churnDue >= 1):
+                churnDue -= 1
+                self.come_or_go(self.rng.choice(channels))
+
+    def say(self, channel):
+        # Have a random simulated user say something in a channel. The text
+        # starts with a sequence number and the time it was sent.
+        self.sequence += 1
+        user = self.rng.randrange(self.users)
+        line = ":%s PRIVMSG %s :load %d %.6f %s" % (
+            user_prefix(user), channel, self.sequence, time.monotonic(),
+            "lorem ipsum dolor sit amet" * self.rng.randrange(1, 4))
+        for client in self.channels[channel]:
+            client.send(line)
+
+    async def netsplits(self):
+        if (not self.netsplitInterval):
+            return
+        servers = [serverName, "leaf.fake.example"]
+        while (True):
+            await asyncio.sleep(self.netsplitInterval)
+            present = [n for n in range(self.users) if n not in self.away]
+            lost = self.rng.sample(present, len(present) // 3)
+            self.away.update(lost)
+            clients = set()
+            for members in self.channels.values():
+                clients.update(members)
+            self.send_batch(clients, "netsplit", servers,
+                            [":%s QUIT :%s" % (user_prefix(n), " ".join(servers))
+                             for n in lost])
+            await asyncio.sleep(self.netsplitHeal)
+            self.away.difference_update(lost)
+            for channel, members in self.channels.items():
+                self.send_batch(members, "netjoin", servers,
+                                [":%s JOIN %s" % (user_prefix(n), channel)
+                                 for n in lost])
+
+    def send_batch(self, clients, kind, params, lines):
+        # Send lines to clients, as a batch of the given type to those that
+        # support it.
+        self.batches += 1
+        ref = "b%d" % self.batches
+        for client in list(clients):
+            if ("batch" in client.caps):
+                client.send("BATCH +%s %s %s" % (ref, kind, " ".join(params)))
+                for line in lines:
+                    client.send("@batch=%s %s" % (ref, line))
+                client.send("BATCH -%s" % ref)
+            else:
+                for line in lines:
+                    client.send(line)
+
+    def come_or_go(self, channel):
+        # Have a random simulated user join, or else leave, by parting the
+        # channel or quitting (which every channel sees).
+        user = self.rng.randrange(self.users)
+        channels = [channel]
+        if (user in self.away):
+            self.away.discard(user)
+            line = ":%s JOIN %s" % (user_prefix(user), channel)
+        elif (self.rng.random() < 0.5):
+            self.away.add(user)
+            line = ":%s PART %s :churn" % (user_prefix(user), channel)
+        else:
+            self.away.add(user)
+            line = ":%s QUIT :Quit: churn" % user_prefix(user)
+            channels = self.channels
+        for channel in channels:
+            for client in self.channels[channel]:
+                client.send(line)
+
+def memory_usage():
+    # Return the resident memory of this process in bytes, if we can tell.
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            return 0
+
+def soak(server, seconds, interval, engine, channel):
+    # Run the client against the server, in this process, for the given time,
+    # reporting every interval seconds how long simulated messages take from
+    # being sent by the server to being shown, how long the client takes to
+    # answer PINGs, and how much memory we're using.
+    import pynapple
+    import pynapple_nullui
+    latencies = []
+    class SoakPlugin(pynapple_nullui.UserInterfacePlugin):
+        def get_stdin(self):
+            return None
+
+        def add_message(self, s, color, hilite):
+            i = s.find("> load ")
+            if (i != -1):
+                try:
+                    sentAt = float(s[i + 7:].split(" ", 2)[1])
+                except (ValueError, IndexError):
+                    return
+                latencies.append(time.monotonic() - sentAt)
+    server.start_thread()
+    pynapple.Session.netEngine = engine
+    pynapple.Session.logRaw = False
+    pynapple.Session.logChat = False
+    pynapple.Session.historyEnabled = False
+    pynapple.IRC.autoJoin = [channel]
+    pynapple.load_backend = lambda name: SoakPlugin
+    ui = pynapple.start("headless")
+    ui.uiPlugin.quiet = True
+    pynapple.kb.parse_input("/connect %s:%d" % (server.host, server.port))
+    start = time.monotonic()
+    startMemory = memory_usage()
+    print("%8s %8s %9s %9s %9s %9s %8s %8s" % ("time", "shown", "lat avg",
+          "lat p99", "lat max", "pong avg", "backlog", "RSS MB"))
+    def report():
+        # Runs on a timer thread; only reads counters.
+        while (True):
+            time.sleep(interval)
+            window = latencies[:]
+            del latencies[:len(window)]
+            window.sort()
+            stats = server.get_stats()
+            p99 = window[int(len(window) * 0.99)] if window else 0.0
+            average = sum(window) / len(window) if window else 0.0
+            print("%7.0fs %8d %8.1fms %8.1fms %8.1fms %8.1fms %8d %8.1f" % (
+                time.monotonic() - start, len(window), average * 1000,
+                p99 * 1000, (window[-1] if window else 0.0) * 1000,
+                stats["pongAverage"] * 1000, pynapple.session.get_backlog(),
+                memory_usage() / 1e6))
+            sys.stdout.flush()
+            if (time.monotonic() - start >= seconds):
+                print("memory growth: %.1f MB" %
+                      ((memory_usage() - startMemory) / 1e6))
+                ui.uiPlugin.shutdown()
+                if (engine == "asyncio"):
+                    pynapple.get_default_engine().stop()
+                else:
+                    pynapple.session.get_wakeup().set()
+                return
+    threading.Thread(target=report, daemon=True).start()
+    ui.run()
+    pynapple.session.quit()
+    pynapple.session.close_log()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fake IRC server and load "
+                                     "generator for testing pynapple.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6667,
+                        help="port to listen on (0 for any; default: 6667)")
+    parser.add_argument("--users", type=int, default=1000,
+                        help="simulated users in each channel")
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="simulated messages per second")
+    parser.add_argument("--burst", type=int, default=0,
+                        help="extra messages sent at once every burst "
+                        "interval")
+    parser.add_argument("--burst-interval", type=float, default=30.0)
+    parser.add_argument("--churn", type=float, default=0.0,
+                        help="simulated joins and parts per second")
+    parser.add_argument("--ping-interval", type=float, default=5.0)
+    parser.add_argument("--netsplit", type=float, default=0.0,
+                        metavar="SECONDS",
+                        help="lose a third of the users in a netsplit this "
+                        "often")
+    parser.add_argument("--netsplit-heal", type=float, default=2.0,
+                        metavar="SECONDS",
+                        help="time until they come back")
+    parser.add_argument("--soak", type=float, metavar="SECONDS",
+                        help="run the client against the server for this long")
+    parser.add_argument("--interval", type=float, default=10.0,
+                        help="seconds between soak reports")
+    parser.add_argument("--engine", choices=("thread", "asyncio"),
+                        default="thread", help="client network engine")
+    parser.add_argument("--channel", default="#pynapple",
+                        help="channel the soaking client joins")
+    args = parser.parse_args(argv)
+    server = FakeServer(args.host, args.port, args.users, args.rate,
+                        args.burst, args.burst_interval, args.churn,
+                        args.ping_interval, args.netsplit,
+                        args.netsplit_heal)
+    if (args.soak):
+        soak(server, args.soak, args.interval, args.engine, args.channel)
+    else:
+        print("fake IRC server listening on %s:%d" % (args.host, args.port))
+        try:
+            server.run()
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# An on-disk, searchable history of the messages seen on a network.
+#
+# Messages are appended to segment files (00000001.seg, 00000002.seg, ...),
+# one message per line:
+#
+#   <time>\t<channel>\t<nick>\t<text>\n
+#
+# so that they can still be read (or grepped) without pynapple. A message is
+# identified by its position: the number of its segment and its byte offset
+# within it. Next to the segments, three kinds of index are kept:
+#
+#   time.idx      (time, segment, offset) of every timeIndexInterval-th
+#                 message, in order, for finding where a period of time starts
+#                 with a binary search.
+#   keys/XX.idx   (hash, segment, offset) of every message, filed under the
+#                 hash of its channel and again under the hash of its nick.
+#   words/XX.idx  (hash, segment, offset) for each distinct word of every
+#                 message, if word indexing is turned on.
+#
+# Postings are spread over 256 files (XX being the low byte of the hash), and
+# are only ever appended to, so the newest postings for a key are at the end
+# of its file. Lookups map the files in to memory and search them for the
+# packed hash, so no index is ever read in to Python objects as a whole. Hash
+# collisions are harmless, as every message found is checked before being
+# returned.
+
+import atexit
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from pynapple_proto import irc_lower
+
+posting = struct.Struct("<IIQ")   # hash, segment, offset
+timeEntry = struct.Struct("<dIQ") # time, segment, offset
+wordPattern = re.compile(r"\w+")
+
+def key_hash(s):
+    return zlib.crc32(irc_lower(s).encode("utf-8", "replace"))
+
+def clean(s):
+    # Make a field safe to store in a segment.
+    return s.replace("\t", " ").replace("\n", " ").replace("\r", "")
+
+def words(s):
+    # Return the distinct words of a message, folded to lower case.
+    return set(w for w in wordPattern.findall(s.lower()) if len(w) > 1)
+
+class Record:
+    # A message read back from the history.
+    __slots__ = ("time", "channel", "nick", "text", "position")
+
+    def __init__(self, time, channel, nick, text, position):
+        self.time = time
+        self.channel = channel
+        self.nick = nick
+        self.text = text
+        self.position = position # (segment, offset)
+
+    def __repr__(self):
+        return "Record(%r, %r, %r, %r)" % (self.time, self.channel, self.nick,
+                                           self.text)
+
+class History:
+    # The history of one network, kept in the given directory. add() only
+    # buffers messages in memory; they're written out by a background thread
+    # every flushInterval seconds (and before any lookup, so that lookups
+    # always see everything added so far). Raises OSError if the directory
+    # can't be created.
+    segmentSize = 64 * 1024 * 1024 # start a new segment beyond this size
+    timeIndexInterval = 64         # messages per time index entry
+    flushInterval = 1.0
+
+    def __init__(self, directory, wordIndex=True):
+        self.directory = directory
+        self.wordIndex = wordIndex
+        self.lock = threading.RLock()
+        self.pending = []      # (segment, line as bytes) waiting to be written
+        self.postings = {}     # (kind, bucket) -> list of hashes and positions
+        self.timeEntries = []  # packed time index entries waiting
+        self.maps = {}         # segment -> (mmap, size mapped)
+        self.thread = None
+        self.closed = False
+        self.added = 0
+        self.errors = 0        # batches that could not be written
+        self.sinceTimeEntry = self.timeIndexInterval
+        for sub in ("keys", "words"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+        segments = self.list_segments()
+        self.segment = segments[-1] if segments else 1
+        self.offset = self.segment_size(self.segment) # where the next line goes
+
+    def list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            if (name.endswith(".seg") and name[:-4].isdigit()):
+                segments.append(int(name[:-4]))
+        return sorted(segments)
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, "%08d.seg" % segment)
+
+    def segment_size(self, segment):
+        try:
+            return os.path.getsize(self.segment_path(segment))
+        except OSError:
+            return 0
+
+    def index_path(self, kind, h):
+        return os.path.join(self.directory, kind, "%02x.idx" % (h & 0xff))
+
+    def add(self, channel, nick, text, when=None):
+        # Add a message to the history.
+        if (self.closed):
+            return
+        if (when is None):
+            when = time.time()
+        line = ("%.3f\t%s\t%s\t%s\n" % (when, clean(channel), clean(nick),
+                                        clean(text))).encode("utf-8", "replace")
+        with self.lock:
+            if (self.offset > 0 and
+                self.offset + len(line) > self.segmentSize):
+                self.segment += 1
+                self.offset = 0
+                self.sinceTimeEntry = self.timeIndexInterval
+            segment, offset = self.segment, self.offset
+            self.pending.append((segment, line))
+            self.offset += len(line)
+            # Postings are packed when written out, to keep this cheap.
+            postings = self.postings
+            keys = [key_hash(channel)]
+            if (irc_lower(nick) != irc_lower(channel)):
+                keys.append(key_hash(nick)) # (unless a private message)
+            for h in keys:
+                entries = postings.get(("keys", h & 0xff))
+                if (entries is None):
+                    entries = postings[("keys", h & 0xff)] = []
+                entries += (h, segment, offset)
+            if (self.wordIndex):
+                crc32 = zlib.crc32
+                for word in words(text):
+                    h = crc32(word.encode("utf-8"))
+                    entries = postings.get(("words", h & 0xff))
+                    if (entries is None):
+                        entries = postings[("words", h & 0xff)] = []
+                    entries += (h, segment, offset)
+            if (self.sinceTimeEntry >= self.timeIndexInterval):
+                self.timeEntries.append(timeEntry.pack(when, segment, offset))
+                self.sinceTimeEntry = 0
+            self.sinceTimeEntry += 1
+            self.added += 1
+        if (self.thread is None):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def run(self):
+        while (not self.closed):
+            time.sleep(self.flushInterval)
+            self.flush()
+
+    def flush(self):
+        # Write out everything added since the last flush. Segment data goes
+        # first, so that an index never points past the end of a segment. If
+        # writing fails, the batch is thrown away (and counted), and the next
+        # message goes wherever the segment really ends.
+        with self.lock:
+            if (not self.pending):
+                return
+            bySegment = {}
+            for segment, line in self.pending:
+                bySegment.setdefault(segment, []).append(line)
+            postings, timeEntries = self.postings, self.timeEntries
+            self.pending = []
+            self.postings = {}
+            self.timeEntries = []
+            try:
+                for segment in sorted(bySegment):
+                    with open(self.segment_path(segment), "ab") as f:
+                        f.write(b"".join(bySegment[segment]))
+                for (kind, bucket), entries in postings.items():
+                    data = struct.pack("<" + "IIQ" * (len(entries) // 3),
+                                       *entries)
+                    with open(self.index_path(kind, bucket), "ab") as f:
+                        f.write(data)
+                if (timeEntries):
+                    with open(os.path.join(self.directory, "time.idx"),
+                              "ab") as f:
+                        f.write(b"".join(timeEntries))
+            except OSError:
+                self.errors += 1
+                self.offset = self.segment_size(self.segment)
+
+    def close(self):
+        self.closed = True
+        self.flush()
+        with self.lock:
+            for mm, size in self.maps.values():
+                mm.close()
+            self.maps = {}
+
+    def map_file(self, path):
+        # Map a file in to memory for reading, or return None if it's empty or
+        # missing.
+        try:
+            with open(path, "rb") as f:
+                if (os.fstat(f.fileno()).st_size == 0):
+                    return None
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError:
+            return None
+
+    def read(self, position):
+        # Return the message at the given (segment, offset) position, or None.
+        segment, offset = position
+        mm, size = self.maps.get(segment, (None, 0))
+        if (offset >= size):
+            # Not mapped yet, or the segment has grown since it was.
+            if (mm is not None):
+                mm.close()
+            mm = self.map_file(self.segment_path(segment))
+            if (mm is None):
+                return None
+            size = len(mm)
+            self.maps[segment] = (mm, size)
+            if (offset >= size):
+                return None
+        end = mm.find(b"\n", offset)
+        if (end == -1):
+            return None
+        fields = mm[offset:end].decode("utf-8", "replace").split("\t", 3)
+        if (len(fields) != 4):
+            return None
+        return Record(float(fields[0]), fields[1], fields[2], fields[3],
+                      position)
+
+    def lookup(self, kind, h):
+        # Return the positions of all messages filed under the given hash, in
+        # the order they were added.
+        mm = self.map_file(self.index_path(kind, h))
+        if (mm is None):
+            return []
+        positions = []
+        needle = struct.pack("<I", h)
+        size = posting.size
+        try:
+            i = mm.find(needle)
+            while (i != -1):
+                if (i % size == 0):
+                    x, segment, offset = posting.unpack_from(mm, i)
+                    positions.append((segment, offset))
+                    i = mm.find(needle, i + size)
+                else:
+                    i = mm.find(needle, i + 1)
+        finally:
+            mm.close()
+        return positions
+
+    def lookup_newest(self, kind, h):
+        # Generate the positions of the messages filed under the given hash,
+        # newest first, reading only as much of the index as needed.
+        mm = self.map_file(self.index_path(kind, h))
+        if (mm is None):
+            return
+        needle = struct.pack("<I", h)
+        size = posting.size
+        try:
+            i = mm.rfind(needle)
+            while (i != -1):
+                if (i % size == 0):
+                    x, segment, offset = posting.unpack_from(mm, i)
+                    yield (segment, offset)
+                    i = mm.rfind(needle, 0, i)
+                else:
+                    i = mm.rfind(needle, 0, i + len(needle) - 1)
+        finally:
+            mm.close()
+
+    def find_time(self, when):
+        # Return the position of the first message added at or after the given
+        # time (approximately: it may be up to timeIndexInterval messages
+        # earlier).
+        mm = self.map_file(os.path.join(self.directory, "time.idx"))
+        if (mm is None):
+            return (0, 0)
+        try:
+            lo = 0
+            hi = len(mm) // timeEntry.size
+            while (lo < hi):
+                mid = (lo + hi) // 2
+                if (timeEntry.unpack_from(mm, mid * timeEntry.size)[0] < when):
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if (lo == 0):
+                return (0, 0)
+            t, segment, offset = timeEntry.unpack_from(mm, (lo - 1) * timeEntry.size)
+            return (segment, offset)
+        finally:
+            mm.close()
+
+    def recent(self, channel, count):
+        # Return up to count of the newest messages in the given channel (or
+        # private conversation), oldest first.
+        self.flush()
+        with self.lock:
+            records = []
+            for position in self.lookup_newest("keys", key_hash(channel)):
+                record = self.read(position)
+                if (record is not None and
+                    irc_lower(record.channel) == irc_lower(channel)):
+                    records.append(record)
+                    if (len(records) == count):
+                        break
+            records.reverse()
+            return records
+
+    def search(self, terms, channel=None, nick=None, since=None, limit=50):
+        # Return up to limit of the newest messages containing all the given
+        # words (and in the given channel, from the given nick, and no older
+        # than the given time, if any), oldest first. Only whole words match,
+        # regardless of case, and words of one letter are ignored, whether
+        # or not words are indexed.
+        self.flush()
+        with self.lock:
+            wordTerms = sorted(words(" ".join(terms)))
+            if (terms and not wordTerms):
+                return []
+            candidates = None
+            if (self.wordIndex and wordTerms):
+                for word in wordTerms:
+                    positions = set(self.lookup("words",
+                                                zlib.crc32(word.encode("utf-8"))))
+                    if (candidates is None):
+                        candidates = positions
+                    else:
+                        candidates &= positions
+                    if (not candidates):
+                        return []
+            for key in (channel, nick):
+                if (key is not None):
+                    positions = set(self.lookup("keys", key_hash(key)))
+                    if (candidates is None):
+                        candidates = positions
+                    else:
+                        candidates &= positions
+            start = (0, 0)
+            if (since is not None):
+                start = self.find_time(since)
+            if (candidates is None):
+                candidates = self.scan(start)
+            else:
+                candidates = sorted(p for p in candidates if p >= start)
+            records = []
+            for position in reversed(candidates):
+                record = self.read(position)
+                if (record is None or not self.matches(record, wordTerms,
+                                                       channel, nick, since)):
+                    continue
+                records.append(record)
+                if (len(records) == limit):
+                    break
+            records.reverse()
+            return records
+
+    def matches(self, record, wordTerms, channel, nick, since):
+        # Check a message against a search: wordTerms must be among its words
+        # (as returned by words()).
+        if (channel is not None and
+            irc_lower(record.channel) != irc_lower(channel)):
+            return False
+        if (nick is not None and irc_lower(record.nick) != irc_lower(nick)):
+            return False
+        if (since is not None and record.time < since):
+            return False
+        return not wordTerms or words(record.text).issuperset(wordTerms)
+
+    def scan(self, start):
+        # Return the positions of every message from the given one onwards, in
+        # order (used to search without a word index).
+        positions = []
+        for segment in self.list_segments():
+            if (segment < start[0]):
+                continue
+            mm = self.map_file(self.segment_path(segment))
+            if (mm is None):
+                continue
+            try:
+                offset = start[1] if segment == start[0] else 0
+                while (offset < len(mm)):
+                    positions.append((segment, offset))
+                    end = mm.find(b"\n", offset)
+                    if (end == -1):
+                        break
+                    offset = end + 1
+            finally:
+                mm.close()
+        return positions
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Logging of server traffic and chat to disk. All file access happens on a
+# background thread, so a slow disk never holds up message handling.
+
+import atexit
+import datetime
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+
+class Logger:
+    # Writes log records to one file per network and channel, below the given
+    # directory (e.g. logs/irc.freenode.net/#pynapple.log). Files are opened
+    # for appending, so logs survive restarts.
+    #
+    # log() only puts a record on a bounded queue; a writer thread collects
+    # the records and writes them out in batches, once flushInterval seconds
+    # have passed or flushSize bytes are waiting, whichever comes first. If
+    # the writer falls so far behind that the queue fills up, new records are
+    # thrown away (and counted) rather than blocking the caller.
+    #
+    # A file is rotated (renamed with a timestamp added to its name) once it
+    # grows beyond maxFileSize bytes, or with rotateDaily set, when it was
+    # last written on an earlier day. With compress set, rotated files are
+    # gzipped as well. Both happen on the writer thread.
+    def __init__(self, directory="logs", queueSize=10000, flushInterval=1.0,
+                 flushSize=65536, maxFileSize=10 * 1024 * 1024,
+                 rotateDaily=False, compress=False):
+        self.directory = directory
+        self.flushInterval = flushInterval
+        self.flushSize = flushSize
+        self.maxFileSize = maxFileSize
+        self.rotateDaily = rotateDaily
+        self.compress = compress
+        self.queue = queue.Queue(queueSize)
+        self.paths = {}    # (network, name) -> path of the log file
+        self.files = {}    # path -> [open file, size, date last written]
+        self.thread = None
+        self.closed = False
+        self.queued = 0    # records accepted by log()
+        self.dropped = 0   # records thrown away because the queue was full
+        self.written = 0   # records written to disk
+        self.flushes = 0   # batches written
+        self.rotations = 0
+        self.errors = 0    # failed writes or rotations
+
+    def start(self):
+        # Start the writer thread. Whatever is still queued when the program
+        # exits without calling close() gets a second to be written out.
+        if (self.thread is None):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+            atexit.register(self.close, 1.0)
+
+    def log(self, network, name, s):
+        # Queue a line of text for the log of the given network and channel
+        # (or other buffer name). Returns False if the record was dropped.
+        if (self.closed):
+            return False
+        path = self.paths.get((network, name))
+        if (path is None):
+            path = self.get_path(network, name)
+        try:
+            self.queue.put_nowait((path, s))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        if (self.thread is None):
+            self.start()
+        return True
+
+    def get_path(self, network, name):
+        # Work out (and remember) the file a network and channel are logged to.
+        # Characters that can't appear in file names are replaced.
+        parts = []
+        for part in (network, name):
+            part = part.replace(os.sep, "_").replace("\0", "_")
+            if (part in ("", ".", "..")):
+                part = "_" + part
+            parts.append(part)
+        path = os.path.join(self.directory, parts[0], parts[1] + ".log")
+        self.paths[(network, name)] = path
+        return path
+
+    def get_queued(self):
+        # Return the number of records waiting to be written.
+        return self.queue.qsize()
+
+    def get_stats(self):
+        return {"queued": self.queued, "pending": self.get_queued(),
+                "written": self.written, "dropped": self.dropped,
+                "flushes": self.flushes, "rotations": self.rotations,
+                "errors": self.errors}
+
+    def close(self, timeout=None):
+        # Stop accepting records, and wait for everything already queued to be
+        # written out (for at most timeout seconds, if given). Returns True if
+        # the queue was drained.
+        if (self.closed):
+            return self.thread is None or not self.thread.is_alive()
+        self.closed = True
+        if (self.thread is None):
+            return True
+        self.queue.put(None) # (blocks until there's room, unlike log())
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def run(self):
+        # The writer thread: collect records in to per-file batches, and write
+        # them out whenever enough time has passed or enough data is waiting.
+        batches = {} # path -> list of lines
+        waiting = 0  # bytes (roughly) waiting to be written
+        deadline = None
+        running = True
+        while (running):
+            timeout = None
+            if (deadline is not None):
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(True, timeout)
+            except queue.Empty:
+                record = False
+            if (record is None):
+                running = False
+            elif (record):
+                path, s = record
+                batches.setdefault(path, []).append(s)
+                waiting += len(s) + 1
+                if (deadline is None):
+                    deadline = time.monotonic() + self.flushInterval
+                if (waiting < self.flushSize):
+                    continue
+            if (batches):
+                self.flush(batches)
+                batches = {}
+                waiting = 0
+            deadline = None
+        for f, size, date in self.files.values():
+            f.close()
+        self.files = {}
+
+    def flush(self, batches):
+        # Write out a batch of lines for each file, rotating files first where
+        # necessary.
+        today = datetime.date.today()
+        for path, lines in batches.items():
+            data = "\n".join(lines) + "\n"
+            try:
+                entry = self.get_file(path, today)
+                if (entry[1] > 0 and (entry[1] + len(data) > self.maxFileSize or
+                                      entry[2] != today)):
+                    self.rotate(path, entry)
+                    entry = self.get_file(path, today)
+                entry[0].write(data)
+                entry[0].flush()
+                entry[1] = entry[0].tell()
+                entry[2] = today
+                self.written += len(lines)
+            except (OSError, ValueError):
+                self.errors += 1
+        self.flushes += 1
+
+    def get_file(self, path, today):
+        # Return the [file, size, date] entry for an open log file, opening the
+        # file (and creating its directory) if necessary.
+        entry = self.files.get(path)
+        if (entry is None):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, "a", encoding="utf-8", errors="replace")
+            date = today
+            size = f.tell()
+            if (size > 0):
+                date = datetime.date.fromtimestamp(os.stat(path).st_mtime)
+            entry = [f, size, date]
+            self.files[path] = entry
+        if (not self.rotateDaily):
+            entry[2] = today
+        return entry
+
+    def rotate(self, path, entry):
+        # Close a log file and move it out of the way, so that the next write
+        # starts a new one.
+        entry[0].close()
+        del self.files[path]
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        if (self.rotateDaily and entry[2] != datetime.date.today()):
+            stamp = entry[2].strftime("%Y%m%d")
+        target = path + "." + stamp
+        n = 1
+        while (os.path.exists(target) or os.path.exists(target + ".gz")):
+            target = "%s.%s.%d" % (path, stamp, n)
+            n += 1
+        os.rename(path, target)
+        self.rotations += 1
+        if (self.compress):
+            with open(target, "rb") as src:
+                with gzip.open(target + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+            os.remove(target)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Word matching used to censor and highlight messages.
+
+import re
+
+def trie_pattern(words):
+    # Build a regular expression matching any of the given words. Rather than
+    # a plain alternation (which the regex engine tries one word at a time,
+    # at every position of the string), the words are merged in to a trie
+    # first, so that each position costs about one step per character matched,
+    # however many words there are. Longer words are preferred over their
+    # prefixes.
+    trie = {}
+    for word in words:
+        if (not word):
+            continue
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[""] = True
+    if (not trie):
+        return "(?!)" # (matches nothing)
+    return trie_node_pattern(trie)
+
+def trie_node_pattern(node):
+    # Return the pattern for the words below a trie node, or None if the node
+    # only marks the end of a word.
+    if ("" in node and len(node) == 1):
+        return None
+    alternatives = []
+    chars = []
+    for c in sorted(k for k in node if k != ""):
+        sub = trie_node_pattern(node[c])
+        if (sub is None):
+            chars.append(re.escape(c))
+        else:
+            alternatives.append(re.escape(c) + sub)
+    charsOnly = not alternatives
+    if (len(chars) == 1):
+        alternatives.append(chars[0])
+    elif (chars):
+        alternatives.append("[" + "".join(chars) + "]")
+    if (len(alternatives) == 1):
+        pattern = alternatives[0]
+    else:
+        pattern = "(?:" + "|".join(alternatives) + ")"
+    if ("" in node):
+        if (charsOnly):
+            pattern += "?"
+        else:
+            pattern = "(?:" + pattern + ")?"
+    return pattern
+
+class Matcher:
+    # Finds the words to censor and the words to highlight in a message with
+    # two regular expression searches, each compiled once from its list. In
+    # the usual case, where a message contains none of the words, those
+    # searches are all it costs. The lists are kept apart so that a word in
+    # one of them can't hide a word in the other (e.g. a word to censor that
+    # starts a longer word to highlight, such as part of our own nick).
+    #
+    # Words can optionally be matched only as whole words, and/or without
+    # regard to case. Where words to censor overlap, all of them are censored.
+    def __init__(self, censorWords, hiliteWords, wholeWords=False,
+                 ignoreCase=False):
+        self.censorRegex = self.compile(censorWords, wholeWords, ignoreCase)
+        self.hiliteRegex = self.compile(hiliteWords, wholeWords, ignoreCase)
+
+    def compile(self, words, wholeWords, ignoreCase):
+        pattern = trie_pattern(words)
+        if (wholeWords):
+            pattern = r"(?<!\w)(?:" + pattern + r")(?!\w)"
+        flags = 0
+        if (ignoreCase):
+            flags = re.IGNORECASE
+        return re.compile(pattern, flags)
+
+    def process(self, s, hiliteFrom=0):
+        # Return the given string with words to censor replaced by asterisks,
+        # and whether it contains any word to highlight. Only words starting
+        # at or after position hiliteFrom count for highlighting (a negative
+        # value turns highlighting off).
+        hilite = (hiliteFrom >= 0 and
+                  self.hiliteRegex.search(s, hiliteFrom) is not None)
+        m = self.censorRegex.search(s)
+        if (m is None):
+            return s, hilite
+        parts = []
+        last = 0
+        while (m is not None):
+            # Matches may overlap, so look again from the next position.
+            start, end = m.span()
+            if (end > last):
+                parts.append(s[last:start])
+                parts.append("*" * (end - max(start, last)))
+                last = end
+            m = self.censorRegex.search(s, start + 1)
+        parts.append(s[last:])
+        return "".join(parts), hilite
+
+    def censor(self, s):
+        # Return the given string with words to censor replaced by asterisks.
+        return self.process(s, -1)[0]
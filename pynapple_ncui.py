@@ -1,13 +1,46 @@
+import bisect
 import curses
+import os
+import selectors
+import signal
+import sys
+import time
 
 class UserInterfacePlugin:
     # Uses the curses terminal handling library to display a chat log,
     # a list of users in the current channel, and a command prompt for
     # entering messages and application commands.
+    #
+    # Changes to the windows aren't drawn straight away. Instead update()
+    # marks the screen as dirty, and the screen is redrawn at most maxRefreshRate
+    # times per second, however many messages arrive in between. Keys typed in
+    # to the input window are still echoed immediately.
+    #
+    # Nothing is polled: the main loop sleeps in a selector until a key is
+    # pressed, a socket thread signals new messages, the terminal is resized
+    # (SIGWINCH), or a put-off refresh is due.
+    maxRefreshRate = 30 # screen refreshes per second, at most
+
     def __init__(self, irc, kb):
         self.ircHandle = irc
         self.kbHandle = kb
         self.buf = ""
+        self.dirty = False
+        self.lastRefresh = 0.0
+        self.refreshTimer = None
+        self.refreshes = 0        # screen refreshes performed
+        self.skippedRefreshes = 0 # update requests folded in to a later refresh
+        self.scrollback = None    # RingBuffer of the lines in the chat window
+        self.scrollOffset = 0     # lines scrolled back from the newest one
+        self.chatDirty = False
+        self.resized = False
+        self.nicks = []           # shown in the nick-list window...
+        self.nicklist = None      # ... unless this NickList is given
+        self.nickOffset = 0       # nick-list rows scrolled past
+        self.nickDirty = False    # the nick-list window needs redrawing
+        self.nickCountDirty = False # ... or only its count of users
+        self.wakeups = 0          # times the main loop woke up
+        self.lag = 0.0            # seconds behind the server, if shown
         curses.setupterm()
         self.colors = curses.tigetnum("colors")
         self.screen = curses.initscr()
@@ -34,9 +67,71 @@ class UserInterfacePlugin:
         self.clear_input_window() # also puts the cursor in the input window
 
     def run(self):
+        engine = self.ircHandle.get_engine()
+        if (engine is not None):
+            # Let the asyncio engine drive everything: network messages are
+            # handled as they arrive, and keys whenever stdin is readable.
+            engine.add_reader(sys.stdin.fileno(), self.read_keys)
+            if (hasattr(signal, "SIGWINCH")):
+                engine.add_signal_handler(signal.SIGWINCH, self.resize)
+            engine.run()
+        else:
+            self.run_selector()
+
+    def run_selector(self):
+        # The main loop used with the threaded engine. Blocks until stdin is
+        # readable, the socket threads have queued messages, or the terminal
+        # has been resized, with a timeout only while a refresh is put off (or
+        # messages are left over from a poll that ran out of budget).
+        wakeup = self.ircHandle.get_wakeup()
+        selector = selectors.DefaultSelector()
+        selector.register(sys.stdin.fileno(), selectors.EVENT_READ, self.read_keys)
+        selector.register(wakeup.fileno(), selectors.EVENT_READ, None)
+        if (hasattr(signal, "SIGWINCH")):
+            # The signal handler only sets a flag and pokes the wakeup pipe;
+            # the resize itself is dealt with here, outside of the handler.
+            signal.signal(signal.SIGWINCH, self.on_sigwinch)
         while (True):
-            self.ircHandle.poll()
-            self.poll_kb()
+            timeout = None
+            if (self.ircHandle.get_backlog() > 0):
+                timeout = 0
+            elif (self.dirty):
+                due = self.lastRefresh + 1.0 / self.maxRefreshRate
+                timeout = max(0, due - time.monotonic())
+            for key, events in selector.select(timeout):
+                if (key.data is not None):
+                    key.data()
+            self.wakeups += 1
+            if (self.resized):
+                self.resize()
+            self.ircHandle.poll(0)
+            self.refresh_if_due()
+
+    def on_sigwinch(self, signum, frame):
+        # No locks may be taken here: the main thread may be holding them.
+        self.resized = True
+        self.ircHandle.get_wakeup().poke()
+
+    def resize(self):
+        # The terminal has been resized: let curses know the new size, and lay
+        # out and redraw the windows to fit.
+        self.resized = False
+        try:
+            size = os.get_terminal_size(sys.stdout.fileno())
+            curses.resizeterm(size.lines, size.columns)
+        except (OSError, curses.error):
+            pass
+        self.resize_window()
+        self.screen.clear()
+        self.nickDirty = True
+        if (self.debugEnabled):
+            self.ircHandle.refresh_debug() # refill the new window
+        self.update_status()
+
+    def read_keys(self):
+        # Handle every key waiting on stdin.
+        while (self.poll_kb()):
+            pass
 
     def poll_kb(self):
         # Detect keys pressed on the keyboard, and assemble a string, character
@@ -49,6 +144,7 @@ class UserInterfacePlugin:
         # network in real time. To work around this, we use curses' cbreak()
         # function which causes its keyboard routines to return immediately.
         # A side effect of this is that we must continuously poll for characters.
+        # Returns True if a key was read.
         keycode = self.inputWin.getch()
         if (keycode >= 0):
             if (keycode == 10):
@@ -57,7 +153,7 @@ class UserInterfacePlugin:
                     self.kbHandle.parse_input(self.buf)
                     self.buf = ""
                     self.clear_input_window()
-            elif (keycode == 127):
+            elif (keycode == 127 or keycode == curses.KEY_BACKSPACE):
                 # The backspace key was pressed.
                 # Note: curses.KEY_BACKSPACE is listed as "unreliable" in the
                 # curses+python documentation. I have found this to be true when
@@ -70,6 +166,18 @@ class UserInterfacePlugin:
             elif ((keycode >= 32) and (keycode < 127)):
                 self.buf = self.buf + chr(keycode)
                 self.inputWin.addch(keycode)
+            elif (keycode == curses.KEY_PPAGE):
+                self.scroll_chat(self.chatWinH - 1)
+            elif (keycode == curses.KEY_NPAGE):
+                self.scroll_chat(1 - self.chatWinH)
+            elif (keycode == curses.KEY_SPREVIOUS): # shift + page up
+                self.scroll_nicks(2 - self.nickWinH)
+            elif (keycode == curses.KEY_SNEXT): # shift + page down
+                self.scroll_nicks(self.nickWinH - 2)
+            elif (keycode == curses.KEY_RESIZE):
+                self.resize()
+            self.inputWin.refresh() # echo right away, whatever else is dirty
+        return keycode >= 0
 
     def make_windows(self):
         # Create the curses windows we'll be using to display text.
@@ -93,11 +201,12 @@ class UserInterfacePlugin:
                                     self.dbgWinW-2,
                                     self.dbgWinY+1,
                                     self.dbgWinX+1)
-        self.chatWin.move(self.chatWinH-1, 0)
-        self.chatWin.scrollok(1)
         self.nickWin.scrollok(1)
         self.inputWin.scrollok(1)
         self.inputWin.nodelay(1)
+        self.inputWin.keypad(1) # deliver PageUp/PageDown as single keys
+        self.chatDirty = True
+        self.nickDirty = True
         self.dbgWin.scrollok(1)
         self.debugEnabled = False
 
@@ -118,31 +227,78 @@ class UserInterfacePlugin:
 
     def resize_window(self):
         # Handle a change in window size by recreating the curses windows based
-        # on the current window size, and then refresh the screen.
+        # on the current window size.
+        debugEnabled = self.debugEnabled
         self.update_geometry()
         self.make_windows()
-        self.update()
+        self.debugEnabled = debugEnabled
 
     def update(self):
+        # Ask for the screen to be redrawn. Happens right away unless the
+        # screen was refreshed less than 1/maxRefreshRate seconds ago, in which
+        # case the redraw is put off until then, picking up any other changes
+        # made in the meantime.
+        self.dirty = True
+        if (not self.refresh_if_due()):
+            self.skippedRefreshes += 1
+            engine = self.ircHandle.get_engine()
+            if (engine is not None and self.refreshTimer is None):
+                # Nobody polls us when the asyncio engine is running the show,
+                # so arrange to be called back once the refresh is due.
+                wait = self.lastRefresh + 1.0 / self.maxRefreshRate
+                self.refreshTimer = engine.call_later(wait - time.monotonic(),
+                                                      self.refresh_timer)
+
+    def refresh_if_due(self):
+        # Redraw the screen if it is dirty and a refresh is allowed by now.
+        # Returns True if the screen is up to date.
+        if (self.dirty):
+            if (time.monotonic() - self.lastRefresh < 1.0 / self.maxRefreshRate):
+                return False
+            self.redraw()
+        return True
+
+    def refresh_timer(self):
+        self.refreshTimer = None
+        self.refresh_if_due()
+
+    def get_refresh_stats(self):
+        # Return the number of screen refreshes performed, and the number of
+        # update requests that were folded in to a later refresh.
+        return self.refreshes, self.skippedRefreshes
+
+    def redraw(self):
         # Redraw the contents of the screen.
-        h, w = self.screen.getmaxyx()
-        if ((w != self.screenW) or (h != self.screenH)):
-            self.resize_window()
+        self.dirty = False
+        self.lastRefresh = time.monotonic()
+        self.refreshes += 1
         self.screen.attron(self.borderPair)
         self.screen.hline(self.chatWinH, 0, curses.ACS_HLINE, self.screenW)
         self.screen.vline(0, self.chatWinW, curses.ACS_VLINE, self.chatWinH)
         self.screen.addch(self.chatWinH, self.chatWinW, curses.ACS_BTEE)
+        if (self.scrollOffset > 0):
+            self.screen.addstr(self.chatWinH, 2,
+                               " scrolled back %d lines " % self.scrollOffset)
+        if (self.lag > 0):
+            s = " lag %.1fs " % self.lag
+            if (len(s) + 2 < self.chatWinW):
+                self.screen.addstr(self.chatWinH, self.chatWinW - len(s) - 1,
+                                   s, curses.A_REVERSE)
+        if (self.chatDirty):
+            self.render_chat()
+        if (self.nickDirty or self.nickCountDirty):
+            self.render_nicks()
         # Curses doesn't show changes in a window until you refresh it.
-        self.screen.nooutrefresh()
-        self.chatWin.nooutrefresh()
-        self.nickWin.nooutrefresh()
+        self.screen.noutrefresh()
+        self.chatWin.noutrefresh()
+        self.nickWin.noutrefresh()
         self.inputWin.noutrefresh()
         if (self.debugEnabled):
             self.dbgBorder.attron(self.borderPair)
             self.dbgBorder.border(0)
-            self.dbgBorder.nooutrefresh()
+            self.dbgBorder.noutrefresh()
             self.dbgWin.redrawwin()
-            self.dbgWin.nooutrefresh()
+            self.dbgWin.noutrefresh()
         curses.doupdate()
 
     def clear_input_window(self):
@@ -152,17 +308,83 @@ class UserInterfacePlugin:
         self.inputWin.addstr(self.ircHandle.get_nick() +
                              "@" + self.ircHandle.get_channel() + "> ")
 
+    def update_status(self):
+        # Redraw the input prompt, which shows our nick and current channel,
+        # keeping whatever has been typed so far.
+        self.inputWin.move(0, 0)
+        self.inputWin.deleteln()
+        self.inputWin.addstr(self.ircHandle.get_nick() +
+                             "@" + self.ircHandle.get_channel() + "> " + self.buf)
+        self.update()
+
+    def set_scrollback(self, lines):
+        # Show the given RingBuffer of (message, color, hilite) records in the
+        # chat window, i.e. switch to another buffer.
+        self.scrollback = lines
+        self.scrollOffset = 0
+        self.chatDirty = True
+        self.update()
+
     def add_message(self, s, color, hilite):
-        # Add a message in the chat window, using the given color.
-        pair = curses.color_pair(color)
-        if (hilite):
-            pair = pair | curses.A_REVERSE
-        self.chatWin.addstr("\n" + s, pair)
+        # A message has been added to the scrollback shown in the chat window.
+        # It is drawn along with any others at the next screen refresh. If the
+        # user has scrolled back, the view stays where it is.
+        if (self.scrollOffset > 0):
+            self.scroll_chat(1)
+        self.chatDirty = True
+        self.update()
+
+    def set_lag(self, seconds):
+        # Show how many seconds behind the server the display is (on the
+        # border under the chat window), or nothing if 0.
+        self.lag = seconds
+        self.update()
+
+    def scroll_chat(self, n):
+        # Scroll the chat window back by n lines (forward, if negative).
+        if (self.scrollback is None):
+            return
+        limit = max(0, len(self.scrollback) - 1)
+        self.scrollOffset = min(max(0, self.scrollOffset + n), limit)
+        self.chatDirty = True
         self.update()
 
+    def render_chat(self):
+        # Draw the part of the scrollback visible in the chat window. Only
+        # those lines are looked at, however long the scrollback is; lines
+        # too long for the window wrap on to the next row.
+        self.chatDirty = False
+        self.chatWin.erase()
+        if (self.scrollback is None):
+            return
+        end = len(self.scrollback) - self.scrollOffset
+        rows = 0
+        start = end
+        while (start > 0 and rows < self.chatWinH):
+            start -= 1
+            rows += self.wrapped_rows(self.scrollback[start][0])
+        y = self.chatWinH - rows # negative if the top line is cut off
+        for s, color, hilite in self.scrollback.slice(start, end):
+            n = self.wrapped_rows(s)
+            if (y < 0):
+                s = s[-y * self.chatWinW:]
+                n += y
+                y = 0
+            pair = curses.color_pair(color)
+            if (hilite):
+                pair = pair | curses.A_REVERSE
+            try:
+                self.chatWin.addstr(y, 0, s, pair)
+            except curses.error:
+                pass # writing the bottom right corner always "fails"
+            y += n
+
+    def wrapped_rows(self, s):
+        # Return the number of rows a line takes up in the chat window.
+        return max(1, (len(s) + self.chatWinW - 1) // self.chatWinW)
+
     def add_debug_message(self, s):
-        # Add a message to the debug window. The message will be added to the
-        # debug window, even if the debug window itself isn't currently visible.
+        # Add a message to the debug window. Only called while it is shown.
         if (self.haveColor):
             self.dbgWin.addstr("\n" + s, self.debugPair)
         else:
@@ -170,15 +392,91 @@ class UserInterfacePlugin:
         if (self.debugEnabled):
             self.update()
 
+    def set_debug_lines(self, lines):
+        # Replace the contents of the debug window with the given messages. The
+        # window only has room for the last few.
+        self.dbgWin.erase()
+        for s in lines[-(self.dbgWinH - 2):]:
+            self.add_debug_message(s)
+
     def set_nicklist(self, a):
-        # Populate the nick-list with an alphabetically sorted array of nicks.
-        self.nickWin.clear()
-        nicks = sorted(a)[:self.nickWinH]
-        for i, nick in enumerate(nicks):
-            self.nickWin.move(i, 0)
-            self.nickWin.addstr(self.truncate_name(nick))
+        # Populate the nick-list with a sorted array of nicks.
+        self.nicks = a
+        self.nicklist = None
+        self.nickOffset = 0
+        self.nickDirty = True
         self.update()
 
+    def update_nicklist(self, nicklist, added, removed):
+        # Apply a change to the nick-list. The nicks added and removed are
+        # given along with the complete, updated NickList, from which the
+        # window is drawn from then on. Only the rows in view are ever drawn
+        # (see render_nicks()), and only if one of the changes is among them
+        # or above them, as found by bisecting; otherwise just the count of
+        # users is redrawn.
+        if (nicklist is not self.nicklist):
+            self.nicklist = nicklist
+            self.nicks = None
+            self.nickDirty = True
+        elif (not self.nickDirty):
+            end = self.nickOffset + self.nickWinH - 1 # past the last row shown
+            order = nicklist.order
+            for name in added + removed:
+                if (bisect.bisect_left(order, nicklist.display_key(name)) < end):
+                    self.nickDirty = True
+                    break
+            else:
+                self.nickCountDirty = True
+        self.update()
+
+    def nick_count(self):
+        if (self.nicklist is not None):
+            return len(self.nicklist)
+        return len(self.nicks)
+
+    def scroll_nicks(self, n):
+        # Scroll the nick-list window down by n rows (up, if negative).
+        self.nickOffset += n
+        self.nickDirty = True
+        self.update()
+
+    def render_nicks(self):
+        # Draw the nick-list window: a line counting the users (and saying
+        # which of them are shown, if they don't all fit), then the names in
+        # view. Only those names are looked at, however many users there are.
+        count = self.nick_count()
+        rows = self.nickWinH - 1
+        offset = max(0, min(self.nickOffset, count - rows))
+        if (offset != self.nickOffset):
+            self.nickOffset = offset
+            self.nickDirty = True
+        start = self.nickOffset
+        end = min(start + rows, count)
+        if (count > rows):
+            header = "%d-%d/%d" % (start + 1, end, count)
+            if (len(header) >= self.nickWinW):
+                header = "%d/%d" % (start + 1, count)
+        else:
+            header = "%d users" % count
+        self.nickCountDirty = False
+        if (not self.nickDirty):
+            self.nickWin.move(0, 0)
+            self.nickWin.clrtoeol()
+            self.nickWin.addstr(0, 0, self.truncate_name(header), curses.A_BOLD)
+            return
+        self.nickDirty = False
+        self.nickWin.erase()
+        self.nickWin.addstr(0, 0, self.truncate_name(header), curses.A_BOLD)
+        if (self.nicklist is not None):
+            names = self.nicklist.names(start, end)
+        else:
+            names = self.nicks[start:end]
+        for i, name in enumerate(names):
+            self.nickWin.addstr(i + 1, 0, self.truncate_name(name))
+
+    def get_max_colors(self):
+        return max(1, self.colors)
+
     def init_colors(self):
         # Called once during program initialization to generate the logical
         # color pairs used by curses in order to display strings in color.
@@ -196,6 +494,7 @@ class UserInterfacePlugin:
         self.chatWin.touchwin()
         self.nickWin.touchwin()
         self.dbgWin.touchwin()
+        self.ircHandle.set_debug_shown(self.debugEnabled)
         self.update()
 
     def truncate_name(self, s):
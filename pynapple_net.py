@@ -0,0 +1,1010 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Network plumbing shared by the connection code in pynapple.py. Nothing in
+# here touches the user interface, so it can be imported (and benchmarked) on
+# its own.
+
+import asyncio
+import collections
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+from pynapple_proto import command_of, irc_lower
+from pynapple_stats import Histogram
+
+class LineFramer:
+    # Assembles logical IRC messages from the raw byte stream received from a
+    # server. Incoming data is read straight in to one large, reusable buffer
+    # (no per-read allocation), and only bytes that haven't been scanned yet
+    # are searched for line terminators, so a long line arriving in many small
+    # pieces costs linear rather than quadratic time.
+    #
+    # Lines are decoded only once they are complete, which means a multibyte
+    # character can never be split across two reads. Lines that aren't valid
+    # in the preferred encoding are decoded using the fallback encoding
+    # instead (latin-1 by default, which accepts any byte sequence), as many
+    # older clients and servers still send legacy 8-bit text.
+    #
+    # Lines longer than maxLineLength bytes are truncated to that length and
+    # the remainder (up to the next line terminator) is thrown away.
+    def __init__(self, bufferSize=65536, maxLineLength=8704,
+                 encoding="utf-8", fallbackEncoding="latin-1"):
+        if (maxLineLength >= bufferSize):
+            raise ValueError("maxLineLength must be smaller than bufferSize")
+        self.buf = bytearray(bufferSize)
+        self.view = memoryview(self.buf)
+        self.maxLineLength = maxLineLength
+        self.encoding = encoding
+        self.fallbackEncoding = fallbackEncoding
+        self.start = 0          # start of the first incomplete line
+        self.end = 0            # end of the data received so far
+        self.scan = 0           # where to resume looking for a line terminator
+        self.discarding = False # skipping the tail of an over-long line
+        self.bytesReceived = 0
+        self.linesFramed = 0
+        self.linesTruncated = 0
+        self.fallbackDecodes = 0
+
+    def make_room(self):
+        # Move any partial line to the front of the buffer so that there is
+        # space to receive more data after it.
+        if (self.start > 0):
+            n = self.end - self.start
+            self.buf[0:n] = self.buf[self.start:self.end]
+            self.scan -= self.start
+            self.start = 0
+            self.end = n
+
+    def fill(self, sock):
+        # Receive as much data as will fit from the given socket directly in to
+        # our buffer. Returns the number of bytes read; zero means the remote
+        # end closed the connection.
+        if (self.end == len(self.buf)):
+            self.make_room()
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        self.bytesReceived += n
+        return n
+
+    def feed(self, data):
+        # Add a chunk of already-received data (e.g. from an asyncio protocol)
+        # and return a list of all lines completed by it.
+        lines = []
+        data = memoryview(data)
+        while (len(data) > 0):
+            if (self.end == len(self.buf)):
+                self.make_room()
+            n = min(len(data), len(self.buf) - self.end)
+            self.view[self.end:self.end + n] = data[:n]
+            self.end += n
+            self.bytesReceived += n
+            data = data[n:]
+            lines.extend(self.lines())
+        return lines
+
+    def lines(self):
+        # Return a list of complete lines found in the newly received data,
+        # decoded and stripped of their line terminators. Empty lines are
+        # skipped. Only the bytes received since the last call are searched,
+        # and all complete lines are split and decoded in one go.
+        lines = []
+        eol = self.buf.rfind(b"\n", self.scan, self.end)
+        if (eol != -1):
+            if (self.discarding):
+                # Drop the rest of an over-long line.
+                self.start = self.buf.find(b"\n", self.scan, eol + 1) + 1
+                self.discarding = False
+            if (eol > self.start):
+                lines = self.split(self.buf[self.start:eol])
+            self.start = eol + 1
+        self.scan = self.end
+        if (self.end - self.start >= self.maxLineLength):
+            # No line terminator in sight; keep what fits and skip the rest.
+            if (not self.discarding):
+                stop = self.start + self.maxLineLength
+                lines.append(self.decode(self.buf[self.start:stop]))
+                self.linesTruncated += 1
+                self.discarding = True
+            self.start = self.scan = self.end
+        if (self.start == self.end):
+            self.start = self.scan = self.end = 0
+        self.linesFramed += len(lines)
+        return lines
+
+    def split(self, data):
+        # Split a block of complete lines (without its final line terminator).
+        # The common case, where the whole block is valid in the preferred
+        # encoding and no line can possibly be too long (a character is never
+        # more than four bytes), is handled by a few calls in to C. Stray CRs
+        # are dropped along with those ending each line, as they aren't
+        # allowed anywhere in an IRC message.
+        try:
+            lines = str(data, self.encoding).replace("\r", "").split("\n")
+        except UnicodeDecodeError:
+            lines = None
+        if (lines is not None and
+                max(map(len, lines)) * 4 <= self.maxLineLength):
+            if ("" in lines):
+                lines = [x for x in lines if x != ""]
+            return lines
+        lines = []
+        for part in data.split(b"\n"):
+            part = part.replace(b"\r", b"")
+            if (len(part) > self.maxLineLength):
+                part = part[:self.maxLineLength]
+                self.linesTruncated += 1
+            if (part):
+                lines.append(self.decode(part))
+        return lines
+
+    def decode(self, b):
+        # Decode a single line, trying the preferred encoding first.
+        try:
+            return str(b, self.encoding)
+        except UnicodeDecodeError:
+            self.fallbackDecodes += 1
+            return str(b, self.fallbackEncoding, "replace")
+
+    def pending(self):
+        # Return the number of bytes buffered that aren't part of a line yet.
+        return self.end - self.start
+
+class WakeupPipe:
+    # A flag like threading.Event, that a thread sets to say new data is
+    # waiting, but which can also be watched with select() (or a selector,
+    # or Tk's createfilehandler()) along with other file descriptors, so
+    # that the UI thread can sleep until there's something to do. Setting
+    # the flag writes a byte to a socket pair; clearing it reads it back.
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+        self.flag = False
+        self.setAt = 0.0 # time.monotonic() when the flag was last set
+        self.lock = threading.Lock()
+
+    def fileno(self):
+        # The descriptor to watch; readable while the flag is set.
+        return self.reader.fileno()
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        with self.lock:
+            if (not self.flag):
+                self.flag = True
+                self.setAt = time.monotonic()
+                try:
+                    self.writer.send(b"x")
+                except OSError:
+                    pass # (full, so readable anyway)
+
+    def poke(self):
+        # Wake up whoever is watching the descriptor without setting the flag.
+        # Takes no lock, so it is safe to call from a signal handler (which
+        # runs on the main thread, maybe while it is in set() or clear()).
+        try:
+            self.writer.send(b"x")
+        except OSError:
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.flag = False
+            try:
+                while (self.reader.recv(4096)):
+                    pass
+            except OSError:
+                pass
+
+    def wait(self, timeout=None):
+        # Wait for the flag to be set, for up to timeout seconds. Returns the
+        # flag.
+        if (not self.flag):
+            select.select([self.reader], [], [], timeout)
+        return self.flag
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+class AddressCache:
+    # Remembers the addresses that host names resolved to for cacheTime
+    # seconds, so that reconnecting doesn't wait for DNS again. If resolving
+    # fails, an expired entry is used rather than nothing. Safe to use from
+    # any thread.
+    cacheTime = 300.0
+
+    def __init__(self):
+        self.entries = {} # (host, port) -> (time resolved, getaddrinfo() list)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        # Return the addresses for a host name and port, as returned by
+        # getaddrinfo(), and whether they came from the cache. Blocks while
+        # resolving; raises OSError if that fails.
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None and now - entry[0] < self.cacheTime):
+                self.hits += 1
+                return entry[1], True
+            self.misses += 1
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except OSError:
+            if (entry is not None):
+                return entry[1], True
+            raise
+        with self.lock:
+            self.entries[key] = (now, infos)
+        return infos, False
+
+    def forget(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+def format_address(address):
+    # Return a socket address as text, with IPv6 addresses in brackets.
+    if (":" in address[0]):
+        return "[%s]:%d" % address[:2]
+    return "%s:%d" % address[:2]
+
+def interleave(infos):
+    # Order addresses as RFC 8305 suggests, alternating between address
+    # families, starting with the first one returned (which is the system's
+    # preference).
+    families = collections.OrderedDict()
+    for info in infos:
+        families.setdefault(info[0], []).append(info)
+    ordered = []
+    while (families):
+        for family in list(families):
+            ordered.append(families[family].pop(0))
+            if (not families[family]):
+                del families[family]
+    return ordered
+
+# connect_ex() results meaning the connection is on its way.
+connectInProgress = (0, errno.EINPROGRESS, errno.EWOULDBLOCK,
+                     getattr(errno, "WSAEWOULDBLOCK", errno.EWOULDBLOCK))
+
+def open_connection(infos, attemptDelay=0.25, timeout=10.0, progress=None):
+    # Connect to whichever of the given addresses (a getaddrinfo() list)
+    # answers first, "Happy Eyeballs" style (RFC 8305): attempts are started
+    # attemptDelay seconds apart, or as soon as the previous one fails, and
+    # race each other. Returns the connected (blocking) socket and its
+    # address, once one attempt has succeeded, having closed the others.
+    # Raises OSError if none succeed within timeout seconds. progress(s) is
+    # called with a description of each attempt and failure. Blocks, so
+    # must be run on a thread other than the UI's.
+    pending = interleave(infos)
+    attempts = {} # socket -> address, for connections in progress
+    deadline = time.monotonic() + timeout
+    nextAttempt = 0.0
+    error = None
+    try:
+        while (pending or attempts):
+            now = time.monotonic()
+            if (now >= deadline):
+                raise TimeoutError("connection timed out")
+            if (pending and (not attempts or now >= nextAttempt)):
+                family, kind, proto, name, address = pending.pop(0)
+                if (progress is not None):
+                    progress("trying %s" % format_address(address))
+                try:
+                    sock = socket.socket(family, kind, proto)
+                except OSError as e:
+                    error = e
+                    continue
+                sock.setblocking(False)
+                result = sock.connect_ex(address)
+                if (result not in connectInProgress):
+                    sock.close()
+                    error = OSError(result, os.strerror(result))
+                    if (progress is not None):
+                        progress("%s: %s" % (format_address(address),
+                                             os.strerror(result)))
+                    continue
+                attempts[sock] = address
+                nextAttempt = now + attemptDelay
+            wait = deadline - now
+            if (pending):
+                wait = max(0.0, min(wait, nextAttempt - now))
+            # Windows reports a failed connect as exceptional, not writable.
+            ready, writable, failed = select.select([], list(attempts),
+                                                    list(attempts), wait)
+            for sock in writable + [s for s in failed if s not in writable]:
+                address = attempts.pop(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if (result == 0 and sock in failed):
+                    result = errno.ECONNREFUSED
+                if (result == 0):
+                    sock.setblocking(True)
+                    return sock, address
+                sock.close()
+                error = OSError(result, os.strerror(result))
+                if (progress is not None):
+                    progress("%s: %s" % (format_address(address),
+                                         os.strerror(result)))
+                nextAttempt = 0.0 # try the next address right away
+    finally:
+        for sock in attempts:
+            sock.close()
+    if (error is None):
+        error = OSError("no addresses to connect to")
+    raise error
+
+URGENT = 0 # replies the server is waiting for, and QUIT
+NORMAL = 1 # other commands
+CHAT = 2   # messages to channels and users
+
+urgentCommands = ("PONG", "PING", "QUIT")
+chatCommands = ("PRIVMSG", "NOTICE")
+
+def split_message(line, limit, encoding="utf-8"):
+    # Split a PRIVMSG or NOTICE so that no part encodes to more than limit
+    # bytes (not counting the line terminator), repeating the command and
+    # target in front of each part. Parts are cut at a space where possible,
+    # and never in the middle of a character. CTCP messages (e.g. actions)
+    # keep their \x01 delimiters in each part. Other lines are returned
+    # unchanged.
+    if (len(line) * 4 <= limit and len(line.encode(encoding)) <= limit):
+        return [line]
+    head, sep, text = line.partition(" :")
+    if (not sep or head.split(" ", 1)[0].upper() not in chatCommands):
+        return [line]
+    head += " :"
+    ctcp = ""
+    if (len(text) > 2 and text[0] == "\x01" and text[-1] == "\x01"):
+        verb, space, rest = text[1:-1].partition(" ")
+        head += "\x01" + verb + space
+        text = rest
+        ctcp = "\x01"
+    room = limit - len((head + ctcp).encode(encoding))
+    if (room < 16):
+        return [line] # (a target that long leaves no room to split)
+    data = text.encode(encoding)
+    parts = []
+    while (len(data) > room):
+        cut = room
+        while (cut > 0 and (data[cut] & 0xc0) == 0x80):
+            cut -= 1 # back up to the start of a character
+        space = data.rfind(b" ", room * 3 // 4, cut + 1)
+        if (space > 0):
+            parts.append(data[:space])
+            data = data[space + 1:]
+        else:
+            parts.append(data[:cut])
+            data = data[cut:]
+    parts.append(data)
+    return [head + str(part, encoding) + ctcp for part in parts]
+
+class SendQueue:
+    # Outgoing messages for one server connection, waiting to be written by a
+    # SenderThread or an AsyncConnection. Messages are queued by priority
+    # (URGENT before NORMAL before CHAT, oldest first within each), and all
+    # messages that may be sent at once are joined in to a single write.
+    #
+    # To avoid being disconnected for flooding, sending is paced the way most
+    # servers pace what they read from clients (RFC 1459, section 8.10): each
+    # message moves a timer ahead by messagePenalty seconds, plus one second
+    # per penaltyBytes bytes, and sending stops while the timer is more than
+    # burstTime seconds ahead of the clock. URGENT messages are never held
+    # back, but do count against the timer.
+    #
+    # PRIVMSGs and NOTICEs too long for the 512 byte protocol limit are split
+    # in to several messages. As the server prepends our nick!user@host when
+    # relaying them, put() is told how many bytes to leave for that.
+    #
+    # Safe to use from any thread.
+    lineLimit = 510       # bytes per message, not counting the CR LF
+    burstTime = 10.0
+    messagePenalty = 2.0
+    penaltyBytes = 120    # bytes per second of extra penalty
+    maxWrite = 16384      # max bytes joined in to one write
+
+    def __init__(self, encoding="utf-8"):
+        self.encoding = encoding
+        self.queues = (collections.deque(), collections.deque(),
+                       collections.deque())
+        self.condition = threading.Condition()
+        self.timer = 0.0
+        self.closed = False
+        self.depth = 0         # messages waiting
+        self.maxDepth = 0
+        self.queued = 0        # messages queued, after splitting
+        self.split = 0         # messages that had to be split
+        self.sent = 0
+        self.bytesSent = 0
+        self.writes = 0
+        self.throttled = 0     # messages that had to wait for the timer
+        self.latencyTotal = 0.0
+        self.latencyMax = 0.0
+
+    def put(self, line, priority=None, reserve=0):
+        # Queue a message (without line terminator) and return the number of
+        # messages it was split in to. The priority is worked out from the
+        # command if not given; reserve is the number of bytes to leave for a
+        # prefix added by the server.
+        command = line.split(" ", 1)[0].upper()
+        if (priority is None):
+            if (command in urgentCommands):
+                priority = URGENT
+            elif (command in chatCommands):
+                priority = CHAT
+            else:
+                priority = NORMAL
+        lines = split_message(line, self.lineLimit - reserve, self.encoding)
+        now = time.monotonic()
+        with self.condition:
+            if (self.closed):
+                return 0
+            for x in lines:
+                self.queues[priority].append(
+                    ((x + "\r\n").encode(self.encoding, "replace"), now,
+                     False)) # (data, time queued, held back yet)
+            self.depth += len(lines)
+            self.maxDepth = max(self.maxDepth, self.depth)
+            self.queued += len(lines)
+            if (len(lines) > 1):
+                self.split += 1
+            self.condition.notify()
+        return len(lines)
+
+    def take(self, now=None):
+        # Remove the messages that may be sent right now and return them as
+        # one block of bytes, along with the number of seconds until the next
+        # message may be sent (None if nothing else is waiting). Once closed,
+        # only URGENT messages are returned.
+        if (now is None):
+            now = time.monotonic()
+        with self.condition:
+            out = []
+            size = 0
+            delay = None
+            if (self.timer < now):
+                self.timer = now
+            for priority, queue in enumerate(self.queues):
+                if (self.closed and priority != URGENT):
+                    break
+                while (queue and size < self.maxWrite):
+                    if (priority != URGENT and
+                            self.timer - now > self.burstTime):
+                        delay = self.timer - now - self.burstTime
+                        data, queuedAt, held = queue[0]
+                        if (not held):
+                            # Counted once, however often we're woken up.
+                            queue[0] = (data, queuedAt, True)
+                            self.throttled += 1
+                        break
+                    data, queuedAt, held = queue.popleft()
+                    out.append(data)
+                    size += len(data)
+                    self.timer += self.messagePenalty + len(data) / self.penaltyBytes
+                    latency = now - queuedAt
+                    self.latencyTotal += latency
+                    self.latencyMax = max(self.latencyMax, latency)
+                if (delay is not None or size >= self.maxWrite):
+                    break
+            if (size >= self.maxWrite and delay is None and self.depth > len(out)):
+                delay = 0
+            self.depth -= len(out)
+            if (out):
+                self.sent += len(out)
+                self.bytesSent += size
+                self.writes += 1
+            return b"".join(out), delay
+
+    def wait(self):
+        # Block until there's something to send, and return it (see take()).
+        # Returns None once closed and there's nothing left to send.
+        with self.condition:
+            while (True):
+                data, delay = self.take()
+                if (data):
+                    return data
+                if (self.closed):
+                    return None
+                self.condition.wait(delay)
+
+    def close(self):
+        # Stop accepting messages. Anything URGENT (e.g. a QUIT) is still
+        # sent; everything else is thrown away.
+        with self.condition:
+            self.closed = True
+            for queue in self.queues[URGENT + 1:]:
+                self.depth -= len(queue)
+                queue.clear()
+            self.condition.notify()
+
+    def get_stats(self):
+        with self.condition:
+            average = 0.0
+            if (self.sent):
+                average = self.latencyTotal / self.sent
+            return {"depth": self.depth, "maxDepth": self.maxDepth,
+                    "queued": self.queued, "split": self.split,
+                    "sent": self.sent, "bytesSent": self.bytesSent,
+                    "writes": self.writes, "throttled": self.throttled,
+                    "latencyAverage": average, "latencyMax": self.latencyMax}
+
+class FastPath:
+    # Answers the messages that can't wait for the UI thread, straight from
+    # the thread (or event loop) receiving them: the server's PINGs, which
+    # get us disconnected if the PONG is late, and CTCP VERSION and PING
+    # requests. At most ctcpLimit CTCP requests are answered every
+    # ctcpInterval seconds, so that nobody can make us flood ourselves off
+    # the server; the rest are ignored. Replies go on the connection's
+    # SendQueue (PONGs ahead of everything else), after which onQueued() is
+    # called, if given. The lines themselves are still passed on to the UI
+    # as usual.
+    #
+    # The time from a line arriving to its reply being queued is recorded in
+    # a Histogram (see pynapple_stats.py).
+    ctcpLimit = 3
+    ctcpInterval = 10.0
+
+    def __init__(self, sendQueue, version, onQueued=None):
+        self.sendQueue = sendQueue
+        self.version = version
+        self.onQueued = onQueued
+        self.ctcpTimes = collections.deque() # when recent CTCPs were answered
+        self.pongs = 0
+        self.ctcpReplies = 0
+        self.ctcpIgnored = 0
+        self.latency = Histogram()
+
+    def scan(self, lines, arrived):
+        # Answer anything in a batch of received lines that needs it. Most
+        # lines are passed over after a couple of string comparisons.
+        replied = False
+        for line in lines:
+            start = 0
+            if (line[0] == "@"):
+                start = line.find(" ") + 1 # skip message tags
+            origin = start # where the prefix (if any) starts
+            if (line.startswith(":", start)):
+                start = line.find(" ", start) + 1 # ... and the prefix
+            if (line.startswith("PING ", start)):
+                self.sendQueue.put("PONG " + line[start + 5:], URGENT)
+                self.pongs += 1
+                replied = True
+            elif ("\x01" in line and line.startswith("PRIVMSG ", start)):
+                replied = self.answer_ctcp(line, origin, start) or replied
+            else:
+                continue
+            self.latency.add(time.monotonic() - arrived)
+        if (replied and self.onQueued is not None):
+            self.onQueued()
+
+    def answer_ctcp(self, line, origin, start):
+        # Answer a CTCP VERSION or PING request, given where the line's prefix
+        # and command start (after any tags). Returns True if we did.
+        i = line.find(" :", start)
+        if (i < 0):
+            return False
+        text = line[i + 2:]
+        if (not text.startswith("\x01")):
+            return False
+        verb = text[1:].split(" ", 1)[0].split("\x01", 1)[0]
+        if (verb != "VERSION" and verb != "PING"):
+            return False
+        if (not line.startswith(":", origin)):
+            return False
+        nick = line[origin + 1:start].split("!", 1)[0].rstrip(" ")
+        if (not nick or " " in nick):
+            return False
+        now = time.monotonic()
+        while (self.ctcpTimes and now - self.ctcpTimes[0] > self.ctcpInterval):
+            self.ctcpTimes.popleft()
+        if (len(self.ctcpTimes) >= self.ctcpLimit):
+            self.ctcpIgnored += 1
+            return False
+        self.ctcpTimes.append(now)
+        if (verb == "VERSION"):
+            reply = "\x01VERSION pynapple-irc %s\x01" % self.version
+        else:
+            reply = text.rstrip("\x01")[:64] + "\x01"
+        self.sendQueue.put("NOTICE %s :%s" % (nick, reply), NORMAL)
+        self.ctcpReplies += 1
+        return True
+
+    def get_stats(self):
+        stats = {"pongs": self.pongs, "ctcpReplies": self.ctcpReplies,
+                 "ctcpIgnored": self.ctcpIgnored}
+        stats["latency"] = self.latency.get_stats()
+        return stats
+
+class LoadShedder:
+    # Picks the received lines that can be dropped when the UI is falling
+    # behind: those no handler is registered for (which would only have been
+    # seen in the debug view and the raw log), and other users' joins, parts
+    # and quits (or whichever commands are given), after which the nick-lists
+    # ought to be fetched again. Our own are never dropped, as long as nick is
+    # kept up to date. What was dropped is counted by command until take() is
+    # called. Used from the thread (or event loop) receiving the lines.
+    def __init__(self, handlers, commands=("JOIN", "PART", "QUIT")):
+        self.handlers = handlers # command -> handlers, as kept by a Dispatcher
+        self.commands = frozenset(commands)
+        self.nick = ""
+        self.dropped = {}
+        self.total = 0
+
+    def filter(self, lines):
+        # Return the lines of a batch that are to be kept.
+        kept = []
+        handlers = self.handlers
+        dropped = self.dropped
+        for line in lines:
+            command = command_of(line)
+            if ((command in self.commands and not self.is_ours(line)) or
+                not handlers.get(command)):
+                dropped[command] = dropped.get(command, 0) + 1
+            else:
+                kept.append(line)
+        self.total += len(lines) - len(kept)
+        return kept
+
+    def is_ours(self, line):
+        # Return True if a line was sent by us (i.e. has our nick as prefix).
+        if (line.startswith("@")):
+            line = line[line.find(" ") + 1:].lstrip(" ")
+        nick = self.nick
+        return (line.startswith(":") and line[len(nick) + 1:len(nick) + 2] == "!"
+                and irc_lower(line[1:len(nick) + 1]) == irc_lower(nick))
+
+    def take(self):
+        # Return the counts of lines dropped since the last call, by command.
+        dropped = self.dropped
+        self.dropped = {}
+        return dropped
+
+class ReceiveQueue:
+    # The (arrival time, line) pairs received by a SocketThread, waiting to be
+    # handled on the UI thread. At most capacity lines are held: beyond that,
+    # with the "pause" policy, put() blocks, so the socket thread stops
+    # reading and TCP flow control slows the server down, until the UI has
+    # worked its way down to resumeLevel (a fraction of capacity). With the
+    # "shed" policy, the lines a LoadShedder picks are dropped first, and
+    # put() only blocks once twice the capacity is reached.
+    #
+    # Safe to use from any thread.
+    resumeLevel = 0.5
+
+    def __init__(self, capacity, policy="shed", shedder=None):
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.capacity = capacity
+        self.policy = policy
+        self.shedder = shedder
+        self.limit = capacity
+        if (policy == "shed" and shedder is not None):
+            self.limit = 2 * capacity
+        self.resume = int(capacity * self.resumeLevel)
+        self.maxDepth = 0
+        self.blocked = False   # put() is waiting for room
+        self.pauses = 0        # times put() has had to wait
+        self.pausedSeconds = 0.0
+
+    def put(self, lines, arrived, stop=None):
+        # Queue a batch of lines received at the given time.monotonic(). If
+        # there's no room, wait for some (or for the stop Event to be set).
+        with self.condition:
+            items = self.items
+            if (len(items) + len(lines) > self.capacity and
+                self.policy == "shed" and self.shedder is not None):
+                lines = self.shedder.filter(lines)
+            if (len(items) >= self.limit):
+                self.blocked = True
+                self.pauses += 1
+                started = time.monotonic()
+                while (len(items) > self.resume and
+                       not (stop is not None and stop.is_set())):
+                    self.condition.wait(0.1)
+                self.blocked = False
+                self.pausedSeconds += time.monotonic() - started
+            items.extend([(arrived, line) for line in lines])
+            if (len(items) > self.maxDepth):
+                self.maxDepth = len(items)
+            self.condition.notify_all()
+
+    def take(self, limit, timeout=0):
+        # Return up to limit of the oldest pairs, waiting at most timeout
+        # seconds for any to arrive if there are none.
+        with self.condition:
+            items = self.items
+            if (not items and timeout > 0):
+                self.condition.wait(timeout)
+            batch = [items.popleft() for i in range(min(limit, len(items)))]
+            if (self.blocked and len(items) <= self.resume):
+                self.condition.notify_all()
+        return batch
+
+    def qsize(self):
+        return len(self.items)
+
+    def oldest(self):
+        # Return the arrival time of the oldest line waiting, or None.
+        items = self.items
+        if (items):
+            return items[0][0]
+        return None
+
+    def get_stats(self):
+        return {"capacity": self.capacity, "maxDepth": self.maxDepth,
+                "pauses": self.pauses, "pausedSeconds": self.pausedSeconds,
+                "paused": self.blocked}
+
+class SenderThread(threading.Thread):
+    # Writes the messages of a SendQueue to a (blocking) socket, so that a
+    # full socket buffer or a flood-control delay never blocks the UI. Exits
+    # once the queue has been closed and emptied, or the socket fails.
+    def __init__(self, sendQueue, sock):
+        super(SenderThread, self).__init__(daemon=True)
+        self.sendQueue = sendQueue
+        self.sock = sock
+
+    def run(self):
+        while (True):
+            data = self.sendQueue.wait()
+            if (data is None):
+                return
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.sendQueue.close()
+                return
+
+class AsyncConnection(asyncio.Protocol):
+    # One server connection driven by an AsyncEngine. Incoming data is framed
+    # as soon as it arrives and complete lines are handed to the onLines
+    # callback (through the engine, so that they end up on the UI thread).
+    # Data sent before the connection is established is held back and written
+    # once it is.
+    #
+    # Given a SendQueue, messages are taken from it whenever pump() is called
+    # (after putting messages on the queue) and as its flood control allows.
+    #
+    # Given an rxLimit, at most that many lines are let through to the UI
+    # thread before it reports having handled them (see lines_handled());
+    # beyond that, the policy is that of a ReceiveQueue, except that reading
+    # is paused with pause_reading() rather than by blocking.
+    def __init__(self, engine, framer, onLines, onLost, sendQueue=None,
+                 fastPath=None, rxLimit=0, rxPolicy="shed", shedder=None):
+        self.engine = engine
+        self.framer = framer
+        self.onLines = onLines
+        self.onLost = onLost
+        self.sendQueue = sendQueue
+        self.fastPath = fastPath
+        if (fastPath is not None):
+            fastPath.onQueued = self.flush_queue
+        self.transport = None
+        self.outbuf = []
+        self.closing = False
+        self.timer = None # pending call of flush_queue()
+        self.rxLimit = rxLimit
+        self.rxPolicy = rxPolicy
+        self.shedder = shedder
+        self.pauseLimit = rxLimit
+        if (rxPolicy == "shed" and shedder is not None):
+            self.pauseLimit = 2 * rxLimit
+        self.delivered = 0 # lines passed on (counted on the event loop)...
+        self.handled = 0   # ... and handled (counted on the UI thread)
+        self.paused = False
+        self.pausedAt = 0.0
+        self.pauses = 0
+        self.pausedSeconds = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if (self.outbuf):
+            transport.write(b"".join(self.outbuf))
+            self.outbuf = []
+        self.flush_queue()
+        if (self.closing):
+            transport.close()
+
+    def data_received(self, data):
+        lines = self.framer.feed(data)
+        if (lines):
+            arrived = time.monotonic()
+            if (self.fastPath is not None):
+                self.fastPath.scan(lines, arrived)
+            if (self.rxLimit):
+                lines = self.limit(lines, arrived)
+            if (lines):
+                self.delivered += len(lines)
+                self.engine.deliver(self.onLines, lines, arrived)
+
+    def limit(self, lines, now):
+        # Apply the overload policy to a batch of lines about to be passed on.
+        backlog = self.delivered - self.handled
+        if (backlog + len(lines) > self.rxLimit and self.rxPolicy == "shed" and
+            self.shedder is not None):
+            lines = self.shedder.filter(lines)
+        if (backlog + len(lines) >= self.pauseLimit and not self.paused and
+            self.transport is not None):
+            self.transport.pause_reading()
+            self.paused = True
+            self.pausedAt = now
+            self.pauses += 1
+        return lines
+
+    def lines_handled(self, n):
+        # Note that n lines passed on have been handled. Called on the UI
+        # thread.
+        self.handled += n
+        if (self.paused and self.delivered - self.handled <=
+            self.rxLimit * ReceiveQueue.resumeLevel):
+            self.engine.call(self.resume_reading)
+
+    def resume_reading(self):
+        if (self.paused):
+            self.paused = False
+            self.pausedSeconds += time.monotonic() - self.pausedAt
+            if (self.transport is not None):
+                self.transport.resume_reading()
+
+    def get_backlog(self):
+        # Return the number of lines passed on but not handled yet.
+        return self.delivered - self.handled
+
+    def get_stats(self):
+        return {"capacity": self.rxLimit, "pauses": self.pauses,
+                "pausedSeconds": self.pausedSeconds, "paused": self.paused}
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.engine.deliver(self.onLost, self, exc)
+
+    def write(self, data):
+        if (self.transport is not None):
+            self.transport.write(data)
+        elif (not self.closing):
+            self.outbuf.append(data)
+
+    def send(self, data):
+        # Queue data to be written to the server. Safe to call from any thread.
+        self.engine.call(self.write, data)
+
+    def pump(self):
+        # Write whatever the send queue allows. Safe to call from any thread.
+        self.engine.call(self.flush_queue)
+
+    def flush_queue(self):
+        if (self.sendQueue is None or self.transport is None):
+            return
+        if (self.timer is not None):
+            self.timer.cancel()
+            self.timer = None
+        data, delay = self.sendQueue.take()
+        if (data):
+            self.transport.write(data)
+        if (delay is not None and not self.closing):
+            self.timer = self.engine.call_later(delay, self.flush_queue)
+
+    def shutdown(self):
+        self.closing = True
+        if (self.sendQueue is not None):
+            self.sendQueue.close()
+            self.flush_queue() # (sends a final QUIT)
+        if (self.transport is not None):
+            self.transport.close() # flushes anything still buffered
+
+    def close(self):
+        # Close the connection once pending data has been written. Safe to call
+        # from any thread.
+        self.engine.call(self.shutdown)
+
+class AsyncEngine:
+    # Services any number of server connections from a single asyncio event
+    # loop, as an alternative to running one SocketThread per connection and
+    # polling a queue. Messages are framed and dispatched as they arrive.
+    #
+    # The loop either runs on the UI thread (engine.run(), as used by the
+    # curses interface, which watches stdin with add_reader()), or on a single
+    # background thread (engine.start_thread(), as used by the Tk interface).
+    # In the latter case the UI supplies a bridge function which is used to
+    # run callbacks on its own thread: bridge(callback, *args).
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.bridge = None
+        self.loopThread = None # ident of the thread running the loop
+
+    def run(self):
+        # Run the event loop on the calling thread until stop() is called.
+        asyncio.set_event_loop(self.loop)
+        self.loopThread = threading.get_ident()
+        self.loop.run_forever()
+
+    def start_thread(self, bridge):
+        # Run the event loop on a background thread, delivering callbacks to
+        # the UI through the given bridge function.
+        self.bridge = bridge
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def call(self, f, *args):
+        # Run f(*args) on the event loop thread: right away, if that's the
+        # calling thread (so that e.g. a QUIT is written even if the program
+        # exits before the loop comes round again).
+        if (threading.get_ident() == self.loopThread):
+            f(*args)
+        else:
+            self.loop.call_soon_threadsafe(f, *args)
+
+    def call_later(self, delay, f, *args):
+        # Run f(*args) on the event loop thread after the given delay. Must be
+        # called from the event loop thread.
+        return self.loop.call_later(delay, f, *args)
+
+    def deliver(self, f, *args):
+        # Run f(*args) on the UI thread. Called from the event loop thread.
+        if (self.bridge is None):
+            f(*args)
+        else:
+            self.bridge(f, *args)
+
+    def add_reader(self, fd, f):
+        # Call f() whenever the given file descriptor becomes readable.
+        self.loop.add_reader(fd, f)
+
+    def remove_reader(self, fd):
+        self.loop.remove_reader(fd)
+
+    def add_signal_handler(self, signum, f):
+        # Call f() on the event loop thread whenever the given signal arrives.
+        self.loop.add_signal_handler(signum, f)
+
+    def connect(self, host, port, framer, onLines, onLost, sendQueue=None,
+                fastPath=None, opener=None, rxLimit=0, rxPolicy="shed",
+                shedder=None):
+        # Open a connection to the given server, returning an AsyncConnection
+        # immediately. onLines(lines, arrived) is called for each batch of
+        # received lines (with the time.monotonic() they arrived) and
+        # onLost(conn, exc) once the connection is closed or fails. If given,
+        # opener() is run in a worker thread to open the (blocking) socket,
+        # rather than leaving that to asyncio. See AsyncConnection for the
+        # rest.
+        conn = AsyncConnection(self, framer, onLines, onLost, sendQueue,
+                               fastPath, rxLimit, rxPolicy, shedder)
+        asyncio.run_coroutine_threadsafe(self.open(conn, host, port, opener),
+                                         self.loop)
+        return conn
+
+    async def open(self, conn, host, port, opener=None):
+        try:
+            if (opener is None):
+                await self.loop.create_connection(lambda: conn, host, port)
+            else:
+                sock = await self.loop.run_in_executor(None, opener)
+                await self.loop.create_connection(lambda: conn, sock=sock)
+        except OSError as e:
+            conn.closing = True
+            self.deliver(conn.onLost, conn, e)
+
+defaultEngine = None
+
+def get_default_engine():
+    # Return the process-wide AsyncEngine, creating it on first use. All
+    # connections share it, so that they are all serviced by one thread.
+    global defaultEngine
+    if (defaultEngine is None):
+        defaultEngine = AsyncEngine()
+    return defaultEngine
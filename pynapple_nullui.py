@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# A headless user interface, for running pynapple as a bot or service. Nothing
+# is drawn: messages shown in the current buffer are written to stdout (unless
+# quiet), and commands are read from stdin, one per line, if it's open. Only
+# the standard library is needed, so this starts quickly and stays small.
+
+import os
+import selectors
+import sys
+
+class UserInterfacePlugin:
+    quiet = False # don't echo messages to stdout
+
+    def __init__(self, irc, kb):
+        self.ircHandle = irc
+        self.kbHandle = kb
+        self.running = True
+        self.selector = None
+        self.inbuf = b"" # partial command read from stdin
+
+    def run(self):
+        engine = self.ircHandle.get_engine()
+        stdin = self.get_stdin()
+        if (engine is not None):
+            if (stdin is not None):
+                engine.add_reader(stdin, self.read_command)
+            engine.run()
+            return
+        # Threaded engine: sleep until a socket thread says messages are
+        # waiting, or a command arrives.
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.ircHandle.get_wakeup().fileno(),
+                               selectors.EVENT_READ, None)
+        if (stdin is not None):
+            self.selector.register(stdin, selectors.EVENT_READ,
+                                   self.read_command)
+        while (self.running):
+            timeout = None
+            if (self.ircHandle.get_backlog() > 0):
+                timeout = 0
+            for key, events in self.selector.select(timeout):
+                if (key.data is not None):
+                    key.data()
+            self.ircHandle.poll(0)
+
+    def get_stdin(self):
+        # Return the descriptor to read commands from, or None.
+        try:
+            if (sys.stdin is None or sys.stdin.closed):
+                return None
+            return sys.stdin.fileno()
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def read_command(self):
+        # Read what's waiting on stdin (straight from the descriptor, as the
+        # selector can't see data buffered by sys.stdin) and run each complete
+        # line as if it had been typed.
+        fd = sys.stdin.fileno()
+        data = os.read(fd, 4096)
+        if (data == b""):
+            # End of input; carry on without it.
+            engine = self.ircHandle.get_engine()
+            if (engine is not None):
+                engine.remove_reader(fd)
+            else:
+                self.selector.unregister(fd)
+            data = b"\n"
+        lines = (self.inbuf + data).split(b"\n")
+        self.inbuf = lines.pop()
+        for line in lines:
+            line = line.decode("utf-8", "replace").strip()
+            if (line != ""):
+                self.kbHandle.parse_input(line)
+
+    def write(self, s):
+        if (not self.quiet):
+            sys.stdout.write(s + "\n")
+            sys.stdout.flush()
+
+    def get_max_colors(self):
+        return 8
+
+    def init_colors(self):
+        pass
+
+    def update_status(self):
+        pass
+
+    def set_scrollback(self, lines):
+        pass
+
+    def add_message(self, s, color, hilite):
+        self.write(s)
+
+    def add_debug_message(self, s):
+        pass
+
+    def set_debug_lines(self, lines):
+        pass
+
+    def set_lag(self, seconds):
+        pass
+
+    def set_nicklist(self, a):
+        pass
+
+    def update_nicklist(self, nicklist, added, removed):
+        pass
+
+    def toggle_debug(self):
+        pass
+
+    def shutdown(self):
+        self.running = False
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# IRC message parsing and dispatching, and channel membership. Like
+# pynapple_net.py, nothing in here touches the user interface.
+
+import bisect
+import string
+
+def irc_lower(s):
+    # Fold a nick or channel name to lower case using the RFC 1459 case
+    # mapping (where []\~ are the upper case forms of {}|^), for use as a key
+    # when looking channels up.
+    return s.translate(ircCaseMap)
+
+ircCaseMap = str.maketrans(string.ascii_uppercase + "[]\\~",
+                           string.ascii_lowercase + "{}|^")
+
+class Message:
+    # A parsed IRC message. The parts every handler needs (prefix, command and
+    # arguments) are split out up front; the sender's nick, user and host and
+    # any IRCv3 message tags are only worked out when asked for, as most
+    # messages never need them. The nick and tags are kept once worked out.
+    #
+    # For compatibility with code that expects the old tuples, a message can
+    # be unpacked as: prefix, command, args = msg
+    __slots__ = ("prefix", "command", "args", "rawTags", "_nick", "_tags")
+
+    def __init__(self, prefix, command, args, rawTags=""):
+        self.prefix = prefix
+        self.command = command
+        self.args = args
+        self.rawTags = rawTags
+        self._nick = None
+        self._tags = None
+
+    def __iter__(self):
+        return iter((self.prefix, self.command, self.args))
+
+    def __repr__(self):
+        return "Message(%r, %r, %r, %r)" % (self.prefix, self.command,
+                                            self.args, self.rawTags)
+
+    @property
+    def nick(self):
+        # The sender's nick (or server name, for a prefix without a "!").
+        nick = self._nick
+        if (nick is None):
+            prefix = self.prefix
+            i = prefix.find("!")
+            if (i == -1):
+                i = prefix.find("@")
+            if (i == -1):
+                nick = prefix
+            else:
+                nick = prefix[:i]
+            self._nick = nick
+        return nick
+
+    @property
+    def user(self):
+        # The sender's user name, from a nick!user@host prefix.
+        prefix = self.prefix
+        bang = prefix.find("!")
+        if (bang == -1):
+            return ""
+        at = prefix.find("@", bang)
+        if (at == -1):
+            return prefix[bang + 1:]
+        return prefix[bang + 1:at]
+
+    @property
+    def host(self):
+        # The sender's host name, from a nick!user@host prefix.
+        at = self.prefix.find("@")
+        if (at == -1):
+            return ""
+        return self.prefix[at + 1:]
+
+    @property
+    def tags(self):
+        # IRCv3 message tags as a dictionary. Tags without a value map to "".
+        if (self._tags is None):
+            self._tags = {}
+            if (self.rawTags):
+                for tag in self.rawTags.split(";"):
+                    key, sep, value = tag.partition("=")
+                    if (key):
+                        self._tags[key] = unescape_tag(value)
+        return self._tags
+
+tagEscapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+
+def unescape_tag(s):
+    # Undo the escaping applied to IRCv3 tag values.
+    if ("\\" not in s):
+        return s
+    out = []
+    i = 0
+    while (i < len(s)):
+        c = s[i]
+        if (c == "\\"):
+            i += 1
+            if (i < len(s)):
+                out.append(tagEscapes.get(s[i], s[i]))
+        else:
+            out.append(c)
+        i += 1
+    return "".join(out)
+
+def parse_message(s):
+    # Transform incoming message strings received by the IRC server in to
+    # component parts common to all messages: an optional set of IRCv3 tags,
+    # an optional prefix, the command, and its arguments (the last of which
+    # may contain spaces, if introduced by a colon).
+    rawTags = ""
+    prefix = ""
+    if (s[0] == "@"):
+        rawTags, s = s[1:].split(" ", 1)
+        s = s.lstrip(" ")
+    if (s[0] == ":"):
+        prefix, s = s[1:].split(" ", 1)
+    i = s.find(" :")
+    if (i != -1):
+        args = s[:i].split()
+        args.append(s[i + 2:])
+    else:
+        args = s.split()
+    command = args.pop(0).upper()
+    return Message(prefix, command, args, rawTags)
+
+def command_of(line):
+    # Return the command of a raw IRC line (in upper case), skipping any tags
+    # and prefix, or "" if there is none.
+    start = 0
+    if (line.startswith("@")):
+        start = line.find(" ") + 1
+        if (start == 0):
+            return ""
+        while (line.startswith(" ", start)):
+            start += 1
+    if (line.startswith(":", start)):
+        start = line.find(" ", start) + 1
+        if (start == 0):
+            return ""
+    while (line.startswith(" ", start)):
+        start += 1
+    end = line.find(" ", start)
+    if (end < 0):
+        end = len(line)
+    return line[start:end].upper()
+
+class Dispatcher:
+    # Maps IRC commands and numeric replies to the functions handling them,
+    # so that each incoming message costs a single dictionary lookup no
+    # matter how many kinds of message we know about. Any number of handlers
+    # may be registered for the same command; they're called in order.
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, command, handler):
+        # Call handler(msg) for every message with the given command.
+        self.handlers.setdefault(command.upper(), []).append(handler)
+
+    def unregister(self, command, handler):
+        handlers = self.handlers.get(command.upper(), [])
+        if (handler in handlers):
+            handlers.remove(handler)
+
+    def dispatch(self, msg):
+        # Pass a message to the handlers for its command. Returns False if no
+        # handler was registered for it.
+        handlers = self.handlers.get(msg.command)
+        if (not handlers):
+            return False
+        for handler in handlers:
+            handler(msg)
+        return True
+
+class NickList:
+    # The users in a channel, along with their channel status (the @, + etc.
+    # prefixes shown in front of their nicks). Members are kept in a dict
+    # keyed by case-folded nick, for constant time lookups, and in a list of
+    # sort keys kept ordered with bisect, so that adding or removing a user
+    # doesn't re-sort the whole list. The list is ordered by rank (operators
+    # first), then by nick.
+    #
+    # Methods changing the list return the change as a pair of lists of
+    # displayed names (added, removed), so that the UI only has to apply the
+    # difference. A user whose status changes is both removed and added.
+    def __init__(self, prefixes="~&@%+"):
+        self.prefixes = prefixes # status prefixes, highest rank first
+        self.members = {}        # irc_lower(nick) -> (nick, prefixes)
+        self.order = []          # sort keys of the members, in order
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, nick):
+        return irc_lower(nick) in self.members
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def split(self, s):
+        # Split a name from a names reply (e.g. "@+nick") in to its status
+        # prefixes and the nick.
+        i = 0
+        while (i < len(s) and s[i] in self.prefixes):
+            i += 1
+        return s[:i], s[i:]
+
+    def sort_key(self, key, modes):
+        if (modes):
+            return (self.prefixes.find(modes[0]), key)
+        return (len(self.prefixes), key)
+
+    def display(self, key):
+        # Return a member's name as shown in the nick-list.
+        nick, modes = self.members[key]
+        return modes[:1] + nick
+
+    def names(self, start=None, end=None):
+        # Return the displayed names of all members (or of those between the
+        # given positions), in order.
+        members = self.members
+        order = self.order
+        if (start is not None or end is not None):
+            order = order[start:end]
+        return [members[k[1]][1][:1] + members[k[1]][0] for k in order]
+
+    def position(self, nick):
+        # Return the position of a member in the ordered list.
+        key = irc_lower(nick)
+        return bisect.bisect_left(self.order, self.sort_key(key, self.members[key][1]))
+
+    def display_key(self, name):
+        # Return the sort key of a displayed name (e.g. "@nick"), which orders
+        # it among the others the same way as the member it stands for; e.g.
+        # bisecting a list of these finds where the name is or would go.
+        modes, nick = self.split(name)
+        return self.sort_key(irc_lower(nick), modes)
+
+    def insert(self, key, nick, modes):
+        self.members[key] = (nick, modes)
+        bisect.insort(self.order, self.sort_key(key, modes))
+
+    def delete(self, key):
+        nick, modes = self.members.pop(key)
+        sortKey = self.sort_key(key, modes)
+        del self.order[bisect.bisect_left(self.order, sortKey)]
+        return modes[:1] + nick
+
+    def add(self, s):
+        # Add a user, given as a nick optionally preceded by status prefixes.
+        modes, nick = self.split(s)
+        key = irc_lower(nick)
+        removed = []
+        if (key in self.members):
+            if (self.members[key] == (nick, modes)):
+                return [], []
+            removed.append(self.delete(key))
+        self.insert(key, nick, modes)
+        return [self.display(key)], removed
+
+    def remove(self, nick):
+        key = irc_lower(nick)
+        if (key not in self.members):
+            return [], []
+        return [], [self.delete(key)]
+
+    def rename(self, old, new):
+        # Change a member's nick, keeping their status.
+        key = irc_lower(old)
+        if (key not in self.members):
+            return [], []
+        modes = self.members[key][1]
+        removed = [self.delete(key)]
+        newKey = irc_lower(new)
+        if (newKey in self.members):
+            removed.append(self.delete(newKey))
+        self.insert(newKey, new, modes)
+        return [self.display(newKey)], removed
+
+    def set_modes(self, nick, prefix, on):
+        # Give a member the given status prefix (e.g. "@"), or take it away.
+        key = irc_lower(nick)
+        if (key not in self.members):
+            return [], []
+        nick, modes = self.members[key]
+        if (on and prefix not in modes):
+            modes = "".join(c for c in self.prefixes if c in modes or c == prefix)
+        elif (not on and prefix in modes):
+            modes = modes.replace(prefix, "")
+        else:
+            return [], []
+        removed = [self.delete(key)]
+        self.insert(key, nick, modes)
+        return [self.display(key)], removed
+
+    def replace(self, other):
+        # Take over the members of another NickList (e.g. one assembled from a
+        # complete names reply), returning the difference to the old ones.
+        old = set(self.names())
+        new = other.names()
+        self.prefixes = other.prefixes
+        self.members = other.members
+        self.order = other.order
+        newSet = set(new)
+        return ([x for x in new if x not in old],
+                [x for x in old if x not in newSet])
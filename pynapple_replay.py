@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Replays raw IRC traffic through the client's whole receive pipeline, offline,
+# and reports how fast it went. Run as:
+#
+#   python3 pynapple_replay.py [options] [workload or file]...
+#
+# The built-in workloads are generated on the fly: "chat" (a busy channel),
+# "names" (joining channels of 10000 users), "netsplit" (thousands of users
+# quitting and rejoining at once) and "utf8" (long lines of multibyte text).
+# A file of recorded traffic, one message per line (e.g. a ~raw.log written
+# by the client, or one saved with --save), can be replayed instead.
+#
+# Traffic goes through the same stages as data received by a SocketThread:
+# line framing (a LineFramer fed in socket-sized chunks), parse_message(),
+# IRC.handle_message(), and the censoring, highlighting and coloring done by
+# UserInterface, ending in the stub UI plugin below rather than a real
+# screen. Logging and the history are turned off unless --storage is given.
+#
+# Results are appended to a file (bench_results.jsonl by default), and
+# compared with the last run of the same workload, so that a slowdown between
+# versions shows up.
+
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import pynapple
+from pynapple_net import LineFramer, SendQueue
+
+class UserInterfacePlugin:
+    # A stub user interface backend, counting what would have been drawn.
+    def __init__(self, irc, kb):
+        self.messages = 0
+        self.nicklistUpdates = 0
+
+    def get_max_colors(self):
+        return 256
+
+    def add_message(self, s, color, hilite):
+        self.messages += 1
+
+    def update_nicklist(self, nicklist, added, removed):
+        self.nicklistUpdates += 1
+
+    def set_nicklist(self, a):
+        self.nicklistUpdates += 1
+
+    def set_scrollback(self, lines):
+        pass
+
+    def add_debug_message(self, s):
+        pass
+
+    def set_debug_lines(self, lines):
+        pass
+
+    def set_lag(self, seconds):
+        pass
+
+    def update_status(self):
+        pass
+
+    def init_colors(self):
+        pass
+
+    def toggle_debug(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def run(self):
+        pass
+
+nick = "pynapple"
+chunkSize = 4096 # bytes per simulated socket read
+
+def user_prefix(n):
+    return "user%d!~user%d@host%d.example" % (n, n, n % 97)
+
+def names_replies(channel, users, prefixes="@+"):
+    # Return the 353 lines listing the given user numbers, packed as a server
+    # would, followed by the 366.
+    lines = []
+    names = []
+    length = 0
+    head = ":irc.example 353 %s = %s :" % (nick, channel)
+    for n in users:
+        name = "user%d" % n
+        if (n % 50 == 0):
+            name = prefixes[n % len(prefixes)] + name
+        if (length + len(name) + len(head) > 500):
+            lines.append(head + " ".join(names))
+            names = []
+            length = 0
+        names.append(name)
+        length += len(name) + 1
+    if (names):
+        lines.append(head + " ".join(names))
+    lines.append(":irc.example 366 %s %s :End of /NAMES list." % (nick, channel))
+    return lines
+
+def join(channel, users):
+    return ([":%s!~%s@localhost JOIN %s" % (nick, nick, channel)] +
+            names_replies(channel, users))
+
+def workload_chat(scale):
+    # A busy channel: mostly chatter, some of it highlighting us, with actions,
+    # joins and parts, and the odd ping.
+    rng = random.Random(1)
+    words = ["pineapple", "hello", "world", "irc", "python", "the", "a", "of",
+             "lol", "ok", "über", "naïve", nick]
+    lines = join("#chat", range(500))
+    for n in range(int(100000 * scale)):
+        user = rng.randrange(500)
+        kind = rng.randrange(100)
+        text = " ".join(rng.choice(words) for x in range(rng.randrange(1, 25)))
+        if (kind < 85):
+            lines.append(":%s PRIVMSG #chat :%s" % (user_prefix(user), text))
+        elif (kind < 90):
+            lines.append(":%s PRIVMSG #chat :\x01ACTION %s\x01" %
+                         (user_prefix(user), text))
+        elif (kind < 94):
+            lines.append(":%s JOIN #chat" % user_prefix(500 + n))
+        elif (kind < 98):
+            lines.append(":%s PART #chat :bye" % user_prefix(500 + n - 20))
+        else:
+            lines.append("PING :irc.example")
+    return lines
+
+def workload_names(scale):
+    # Joining channels of 10000 users each.
+    lines = []
+    for n in range(max(1, int(20 * scale))):
+        lines += join("#big%d" % n, range(10000))
+    return lines
+
+def workload_netsplit(scale):
+    # A channel of 5000 users, most of whom are on the far side of repeated
+    # netsplits: they all quit, then rejoin and get their modes back.
+    users = range(5000)
+    lines = join("#split", users)
+    for n in range(max(1, int(10 * scale))):
+        split = [u for u in users if u % 5]
+        for u in split:
+            lines.append(":%s QUIT :irc.a.example irc.b.example" % user_prefix(u))
+        for u in split:
+            lines.append(":%s JOIN #split" % user_prefix(u))
+        for i in range(0, len(split), 4):
+            lines.append(":irc.b.example MODE #split +vvvv %s" %
+                         " ".join("user%d" % u for u in split[i:i + 4]))
+    return lines
+
+def workload_utf8(scale):
+    # Long lines of multibyte text, close to the 512 byte limit.
+    rng = random.Random(2)
+    words = ["日本語", "テキスト", "über", "naïve", "🍍", "ёлка", "Ελληνικά",
+             "עברית", "中文字符"]
+    lines = join("#utf8", range(200))
+    for n in range(int(50000 * scale)):
+        text = []
+        size = 0
+        while (size < 380):
+            w = rng.choice(words)
+            text.append(w)
+            size += len(w.encode("utf-8")) + 1
+        lines.append(":%s PRIVMSG #utf8 :%s" % (user_prefix(rng.randrange(200)),
+                                               " ".join(text)))
+    return lines
+
+workloads = {
+    "chat": workload_chat,
+    "names": workload_names,
+    "netsplit": workload_netsplit,
+    "utf8": workload_utf8,
+}
+
+def load_traffic(name, scale):
+    # Return the raw traffic of a built-in workload, or read from a file.
+    if (name in workloads):
+        lines = workloads[name](scale)
+        return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+    with open(name, "rb") as f:
+        return f.read()
+
+def make_client(storage):
+    # Set up the client with the stub UI and a connection that appears to be
+    # logged in, but writes nothing to the network.
+    pynapple.backends["replay"] = "pynapple_replay"
+    pynapple.Session.historyEnabled = storage
+    pynapple.Session.logRaw = storage
+    pynapple.Session.logChat = storage
+    pynapple.IRC.nick = nick
+    ui = pynapple.start("replay")
+    session = pynapple.session
+    conn = pynapple.IRC(session)
+    conn.server = "replay.example"
+    conn.port = 6667
+    conn.connected = True
+    conn.sendQueue = SendQueue()
+    conn.sendQueue.close() # (PONGs etc. go nowhere)
+    session.connections["replay.example:6667"] = conn
+    session.active = conn
+    return ui, conn
+
+class Timer:
+    # Accumulates the time spent in calls to a method, by wrapping it.
+    def __init__(self, obj, name):
+        self.seconds = 0.0
+        f = getattr(obj, name)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.seconds += time.perf_counter() - start
+        setattr(obj, name, timed)
+
+def replay(data, storage=False):
+    # Push the traffic through every stage and return a dictionary of results.
+    ui, conn = make_client(storage)
+    formatTimers = [Timer(ui, "add_message"), Timer(ui, "add_user_message")]
+    stages = {}
+    start = time.perf_counter()
+    framer = LineFramer(conn.rxBufferSize, conn.maxLineLength)
+    lines = []
+    view = memoryview(data)
+    for i in range(0, len(data), chunkSize):
+        lines += framer.feed(view[i:i + chunkSize])
+    stages["frame"] = time.perf_counter() - start
+    start = time.perf_counter()
+    conn.log_received(lines)
+    stages["log"] = time.perf_counter() - start
+    start = time.perf_counter()
+    messages = [conn.parse_message(line) for line in lines]
+    stages["parse"] = time.perf_counter() - start
+    start = time.perf_counter()
+    for i, msg in enumerate(messages):
+        conn.handle_message(msg)
+        if (i % conn.pollBatchSize == 0):
+            conn.flush_nicklists() # as poll() does after each batch
+    conn.flush_churn(True)
+    handled = time.perf_counter() - start
+    stages["format"] = sum(t.seconds for t in formatTimers)
+    stages["handle"] = handled - stages["format"]
+    total = sum(stages.values())
+    pynapple.session.close_log()
+    return {"bytes": len(data), "messages": len(lines), "seconds": total,
+            "messagesPerSecond": len(lines) / total,
+            "stages": stages, "drawn": ui.uiPlugin.messages,
+            "nicklistUpdates": ui.uiPlugin.nicklistUpdates}
+
+def peak_memory(data, storage=False):
+    # Replay again under tracemalloc, returning the peak memory allocated (in
+    # bytes), not counting the traffic itself. Kept separate from the timed
+    # run, as tracing slows everything down a lot.
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    replay(data, storage)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak
+
+def get_revision():
+    # Return the git revision being measured, if we can tell.
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return out.stdout.decode().strip()
+    except OSError:
+        return ""
+
+def last_result(path, workload):
+    # Return the most recent stored result for a workload, or None.
+    last = None
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if (result.get("workload") == workload):
+                    last = result
+    except OSError:
+        pass
+    return last
+
+def report(result, previous, threshold):
+    stages = "  ".join("%s %.3fs" % (name, seconds)
+                       for name, seconds in result["stages"].items())
+    line = "%-10s %8d msgs %8.3f s %10.0f msgs/s" % (
+        result["workload"], result["messages"], result["seconds"],
+        result["messagesPerSecond"])
+    if (result.get("peakMemory") is not None):
+        line += " %7.1f MB peak" % (result["peakMemory"] / 1e6)
+    if (previous is not None):
+        change = (result["messagesPerSecond"] /
+                  previous["messagesPerSecond"] - 1) * 100
+        line += "  %+.1f%% vs %s" % (change, previous.get("revision") or "last run")
+        if (change < -threshold):
+            line += "  ** REGRESSION **"
+    print(line)
+    print("           " + stages)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay IRC traffic through pynapple's receive pipeline.")
+    parser.add_argument("workloads", nargs="*", metavar="WORKLOAD",
+                        help="built-in workload (%s) or a file of recorded "
+                        "traffic (default: all built-in workloads)" %
+                        ", ".join(sorted(workloads)))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="size of the built-in workloads (default: 1)")
+    parser.add_argument("--results", default="bench_results.jsonl",
+                        help="file results are appended to and compared with")
+    parser.add_argument("--no-save", action="store_true",
+                        help="don't store the results")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip measuring peak memory")
+    parser.add_argument("--storage", action="store_true",
+                        help="include logging and the history")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="slowdown in %% flagged as a regression")
+    parser.add_argument("--save", metavar="DIR",
+                        help="write the traffic of each workload to DIR")
+    args = parser.parse_args(argv)
+    revision = get_revision()
+    for name in args.workloads or sorted(workloads):
+        data = load_traffic(name, args.scale)
+        if (args.save):
+            os.makedirs(args.save, exist_ok=True)
+            with open(os.path.join(args.save, name + ".irc"), "wb") as f:
+                f.write(data)
+        result = replay(data, args.storage)
+        result["workload"] = name
+        result["scale"] = args.scale
+        result["revision"] = revision
+        result["version"] = pynapple.IRC.version
+        result["python"] = sys.version.split()[0]
+        result["date"] = datetime.datetime.now().isoformat(timespec="seconds")
+        result["peakMemory"] = None
+        if (not args.no_memory):
+            result["peakMemory"] = peak_memory(data, args.storage)
+        previous = last_result(args.results, name)
+        report(result, previous, args.threshold)
+        if (not args.no_save):
+            with open(args.results, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# A fixed-capacity ring buffer, used to keep a bounded amount of history
+# around (e.g. the scrollback of each buffer) without memory use growing with
+# uptime.
+
+class RingBuffer:
+    # Holds the most recent items appended to it, up to a fixed capacity, in a
+    # list that is overwritten in place once full. Indexing and slicing work
+    # as for a list (index 0 is the oldest item kept) and take constant time
+    # per item, so a window of items anywhere in the history can be read back
+    # cheaply. The list only grows as far as it has to.
+    def __init__(self, capacity):
+        if (capacity < 1):
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.items = []
+        self.start = 0   # index in self.items of the oldest item
+        self.dropped = 0 # items thrown away to make room for newer ones
+
+    def __len__(self):
+        return len(self.items)
+
+    def append(self, x):
+        # Add an item, dropping the oldest one if full.
+        if (len(self.items) < self.capacity):
+            self.items.append(x)
+        else:
+            self.items[self.start] = x
+            self.start += 1
+            if (self.start == self.capacity):
+                self.start = 0
+            self.dropped += 1
+
+    def clear(self):
+        self.items = []
+        self.start = 0
+
+    def __getitem__(self, i):
+        if (isinstance(i, slice)):
+            start, stop, step = i.indices(len(self.items))
+            if (step != 1):
+                return [self[x] for x in range(start, stop, step)]
+            return self.slice(start, stop)
+        n = len(self.items)
+        if (i < 0):
+            i += n
+        if (i < 0 or i >= n):
+            raise IndexError("ring buffer index out of range")
+        i += self.start
+        if (i >= n):
+            i -= n
+        return self.items[i]
+
+    def slice(self, start, stop):
+        # Return the items from start up to (but not including) stop as a list.
+        # Both must be within 0...len(self).
+        if (stop <= start):
+            return []
+        n = len(self.items)
+        a = self.start + start
+        b = self.start + stop
+        if (a >= n):
+            return self.items[a - n:b - n]
+        if (b <= n):
+            return self.items[a:b]
+        return self.items[a:] + self.items[:b - n]
+
+    def __iter__(self):
+        return iter(self.slice(0, len(self.items)))
+
+    def last(self, n):
+        # Return the newest n items (or fewer, if we don't have that many).
+        return self.slice(max(0, len(self.items) - n), len(self.items))
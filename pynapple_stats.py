@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Pynapple IRC Client. Copyright 2013 Windsor Schmidt <windsor.schmidt@gmail.com>
+#
+# Runtime metrics: cheap histograms of how long things take, collected on the
+# hot paths while the client runs, and a background thread that periodically
+# appends a snapshot of them (and whatever else the client reports) to a file,
+# one JSON object per line, for graphing later.
+
+import json
+import threading
+import time
+
+class Histogram:
+    # Counts durations in power-of-two buckets of microseconds (bucket n holds
+    # those under 2^n us), so that adding one costs a few integer operations
+    # and the percentiles come out within a factor of two, which is plenty for
+    # spotting where time goes.
+    bucketCount = 32 # the last bucket holds everything over ~18 minutes
+
+    def __init__(self):
+        self.buckets = [0] * self.bucketCount
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        n = int(seconds * 1000000).bit_length()
+        if (n >= self.bucketCount):
+            n = self.bucketCount - 1
+        self.buckets[n] += 1
+        self.count += 1
+        self.total += seconds
+        if (seconds > self.max):
+            self.max = seconds
+
+    def percentile(self, p):
+        # Return (an upper bound on) the duration under which the given
+        # fraction of those added fell.
+        if (self.count == 0):
+            return 0.0
+        wanted = p * self.count
+        seen = 0
+        for n, count in enumerate(self.buckets):
+            seen += count
+            if (seen >= wanted):
+                return min((1 << n) / 1000000.0, self.max)
+        return self.max
+
+    def get_stats(self):
+        average = 0.0
+        if (self.count):
+            average = self.total / self.count
+        return {"count": self.count, "average": average,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99),
+                "max": self.max}
+
+    def summary(self):
+        # Return the statistics as a short line of text, in milliseconds.
+        s = self.get_stats()
+        return ("n=%d avg=%.3f p50=%.3f p99=%.3f max=%.3f ms" %
+                (s["count"], s["average"] * 1000, s["p50"] * 1000,
+                 s["p99"] * 1000, s["max"] * 1000))
+
+class Metrics:
+    # The histograms kept for the receive path: time spent queued between the
+    # socket and the UI thread, and per message, time spent parsing, in the
+    # handlers, and drawing it. Updated on the UI thread only.
+    names = ("queued", "parse", "dispatch", "ui")
+
+    def __init__(self):
+        self.histograms = {}
+        for name in self.names:
+            self.histograms[name] = Histogram()
+        self.uiSeconds = 0.0 # running total of time spent drawing messages
+        self.started = time.time()
+
+    def get_stats(self):
+        stats = {}
+        for name, histogram in self.histograms.items():
+            stats[name] = histogram.get_stats()
+        return stats
+
+class StatsWriter(threading.Thread):
+    # Appends the dictionary returned by collect() (plus the time) to a file
+    # every interval seconds, until stopped. collect() is called on this
+    # thread, so it should only read counters.
+    def __init__(self, path, interval, collect):
+        super(StatsWriter, self).__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.collect = collect
+        self.stopRequest = threading.Event()
+        self.errors = 0
+
+    def run(self):
+        while (not self.stopRequest.wait(self.interval)):
+            self.write()
+
+    def write(self):
+        try:
+            stats = self.collect()
+        except RuntimeError:
+            # Something we were reading from changed size under us; try again
+            # next time.
+            return
+        stats["time"] = time.time()
+        try:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(stats, sort_keys=True) + "\n")
+        except OSError:
+            self.errors += 1
+
+    def stop(self):
+        # Stop, writing one last snapshot.
+        if (not self.stopRequest.is_set()):
+            self.stopRequest.set()
+            self.write()
@@ -1,7 +1,12 @@
 from tkinter import *
 from tkinter import ttk
 import tkinter.font
+import bisect
+import collections
+import os
 import random
+import threading
+import time
 root = Tk()
 
 class UserInterfacePlugin:
@@ -12,6 +17,9 @@ class UserInterfacePlugin:
 
     hilite_bg = "#882255"
     hilite_fg = "#ffccee"
+    maxLines = 5000 # lines kept in the chat and server panes
+    frameInterval = 16 # ms between redraws of the chat and server panes
+    nickBatchLimit = 64 # nick-list changes applied one by one, at most
 
     root.title("pynapple")
     root.rowconfigure(0, weight=1)
@@ -32,7 +40,11 @@ class UserInterfacePlugin:
 
     statustxt = StringVar()
     status = Label(p1, textvariable=statustxt, font=medVarFnt)
-    status.grid(sticky="ew", row=0, columnspan=2, padx=4, pady=4)
+    status.grid(sticky="ew", row=0, padx=4, pady=4)
+
+    nickcounttxt = StringVar()
+    nickcount = Label(p1, textvariable=nickcounttxt, font=medVarFnt)
+    nickcount.grid(row=0, column=1, padx=4, pady=4)
 
     chat = Text(p1, font=medFixFnt, state = "disabled", background = "#0a0a0a")
     chat.grid(sticky="nsew", row=1, padx=2)
@@ -44,7 +56,11 @@ class UserInterfacePlugin:
 
     cmdtxt = StringVar()
     cmd = Entry(p1, textvariable=cmdtxt, font=medFixFnt)
-    cmd.grid(sticky="ew", row=2, columnspan=2, padx=4, pady=4)
+    cmd.grid(sticky="ew", row=2, padx=4, pady=4)
+
+    lagtxt = StringVar()
+    lag = Label(p1, textvariable=lagtxt, font=medVarFnt, foreground="#F92672")
+    lag.grid(row=2, column=1, padx=4, pady=4)
     cmd.focus()
 
     server = Text(p2, font=medFixFnt, state = "disabled", background = "#0a0a0a")
@@ -53,9 +69,24 @@ class UserInterfacePlugin:
     def __init__(self, irc, kb):
         self.ircHandle = irc
         self.kbHandle = kb
+        self.wakeups = 0        # times we woke up to handle network data
+        self.idleWakeups = 0    # ... and found nothing to do
+        self.latencyCount = 0   # batches of messages shown
+        self.latencyTotal = 0.0 # seconds from arrival to being on screen
+        self.latencyMax = 0.0
         root.title("pynapple-irc v" + self.ircHandle.get_version())
         self.cmd.bind('<Return>', self.handle_input)
+        self.notebook.bind('<<NotebookTabChanged>>', self.tab_changed)
         self.maxColors = 128
+        self.chatLines = 0
+        self.serverLines = 0
+        self.chatPending = []   # insert() arguments for lines not yet shown
+        self.serverPending = []
+        self.renderScheduled = False
+        self.renderSince = None # arrival time of the oldest lines not shown
+        self.nickNames = []     # the names in the nick-list, in order
+        self.nickKeys = None    # ... and their sort keys, once needed
+        self.nickSource = None  # the NickList they were last taken from
         self.init_colors()
         self.ircHandle.get_status()
 
@@ -71,6 +102,8 @@ class UserInterfacePlugin:
         self.chat.tag_configure(6, foreground = "#465457")
         self.chat.tag_configure(7, foreground = "#CCCCC6")
         self.server.tag_configure("server", foreground = "#CCCCC6")
+        self.chat.tag_configure("h", background = self.hilite_bg,
+                                foreground = self.hilite_fg)
         # TODO: make colors less pastel (only one of RGB values allowed > x)
         for tag in range(self.maxColors):
             rgb = [random.randint(64,255) for x in range(3)]
@@ -117,50 +150,269 @@ class UserInterfacePlugin:
         s  = "%s %s %s %s" % (nick, a, b, c)
         self.statustxt.set(s)
 
-    def add_message(self, s, color, hilite):
+    def set_scrollback(self, lines):
+        # Show the given RingBuffer of (message, color, hilite) records in the
+        # chat window, i.e. switch to another buffer. The newest lines are
+        # inserted with a single call.
+        args = []
+        for s, color, hilite in lines.last(self.maxLines):
+            args.extend(("\n", (), s, "h" if hilite else color))
+        self.chatPending = [] # (lines from the buffer we're leaving)
         self.chat.configure(state = "normal")
-        self.chat.insert('end', "\n")
-        if (hilite):
-            self.chat.tag_configure("h", background = self.hilite_bg,
-                                    foreground = self.hilite_fg)
-            self.chat.insert('end', s, "h")
-        else:
-            self.chat.insert('end', s, color)
+        self.chat.delete("1.0", "end")
+        if (args):
+            self.chat.insert('end', *args)
         self.chat.configure(state = "disabled")
         self.chat.see('end')
+        self.chatLines = len(args) // 4
+
+    def add_message(self, s, color, hilite):
+        # Lines are collected and added to the Text widget once per frame
+        # (see render()), rather than one at a time.
+        self.chatPending.extend(("\n", (), s, "h" if hilite else color))
+        self.schedule_render()
 
     def add_debug_message(self, s):
+        # Only called while the server pane is shown.
+        self.serverPending.extend(("\n", (), s, "server"))
+        self.schedule_render()
+
+    def set_debug_lines(self, lines):
+        # Replace the contents of the server pane with the given messages.
         self.server.configure(state = "normal")
-        self.server.insert('end', "\n" + s, "server")
+        self.server.delete("1.0", "end")
         self.server.configure(state = "disabled")
-        self.server.see('end')
+        self.serverLines = 0
+        self.serverPending = []
+        for s in lines:
+            self.serverPending.extend(("\n", (), s, "server"))
+        self.schedule_render()
+
+    def schedule_render(self):
+        if (not self.renderScheduled):
+            self.renderScheduled = True
+            root.after(self.frameInterval, self.render)
+
+    def render(self):
+        # Add the lines collected since the last frame to the chat and server
+        # panes, each with a single insert() call.
+        self.renderScheduled = False
+        if (self.chatPending):
+            self.chatLines = self.append(self.chat, self.chatPending,
+                                         self.chatLines)
+            self.chatPending = []
+        if (self.serverPending):
+            self.serverLines = self.append(self.server, self.serverPending,
+                                           self.serverLines)
+            self.serverPending = []
+        if (self.renderSince is not None):
+            since = self.renderSince
+            self.renderSince = None
+            self.note_latency(since)
+
+    def append(self, text, args, lines):
+        # Insert lines (given as insert() arguments, four per line) at the end
+        # of a Text widget, and return the number of lines it now holds. Only
+        # the last maxLines are inserted, as the rest would be trimmed right
+        # away. The widget is scrolled to show the new lines only if the user
+        # hadn't scrolled back from the end.
+        if (len(args) > self.maxLines * 4):
+            args = args[-self.maxLines * 4:]
+        atEnd = text.yview()[1] >= 1.0
+        text.configure(state = "normal")
+        text.insert('end', *args)
+        lines = self.trim(text, lines + len(args) // 4)
+        text.configure(state = "disabled")
+        if (atEnd):
+            text.see('end')
+        return lines
+
+    def trim(self, text, lines):
+        # Keep a Text widget from growing without bounds. Once it holds a
+        # tenth more than maxLines lines, the oldest ones are deleted in one
+        # go. Returns the number of lines left.
+        if (lines > self.maxLines + self.maxLines // 10):
+            excess = lines - self.maxLines
+            text.delete("1.0", "%d.0" % (excess + 1))
+            lines -= excess
+        return lines
 
     def set_nicklist(self, a):
-        # Populate the nick-list with an alphabetically sorted array of nicks.
+        # Populate the nick-list with a sorted array of nicks.
+        self.nickNames = list(a)
+        self.nickKeys = None
+        self.nickSource = None
         self.nicktxt.set(tuple(a))
+        self.nickcounttxt.set("%d users" % len(a))
+
+    def update_nicklist(self, nicklist, added, removed):
+        # Apply a change to the nick-list. The nicks added and removed are
+        # given along with the complete, updated NickList. A few changes are
+        # made row by row, each found by bisecting our copy of the names shown
+        # (or rather, of their sort keys), so that a join costs the same in a
+        # channel of ten users or ten thousand; the list is set all at once
+        # when there are many, or it is another NickList than the one shown.
+        if (nicklist is not self.nickSource or
+            len(added) + len(removed) > max(self.nickBatchLimit, len(nicklist) // 10)):
+            self.set_nicklist(nicklist.names())
+            self.nickSource = nicklist
+            return
+        names = self.nickNames
+        keys = self.nickKeys
+        if (keys is None):
+            keys = self.nickKeys = [nicklist.display_key(s) for s in names]
+        # A disabled Listbox ignores insert() and delete().
+        self.nicks.configure(state = "normal")
+        for name in removed:
+            i = bisect.bisect_left(keys, nicklist.display_key(name))
+            if (i < len(names) and names[i] == name):
+                del names[i]
+                del keys[i]
+                self.nicks.delete(i)
+        for name in added:
+            key = nicklist.display_key(name)
+            i = bisect.bisect_left(keys, key)
+            if (i < len(names) and names[i] == name):
+                continue # already shown
+            names.insert(i, name)
+            keys.insert(i, key)
+            self.nicks.insert(i, name)
+        self.nicks.configure(state = "disabled")
+        self.nickcounttxt.set("%d users" % len(names))
 
 
+    def set_lag(self, seconds):
+        # Show how many seconds behind the server the display is, or nothing
+        # if 0.
+        if (seconds > 0):
+            self.lagtxt.set("lag %.1fs" % seconds)
+        else:
+            self.lagtxt.set("")
+
     def handle_input(self, event):
         s = self.cmdtxt.get()
         if (s != ""):
             self.kbHandle.parse_input(s)
             self.cmdtxt.set("")
 
+    def tab_changed(self, event):
+        # Traffic is only drawn in the server pane while it is shown.
+        self.ircHandle.set_debug_shown(self.notebook.select() == str(self.p2))
+
     def toggle_debug(self):
+        if (self.notebook.select() == str(self.p2)):
+            self.notebook.select(self.p1)
+            return
         self.notebook.select(self.p2)
         self.chat.configure(font=self.bigFixFnt)
         self.cmd.configure(font=self.bigFixFnt)
         self.nicks.configure(font=self.bigFixFnt)
         self.status.configure(font=self.bigVarFnt)
-        # TODO: what does 'toggle' mean for tabs?
 
-    def polling_task(self):
-        self.ircHandle.poll()
-        root.after(4, self.polling_task)
+    def polling_task(self, *args):
+        # Handle a batch of incoming messages, without waiting for any. Called
+        # by Tk when the socket threads' wakeup pipe becomes readable. If the
+        # batch budget ran out before the receive queue was drained, come
+        # straight back (after pending Tk events have had a chance to run).
+        wakeup = self.ircHandle.get_wakeup()
+        since = wakeup.setAt
+        self.wakeups += 1
+        if (self.ircHandle.poll(0) > 0):
+            self.note_latency(since)
+        else:
+            self.idleWakeups += 1
+        if (self.ircHandle.get_backlog() > 0):
+            root.after(0, self.polling_task)
+        elif (self.pollInterval is not None):
+            root.after(self.pollInterval, self.polling_task)
+
+    def note_latency(self, since):
+        # Record how long messages that arrived at the given time took to be
+        # drawn, once they've been added to the panes (at the next frame) and
+        # Tk has caught up with redrawing (in its idle tasks).
+        if (self.renderScheduled):
+            if (self.renderSince is None or since < self.renderSince):
+                self.renderSince = since
+            return
+        def done():
+            latency = time.monotonic() - since
+            self.latencyCount += 1
+            self.latencyTotal += latency
+            self.latencyMax = max(self.latencyMax, latency)
+        root.after_idle(done)
+
+    def get_wakeup_stats(self):
+        # Return the number of wakeups to handle network data, how many of
+        # those found nothing to do, and the average and worst time taken from
+        # messages arriving to being drawn.
+        average = 0.0
+        if (self.latencyCount):
+            average = self.latencyTotal / self.latencyCount
+        return {"wakeups": self.wakeups, "idleWakeups": self.idleWakeups,
+                "latencyAverage": average, "latencyMax": self.latencyMax}
 
     def run(self):
-        root.after(4, self.polling_task)
+        engine = self.ircHandle.get_engine()
+        self.pollInterval = None
+        if (engine is not None):
+            # The asyncio engine runs on a thread of its own and hands us
+            # received messages through call_soon().
+            self.start_bridge()
+            engine.start_thread(self.call_soon)
+        else:
+            # Sleep until a socket thread says messages are waiting. Where Tk
+            # can't watch file handles (Windows), poll instead.
+            try:
+                root.createfilehandler(self.ircHandle.get_wakeup().fileno(),
+                                       tkinter.READABLE, self.polling_task)
+            except (AttributeError, OSError):
+                self.pollInterval = 4
+                root.after(self.pollInterval, self.polling_task)
         root.mainloop()
 
+    def start_bridge(self):
+        # Set up a way for other threads to run callbacks on the Tk thread. Tk
+        # watches the read end of a pipe, and call_soon() writes a byte to it
+        # whenever callbacks are waiting. Where Tk can't watch file handles
+        # (Windows), the callback queue is polled instead.
+        self.callbacks = collections.deque()
+        self.wakeLock = threading.Lock()
+        self.wakePending = False
+        try:
+            self.wakeR, self.wakeW = os.pipe()
+            root.createfilehandler(self.wakeR, tkinter.READABLE,
+                                   self.run_callbacks)
+        except (AttributeError, OSError):
+            self.wakeW = None
+            root.after(4, self.poll_callbacks)
+
+    def call_soon(self, f, *args):
+        # Run f(*args) on the Tk thread. May be called from any thread.
+        self.callbacks.append((f, args, time.monotonic()))
+        with self.wakeLock:
+            if (self.wakePending or self.wakeW is None):
+                return
+            self.wakePending = True
+        os.write(self.wakeW, b"x")
+
+    def run_callbacks(self, *args):
+        if (self.wakeW is not None):
+            with self.wakeLock:
+                os.read(self.wakeR, 1)
+                self.wakePending = False
+        self.wakeups += 1
+        if (not self.callbacks):
+            self.idleWakeups += 1
+            return
+        since = self.callbacks[0][2]
+        while (self.callbacks):
+            f, args, queuedAt = self.callbacks.popleft()
+            f(*args)
+        self.note_latency(since)
+
+    def poll_callbacks(self):
+        self.run_callbacks()
+        root.after(4, self.poll_callbacks)
+
     def shutdown(self):
         root.destroy()